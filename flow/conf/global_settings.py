@@ -18,6 +18,44 @@ PORTFOLIO_CACHE_BACKEND = None
 RATE_CACHE_SECONDS      = 10*24*60*60   # 10 days
 PORTFOLIO_CACHE_SECONDS = 10*60*60      # 10 hours
 
+# Limits of the portfolio calculation cache for each kind of element.
+# items: maximum number of cached elements
+# size:  maximum estimated memory in bytes
+# dates: maximum number of dates kept by each element
+# A missing or None value means no limit.
+PORTFOLIO_CACHE_LIMITS = {'instrument': {'items': 5000, 'size': 256*1024*1024, 'dates': 10},
+                          'portfolio':  {'items': 500,  'size': 256*1024*1024, 'dates': 10},
+                          'view':       {'items': 200,  'size': 128*1024*1024, 'dates': 10},
+                          'aggregate':  {'items': 50,   'size': 128*1024*1024, 'dates': 10},
+                          'scenario':   {'items': 10,   'size': 128*1024*1024}}
+
+# Number of threads used to build portfolio trees in parallel.
+# 0 builds sub-funds and instruments one after the other.
+PORTFOLIO_BUILD_THREADS = 8
+
+# Build portfolio views lazily. Folders are collapsed until expanded
+# and only expanded nodes are created.
+PORTFOLIO_TREE_LAZY = False
+
+# Seconds between database checks for position changes made by other
+# processes. Changes saved in this process invalidate the cache at once.
+PORTFOLIO_TIMECHECK_SECONDS = 5
+
+# Seconds a revision handed to a client for delta refreshes of portfolio
+# views is honoured. Clients polling with an older revision get the
+# whole tree.
+PORTFOLIO_DELTA_EXPIRY = 300
+
+# Parametric risk of portfolio trees.
+# method:     'sample' or 'ewma' covariance of position returns
+# lambda:     decay factor of the ewma covariance
+# shrinkage:  weight of the diagonal target, between 0 and 1
+# confidence: value at risk confidence level
+# returns:    'log' or 'simple' daily returns
+# periods:    number of periods in one year, used to annualise volatility
+PORTFOLIO_RISK = {'method': 'ewma', 'lambda': 0.94, 'shrinkage': 0.0, 'confidence': 0.99,
+                  'returns': 'log', 'periods': 252}
+
 FIRM_CODE_NAME = 'Firm code'
 
 FIELDS_SHORTCUTS = {'ASK' :'ASK_PRICE',
@@ -1,4 +1,6 @@
 
 from api import *
 from forms import *
+from bootstrap import *
+from rates import *
 #from managers import *
\ No newline at end of file
@@ -0,0 +1,148 @@
+from datetime import date
+
+import numpy as np
+
+from django.test import TestCase
+
+from jflow.core.cashflow import CashFlow, CashFlowMatrix, BootstrapEngine
+from jflow.core.cashflow.cash import singlecash
+from jflow.core.cashflow.cashflow import CashFlowBase
+from jflow.core.cashflow.matrix import csrpattern
+
+__all__ = ['BootstrapEngineTest', 'CsrPatternTest']
+
+
+START = date(2010,1,4)
+
+def dcf(dte):
+    return (dte - START).days/365.
+
+
+class quotecash(singlecash):
+    '''
+    Cash ammount which changes with the quote of the instrument
+    '''
+    def __init__(self, value, *args, **kwargs):
+        super(quotecash,self).__init__(*args, **kwargs)
+        self.value = value
+
+    def cash(self):
+        return self.value
+
+
+class instrument(CashFlow):
+    '''
+    Par instrument paying a coupon at each date and the notional at the last
+    '''
+    def __init__(self, rate, dates):
+        CashFlowBase.__init__(self, False)
+        self.coupons = []
+        for i,dte in enumerate(dates):
+            c = quotecash(rate, date = dte)
+            self.coupons.append(c)
+            self.add(c)
+        self.coupons[-1].value += 1.
+
+    def setrate(self, rate):
+        for c in self.coupons:
+            c.value = rate
+        self.coupons[-1].value += 1.
+
+
+def oldsolve(cfmat, known):
+    '''
+    Dense bootstrap of the cash flow matrix, columns located by
+    searching the node and right hand side dates as in CashFlowMatrix.build
+    '''
+    nodes = [kv.key for kv in cfmat.inner]
+    drhs  = sorted(set(d for cfs in cfmat.itervalues() for d in (kv.key for kv in cfs)) - set(nodes))
+    N,K   = len(nodes),len(drhs)
+    lhs   = np.zeros((N,N))
+    rhs   = np.zeros((N,K))
+    for row,cfs in enumerate(cfmat.itervalues()):
+        for kv in cfs:
+            if kv.key in drhs:
+                rhs[row,drhs.index(kv.key)] += kv.value.cash()
+            else:
+                lhs[row,nodes.index(kv.key)] += kv.value.cash()
+    b = np.ones(N)
+    if K:
+        b = b - np.dot(rhs,known(np.array([dcf(d) for d in drhs])))
+    return lhs, rhs, np.linalg.solve(lhs,b)
+
+
+class BootstrapEngineTest(TestCase):
+
+    def setUp(self):
+        annual = [date(START.year+i,1,4) for i in range(1,6)]
+        semi   = [date(START.year+i,7,4) for i in range(0,5)]
+        self.known = lambda T : np.exp(-0.03*T)
+        self.instruments = [instrument(0.02 + 0.002*i, annual[:i+1]) for i in range(4)]
+        self.instruments.append(instrument(0.015, sorted(semi + annual)))
+        self.cfmat = CashFlowMatrix()
+        for inst in self.instruments:
+            self.cfmat.add(inst)
+
+    def solve(self, engine):
+        lhs,rhs,trhs = engine.sparse()
+        b = np.ones(lhs.rows) - rhs.dot(self.known(trhs))
+        return lhs.solve_lower(b)
+
+    def testSameMatrices(self):
+        engine = BootstrapEngine(self.cfmat, dcf)
+        lhs,rhs,trhs = engine.sparse()
+        olhs,orhs,odfs = oldsolve(self.cfmat, self.known)
+        self.assertTrue(np.allclose(lhs.todense(),olhs))
+        self.assertTrue(np.allclose(rhs.todense(),orhs))
+        self.assertEqual(len(trhs),5)
+
+    def testDiscountFactors(self):
+        engine = BootstrapEngine(self.cfmat, dcf)
+        dfs = self.solve(engine)
+        olhs,orhs,odfs = oldsolve(self.cfmat, self.known)
+        self.assertEqual(len(dfs),5)
+        self.assertTrue(np.allclose(dfs,odfs,rtol = 0,atol = 1.0e-12))
+        self.assertTrue(np.all(np.diff(dfs[:4]) < 0))
+
+    def testRefreshQuotes(self):
+        engine = BootstrapEngine(self.cfmat, dcf)
+        key    = engine.key
+        self.solve(engine)
+        for i,inst in enumerate(self.instruments):
+            inst.setrate(0.03 + 0.001*i)
+        dfs = self.solve(engine)
+        olhs,orhs,odfs = oldsolve(self.cfmat, self.known)
+        self.assertEqual(key,BootstrapEngine.structure(self.cfmat))
+        self.assertTrue(np.allclose(dfs,odfs,rtol = 0,atol = 1.0e-12))
+
+
+class CsrPatternTest(TestCase):
+
+    def setUp(self):
+        self.r = [2, 0, 1, 0, 2, 2]
+        self.c = [1, 2, 0, 2, 0, 1]
+        self.pattern = csrpattern(3, 3, self.r, self.c)
+
+    def dense(self, v):
+        mat = np.zeros((3,3))
+        for r,c,x in zip(self.r,self.c,v):
+            mat[r,c] += x
+        return mat
+
+    def testDuplicatesSummed(self):
+        v   = [1., 2., 3., 4., 5., 6.]
+        mat = self.pattern.matrix(v)
+        self.assertEqual(mat.nnz(),4)
+        self.assertTrue(np.allclose(mat.todense(),self.dense(v)))
+        self.assertEqual(list(mat.indptr),[0,1,2,4])
+
+    def testSamePattern(self):
+        v = [-1., 0.5, 2., 3., 1., 1.]
+        self.assertTrue(np.allclose(self.pattern.matrix(v).todense(),self.dense(v)))
+        x = np.array([1., 2., 3.])
+        self.assertTrue(np.allclose(self.pattern.matrix(v).dot(x),np.dot(self.dense(v),x)))
+
+    def testEmpty(self):
+        mat = csrpattern(2, 2, [], []).matrix([])
+        self.assertEqual(mat.nnz(),0)
+        self.assertTrue(np.allclose(mat.todense(),np.zeros((2,2))))
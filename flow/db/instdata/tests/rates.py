@@ -0,0 +1,108 @@
+from datetime import date
+
+from twisted.internet import defer
+
+from django.test import TestCase
+
+from jflow.core.rates.cache import dateintervals
+from jflow.core.rates.factory.loader import inflightLoads, historyload
+
+__all__ = ['DateIntervalsTest', 'InflightLoadsTest']
+
+
+class DateIntervalsTest(TestCase):
+
+    def setUp(self):
+        self.di = dateintervals()
+        self.di.add(date(2010,1,10), date(2010,1,20))
+        self.di.add(date(2010,2,1), date(2010,2,10))
+
+    def testAdd(self):
+        self.assertEqual(len(self.di),2)
+        self.di.add(date(2010,1,5), date(2010,1,1))
+        self.assertEqual(list(self.di),[(date(2010,1,1),date(2010,1,5)),
+                                        (date(2010,1,10),date(2010,1,20)),
+                                        (date(2010,2,1),date(2010,2,10))])
+
+    def testMerge(self):
+        # adjacent intervals are merged
+        self.di.add(date(2010,1,21), date(2010,1,31))
+        self.assertEqual(list(self.di),[(date(2010,1,10),date(2010,2,10))])
+        self.di.add(date(2010,1,1), date(2010,3,1))
+        self.assertEqual(list(self.di),[(date(2010,1,1),date(2010,3,1))])
+
+    def testGaps(self):
+        di = self.di
+        self.assertEqual(di.gaps(date(2010,1,12), date(2010,1,18)),[])
+        self.assertEqual(di.gaps(date(2010,1,1), date(2010,2,5)),
+                         [(date(2010,1,1),date(2010,1,9)),
+                          (date(2010,1,21),date(2010,1,31))])
+        self.assertEqual(di.gaps(date(2010,1,15), date(2010,3,1)),
+                         [(date(2010,1,21),date(2010,1,31)),
+                          (date(2010,2,11),date(2010,3,1))])
+        self.assertEqual(dateintervals().gaps(date(2010,1,1), date(2010,1,2)),
+                         [(date(2010,1,1),date(2010,1,2))])
+
+
+class fakeloader(defer.Deferred):
+    
+    def __init__(self):
+        defer.Deferred.__init__(self)
+        self.loads = 0
+        
+    def load(self):
+        self.loads += 1
+        return self
+
+
+class InflightLoadsTest(TestCase):
+
+    def setUp(self):
+        # run the registry calls straight away instead of on the reactor
+        self.inflight = inflightLoads(callFromThread = lambda f, *args: f(*args))
+        self.loaders  = []
+
+    def create(self):
+        loader = fakeloader()
+        self.loaders.append(loader)
+        return loader
+
+    def testCoalesce(self):
+        d1 = self.inflight.get_or_load('a', self.create)
+        d2 = self.inflight.get_or_load('a', self.create)
+        self.inflight.get_or_load('b', self.create)
+        self.assertEqual(len(self.loaders),2)
+        self.assertEqual([l.loads for l in self.loaders],[1,1])
+        self.assertEqual(len(self.inflight),2)
+        results = []
+        d1.addCallback(lambda r: results.append(('d1',r)) or 'changed')
+        d2.addCallback(lambda r: results.append(('d2',r)))
+        self.loaders[0].callback('result')
+        self.assertEqual(results,[('d1','result'),('d2','result')])
+        self.assertEqual(len(self.inflight),1)
+        # a request after the loader has finished starts a new loader
+        self.inflight.get_or_load('a', self.create)
+        self.assertEqual(len(self.loaders),3)
+
+    def testFailure(self):
+        errors = []
+        for i in range(2):
+            self.inflight.get_or_load('a', self.create).addErrback(errors.append)
+        self.loaders[0].errback(ValueError('failed'))
+        self.loaders[0].addErrback(lambda e: None)
+        self.assertEqual(len(errors),2)
+        self.assertTrue(errors[0].check(ValueError))
+        self.assertEqual(len(self.inflight),0)
+
+    def testCreateFailure(self):
+        def create():
+            raise ValueError('no loader')
+        errors = []
+        self.inflight.get_or_load('a', create).addErrback(errors.append)
+        self.assertEqual(len(errors),1)
+        self.assertEqual(len(self.inflight),0)
+
+    def testHistoryLoad(self):
+        d = self.inflight.get_or_load('a', self.create, historyload('GOOG_US'))
+        self.assertTrue(isinstance(d,historyload))
+        self.assertEqual(d.code(),'GOOG_US')
@@ -1,5 +1,7 @@
 from decimal import Decimal
+from threading import local
 
+from django.db import connection, transaction
 from django.db.models import Q
 
 from base import *
@@ -10,6 +12,28 @@ position_status_choice = (
                           (POSITION_STATUS_MANUAL,'Manuall'),
                           )
 
+def status_values(status):
+    '''
+    List of integer status flags from *status*,
+    or None if all statuses are required
+    '''
+    if str(status).lower() == 'all':
+        return None
+    try:
+        status = list(status)
+    except:
+        status = [status]
+    cstatus = []
+    for s in status:
+        try:
+            si = int(s)
+        except:
+            si = POSITION_STATUS_SYNCRONIZED
+        if si not in cstatus:
+            cstatus.append(si)
+    return cstatus
+
+
 class aggposition(list):
     
     def __init__(self, ic, dt = None):
@@ -17,10 +41,14 @@ class aggposition(list):
         self.dt   = dt or datetime.date.today()
         self.size = 0
         
-    def append(self, p):
-        pv = p.first_at_or_before(self.dt)
-        self.size += pv.size
-        super(aggposition,self).append({'position': p,'history': pv})
+    def append(self, p, history = None):
+        '''
+        Add position *p* with its prefetched *history* at the aggregation
+        date. A position without history has zero size.
+        '''
+        if history is not None:
+            self.size += history.size
+        super(aggposition,self).append({'position': p,'history': history})
         
         
 class CustodyAccountManager(models.Manager):
@@ -40,27 +68,10 @@ class CustodyAccountManager(models.Manager):
 class PositionManager(models.Manager):
         
     def status_filter(self, status):
-        if str(status).lower() == 'all':
+        values = status_values(status)
+        if values is None:
             return self.filter()
-        
-        status_values = list(dict(position_status_choice))
-        try:
-            status = list(status)
-        except:
-            status = [status]
-        cstatus = []
-        for s in status:
-            try:
-                si = int(s)
-            except:
-                si = POSITION_STATUS_SYNCRONIZED
-            if si not in cstatus:
-                cstatus.append(si)
-        s = cstatus.pop(0)
-        du = Q(status = s)
-        for s in cstatus:
-            du = du & Q(status = s)
-        return self.filter(du)    
+        return self.filter(status__in = values)
     
     def status_date_filter(self, dt = None, status = POSITION_STATUS_SYNCRONIZED):
         dt = dt or datetime.date.today()
@@ -68,15 +79,70 @@ class PositionManager(models.Manager):
         return qs.filter(Q(open_date__lte = dt),
                          Q(close_date__gt = dt) | Q(close_date__isnull=True))
     
+    def snapshot_filter(self, dt = None, status = POSITION_STATUS_SYNCRONIZED):
+        '''
+        Open positions at *dt* read from the materialised snapshot.
+        Snapshots are built when positions are loaded, never here.
+        If *dt* is not materialised the positions table is filtered.
+        '''
+        from jflow.db.trade.models import PositionSnapshot as PS
+        dt = dt or datetime.date.today()
+        if not PS.objects.materialised(dt):
+            return self.status_date_filter(dt = dt, status = status)
+        # a single filter call, so that both conditions apply to the same snapshot row
+        kwargs = {'snapshots__dt': dt}
+        values = status_values(status)
+        if values is not None:
+            kwargs['snapshots__status__in'] = values
+        return self.filter(**kwargs)
+    
     def positions_for_fund(self, fund = None, dt = None, status = POSITION_STATUS_SYNCRONIZED):
-        qs    = self.status_date_filter(dt = dt, status = status)
+        qs    = self.snapshot_filter(dt = dt, status = status)
         if not fund:
             return qs
         else:
             return qs.filter(fund = fund)
+    
+    def fund_tree(self, fund):
+        '''
+        List of ids of *fund* and all its sub-funds.
+        The fund hierarchy is loaded with one query.
+        '''
+        from jflow.db.trade.models import Fund
+        children = {}
+        for id,parent in Fund.objects.values_list('id','parent'):
+            if parent is not None:
+                children.setdefault(parent,[]).append(id)
+        ids   = []
+        stack = [fund.id]
+        while stack:
+            id = stack.pop()
+            ids.append(id)
+            stack.extend(children.get(id,()))
+        return ids
+    
+    def positions_for_fund_tree(self, fund, dt = None, status = POSITION_STATUS_SYNCRONIZED):
+        '''
+        Open positions in *fund* and all its sub-funds at date *dt*
+        together with their latest history at or before *dt*.
+        Positions are fetched with one query and their histories with
+        another, positions without history have None as history.
+        Return a dictionary of lists of (position, history) tuples
+        keyed by fund id.
+        '''
+        from jflow.db.trade.models import PositionHistory as PH
+        dt  = dt or datetime.date.today()
+        ids = self.fund_tree(fund)
+        qs  = self.positions_for_fund(dt = dt, status = status).filter(fund__in = ids)
+        qs  = list(qs.select_related('instrumentCode','fund'))
+        hist   = PH.objects.latest_for_positions(qs, dt)
+        result = dict((id,[]) for id in ids)
+        for p in qs:
+            result[p.fund_id].append((p,hist.get(p.id,None)))
+        return result
         
     def positions_for_team(self, team = None, dt = None, status = POSITION_STATUS_SYNCRONIZED):
-        qs    = self.status_date_filter(dt = dt, status = status)
+        qs    = self.snapshot_filter(dt = dt, status = status)
         if not team:
             return qs        
         else:
@@ -99,13 +165,16 @@ class PositionManager(models.Manager):
         #fund_ids = [row[0] for row in cursor.fetchall()]
         #return qs.filter(fund__in = fund_ids)
         
-    def aggregate_positions(self, team = None, dt = None, dummy = False):
+    def aggregate_positions(self, team = None, dt = None, status = POSITION_STATUS_SYNCRONIZED):
         '''
         Return a dictionary contains aggregated positions
         for a given team and a given date
         '''
-        qs = self.positions_for_team(team = team, dt = dt, dummy = dummy)
-        pd = {}
+        from jflow.db.trade.models import PositionHistory as PH
+        qs   = self.positions_for_team(team = team, dt = dt, status = status)
+        qs   = list(qs.select_related('instrumentCode'))
+        hist = PH.objects.latest_for_positions(qs, dt)
+        pd   = {}
         for p in qs:
             ic   = p.instrumentCode
             code = ic.code
@@ -113,7 +182,7 @@ class PositionManager(models.Manager):
             if not agg:
                 agg = aggposition(ic,dt)
                 pd[code] = agg
-            agg.append(p)
+            agg.append(p, hist.get(p.id,None))
         return pd
     
     def get_or_create_position(self, fund, open_date, ic,
@@ -153,6 +222,65 @@ class PositionManager(models.Manager):
         
         return postn
     
+    def get_or_create_positions(self, trades, status = POSITION_STATUS_SYNCRONIZED):
+        '''
+        Bulk version of get_or_create_position.
+            trades    iterable over (fund, dt, instrumentCode) tuples
+            status    position status
+            
+        Open positions are loaded with one query and missing
+        positions are created.
+        Return a dictionary of positions keyed by
+        (fund id, instrumentCode id, dt)
+        '''
+        from jflow.db.trade.models import CustodyAccount as CA
+        trades = sorted(trades, key = lambda t: t[1])
+        if not trades:
+            return {}
+        funds = dict((f.id,f) for f,dt,ic in trades)
+        ics   = dict((ic.id,ic) for f,dt,ic in trades)
+        start = trades[0][1]
+        end   = trades[-1][1]
+        
+        custodians = {}
+        for c in CA.objects.filter(fund__in = funds.keys()):
+            custodians.setdefault(c.fund_id,c)
+        for id,f in funds.items():
+            if id not in custodians:
+                custodians[id] = CA.objects.get_for_fund(f)
+        
+        qs = self.filter(Q(fund__in           = funds.keys()),
+                         Q(instrumentCode__in = ics.keys()),
+                         Q(status             = status),
+                         Q(open_date__lte     = end),
+                         Q(close_date__gt = start) | Q(close_date__isnull=True))
+        candidates = {}
+        for p in qs:
+            if p.custodian_id == custodians[p.fund_id].id:
+                candidates.setdefault((p.fund_id,p.instrumentCode_id),[]).append(p)
+        
+        result = {}
+        for f,dt,ic in trades:
+            key = (f.id,ic.id,dt)
+            if key in result:
+                continue
+            postn = [p for p in candidates.get((f.id,ic.id),()) if p.open_date <= dt and
+                     (p.close_date is None or p.close_date > dt)]
+            if len(postn) == 1:
+                postn = postn[0]
+            elif not postn:
+                postn = self.model(instrumentCode = ic,
+                                   fund           = f,
+                                   custodian      = custodians[f.id],
+                                   open_date      = dt,
+                                   status         = status)
+                postn.save()
+                candidates.setdefault((f.id,ic.id),[]).append(postn)
+            else:
+                raise ValueError, "There are %s conflicting positions %s in %s" % (len(postn),ic,f)
+            result[key] = postn
+        return result
+    
     def clear_from_date(self, dt):
         '''
         delete all positions and histories opened after given date
@@ -173,6 +301,36 @@ class PositionHistoryManager(models.Manager):
     def predate(self, position, dt):
         return self.filter(position = position, dt__lte = dt)
     
+    def latest_at_or_before(self, dt, qs = None):
+        '''
+        Restrict *qs* to the latest history row of each position
+        at or before date *dt*
+        '''
+        from django.db import connection
+        qn    = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        where = '%(table)s.%(dt)s = (SELECT MAX(h.%(dt)s) FROM %(table)s h ' \
+                'WHERE h.%(pos)s = %(table)s.%(pos)s AND h.%(dt)s <= %%s)' % {
+                'table': table,
+                'dt':    qn('dt'),
+                'pos':   qn('position_id')}
+        if qs is None:
+            qs = self.all()
+        return qs.filter(dt__lte = dt).extra(where = [where], params = [dt])
+    
+    def latest_for_positions(self, positions, dt = None):
+        '''
+        Latest history at or before *dt* for a list of positions,
+        loaded with one query.
+        Return a dictionary of histories keyed by position id.
+        '''
+        dt  = dt or datetime.date.today()
+        ids = [p.id for p in positions]
+        if not ids:
+            return {}
+        qs  = self.latest_at_or_before(dt, self.filter(position__in = ids))
+        return dict((h.position_id,h) for h in qs)
+    
     def postdate(self, position, dt):
         return self.filter(position = position, dt__gt = dt)
     
@@ -193,32 +351,122 @@ class PositionHistoryManager(models.Manager):
             
         ''' 
         from jflow.db.trade.models import Position as PO
-        po = PO.objects.get_or_create_position(fund,
-                                               dt,
-                                               instrument,
-                                               status = status)
-        preh  = self.predate(po,dt)
-        if preh:
-            preh = preh[0]
-            if preh.dt < dt:
-                # Create a new history point
-                preh = self.model(position = po, dt = dt)
-        else:
-            preh = self.model(position = po, dt = dt)
+        self.addmany([(fund,dt,instrument,size,value,dirty_value)], status = status)
+        # the position traded by addmany, including custodian and close date
+        positions = PO.objects.get_or_create_positions([(fund,dt,instrument)], status = status)
+        return self.get(position = positions[(fund.id,instrument.id,dt)],
+                        dt       = dt)
+    
+    def addmany(self, rows, status = POSITION_STATUS_SYNCRONIZED):
+        '''
+        Bulk version of addnew for end of day position loads
+            rows      iterable over (fund, dt, instrument, size, value) or
+                      (fund, dt, instrument, size, value, dirty_value) tuples
+            status    position status
+            
+        A history point is created where needed, starting from the previous
+        point of the position, with one batched INSERT statement. Each trade
+        is then added to the history at its date and at all later dates with
+        set-based UPDATE statements, all in a single transaction.
+        Snapshot signals are suspended during the load. Once committed,
+        the snapshot rows of the traded positions are rebuilt at the
+        materialised dates from the first traded date, and the traded
+        dates are materialised if they are not already.
+        Return the number of (position, date) points traded.
+        '''
+        from jflow.db.trade.models import PositionSnapshot as PS
+        PS.objects.suspend()
+        try:
+            ids, dates, N = self.__addmany(rows, status)
+        finally:
+            PS.objects.resume()
+        if ids:
+            PS.objects.refresh_positions(ids, dates[0])
+            for dt in dates:
+                PS.objects.ensure(dt)
+        return N
+    
+    @transaction.commit_on_success
+    def __addmany(self, rows, status):
+        from jflow.db.trade.models import Position as PO
+        trades = {}
+        funds  = {}
+        insts  = {}
+        for row in rows:
+            fund, dt, inst, size, value = row[:5]
+            dirty_value = value
+            if len(row) > 5 and row[5] is not None:
+                dirty_value = row[5]
+            funds[fund.id] = fund
+            insts[inst.id] = inst
+            key = (fund.id,inst.id,dt)
+            t   = trades.get(key,None)
+            if t is None:
+                t = [Decimal(0),0.0,0.0]
+                trades[key] = t
+            t[0] += Decimal(str(size))
+            t[1] += float(value)
+            t[2] += float(dirty_value)
+        if not trades:
+            return [], None, 0
         
-        dirty_value       = dirty_value or value 
-        preh.size        += Decimal(str(size))
-        preh.value       += float(value)
-        preh.dirty_value += float(dirty_value)
-        preh.save()
+        positions = PO.objects.get_or_create_positions(((funds[f],dt,insts[i]) for f,i,dt in trades),
+                                                       status = status)
+        deltas = {}
+        for key,t in trades.items():
+            pk = (positions[key].id,key[2])
+            d  = deltas.get(pk,None)
+            if d is None:
+                deltas[pk] = t
+            else:
+                d[0] += t[0]
+                d[1] += t[1]
+                d[2] += t[2]
         
-        # Now check for post date positions
-        posth  = self.postdate(po,dt)
-        for p in posth:
-            p.size  += size
-            p.value += value
+        # Create missing history points from the previous point
+        qn     = connection.ops.quote_name
+        table  = qn(self.model._meta.db_table)
+        now    = datetime.datetime.now()
+        cursor = connection.cursor()
+        bydate = {}
+        for id,dt in deltas:
+            bydate.setdefault(dt,[]).append(id)
+        params = []
+        for dt,ids in bydate.items():
+            prev = self.latest_at_or_before(dt, self.filter(position__in = ids))
+            prev = dict((h.position_id,h) for h in prev)
+            for id in ids:
+                h = prev.get(id,None)
+                if h is None:
+                    params.append((id,dt,Decimal(0),0.0,0.0,0.0,0.0,now,now))
+                elif h.dt != dt:
+                    params.append((id,dt,h.size,h.value,h.dirty_value,
+                                   h.cost_unit_base,h.book_cost_base,now,now))
+        if params:
+            fields = ('position_id','dt','size','value','dirty_value',
+                      'cost_unit_base','book_cost_base','last_modified','created')
+            sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table,
+                                                       ', '.join(qn(f) for f in fields),
+                                                       ', '.join(['%s']*len(fields)))
+            cursor.executemany(sql, params)
         
-        return preh
+        # Propagate trades to their date and all later dates
+        sql = 'UPDATE %(table)s SET %(size)s = %(size)s + %%s, %(value)s = %(value)s + %%s, ' \
+              '%(dirty)s = %(dirty)s + %%s, %(lm)s = %%s ' \
+              'WHERE %(pos)s = %%s AND %(dt)s >= %%s' % {
+              'table': table,
+              'size':  qn('size'),
+              'value': qn('value'),
+              'dirty': qn('dirty_value'),
+              'lm':    qn('last_modified'),
+              'pos':   qn('position_id'),
+              'dt':    qn('dt')}
+        params = [(d[0],d[1],d[2],now,id,dt) for (id,dt),d in deltas.items()]
+        cursor.executemany(sql, params)
+        transaction.set_dirty()
+        ids = [p.id for p in positions.values()]
+        PO.objects.filter(id__in = ids).update(last_modified = now)
+        return ids, sorted(bydate), len(deltas)
     
     def add_from_size_and_price(self,
                                 fund,
@@ -245,3 +493,118 @@ class PositionHistoryManager(models.Manager):
         qs.delete()
         return N
     
+
+
+_snapshot = local()
+
+
+class PositionSnapshotManager(models.Manager):
+    '''
+    Manager of the materialised positions snapshot.
+    Each snapshot date holds one row for every position open at that date.
+    Materialised dates are recorded in PositionSnapshotDate, so that dates
+    without open positions are not materialised again.
+    Snapshots are built when positions are loaded (see
+    PositionHistoryManager.addmany) or by end of day jobs calling
+    ensure, and kept up to date by the signal handlers of the models.
+    '''
+    def suspended(self):
+        '''
+        True if snapshot refreshes from signals are suspended
+        in the current thread
+        '''
+        return getattr(_snapshot,'suspended',0) > 0
+    
+    def suspend(self):
+        _snapshot.suspended = getattr(_snapshot,'suspended',0) + 1
+        
+    def resume(self):
+        _snapshot.suspended = getattr(_snapshot,'suspended',1) - 1
+    
+    def materialised(self, dt):
+        '''
+        True if the snapshot at *dt* is materialised
+        '''
+        from jflow.db.trade.models import PositionSnapshotDate as PSD
+        return bool(PSD.objects.filter(dt = dt)[:1])
+    
+    def ensure(self, dt):
+        '''
+        Materialise the snapshot at *dt* if not already available
+        '''
+        if not self.materialised(dt):
+            self.materialise(dt)
+    
+    def dates(self, since = None):
+        '''
+        List of materialised dates, optionally at or after *since*
+        '''
+        from jflow.db.trade.models import PositionSnapshotDate as PSD
+        qs = PSD.objects.all()
+        if since:
+            qs = qs.filter(dt__gte = since)
+        return list(qs.values_list('dt', flat = True))
+    
+    @transaction.commit_on_success
+    def materialise(self, dt, positions = None):
+        '''
+        Build the snapshot rows at *dt* from positions and their latest
+        history with one INSERT ... SELECT statement. Positions without
+        history have zero size and value.
+        If *positions*, a list of position ids, is given only the
+        rows of those positions are rebuilt.
+        The build runs in its own transaction and first updates the
+        PositionSnapshotDate row of *dt*. The row lock taken by the update
+        makes concurrent builds of the same date run one after the other.
+        '''
+        from jflow.db.trade.models import Position as PO, PositionHistory as PH
+        from jflow.db.trade.models import PositionSnapshotDate as PSD
+        if positions is None:
+            PSD.objects.get_or_create(dt = dt)
+        elif not positions:
+            return
+        qn = connection.ops.quote_name
+        names = {'snap':  qn(self.model._meta.db_table),
+                 'dates': qn(PSD._meta.db_table),
+                 'pos':   qn(PO._meta.db_table),
+                 'hist':  qn(PH._meta.db_table),
+                 'id':    qn('id'),
+                 'dt':    qn('dt'),
+                 'posid': qn('position_id'),
+                 'fund':  qn('fund_id'),
+                 'ic':    qn('instrumentCode_id'),
+                 'stat':  qn('status'),
+                 'size':  qn('size'),
+                 'value': qn('value'),
+                 'open':  qn('open_date'),
+                 'close': qn('close_date')}
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %(dates)s SET %(dt)s = %(dt)s WHERE %(dt)s = %%s' % names, [dt])
+        delete = 'DELETE FROM %(snap)s WHERE %(dt)s = %%s' % names
+        insert = 'INSERT INTO %(snap)s (%(dt)s, %(fund)s, %(posid)s, %(ic)s, %(stat)s, %(size)s, %(value)s) ' \
+                 'SELECT %%s, p.%(fund)s, p.%(id)s, p.%(ic)s, p.%(stat)s, ' \
+                 'COALESCE(h.%(size)s, 0), COALESCE(h.%(value)s, 0) ' \
+                 'FROM %(pos)s p LEFT OUTER JOIN %(hist)s h ON h.%(posid)s = p.%(id)s ' \
+                 'AND h.%(dt)s = (SELECT MAX(h2.%(dt)s) FROM %(hist)s h2 ' \
+                 'WHERE h2.%(posid)s = p.%(id)s AND h2.%(dt)s <= %%s) ' \
+                 'WHERE p.%(open)s <= %%s AND (p.%(close)s > %%s OR p.%(close)s IS NULL)' % names
+        params = [dt]
+        if positions is not None:
+            ids     = ', '.join(['%s']*len(positions))
+            delete += ' AND %s IN (%s)' % (names['posid'],ids)
+            insert += ' AND p.%s IN (%s)' % (names['id'],ids)
+            params.extend(positions)
+        cursor.execute(delete, params)
+        cursor.execute(insert, [dt,dt,dt,dt] + params[1:])
+        transaction.set_dirty()
+    
+    def refresh_positions(self, positions, since = None):
+        '''
+        Rebuild the rows of *positions*, a list of position ids,
+        at all materialised dates at or after *since*,
+        one transaction per date
+        '''
+        if not positions:
+            return
+        for dt in self.dates(since):
+            self.materialise(dt, positions)
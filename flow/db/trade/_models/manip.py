@@ -2,12 +2,15 @@ import datetime
 
 from django.db import connection
 from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
 
 from trade import *
 from managers import *
 
 __all__ = ['Position',
            'PositionHistory',
+           'PositionSnapshot',
+           'PositionSnapshotDate',
            'ProfitAndLoss']
 
 
@@ -158,6 +161,58 @@ class PositionHistory(TimeStamp):
         super(PositionHistory,self).delete()
         
 
+class PositionSnapshot(models.Model):
+    '''
+    Materialised open positions at a date.
+    Rows are kept in sync with Position and PositionHistory
+    by the signal handlers below.
+    '''
+    dt             = models.DateField(verbose_name = 'date', db_index = True)
+    fund           = models.ForeignKey(Fund)
+    position       = models.ForeignKey(Position, related_name = 'snapshots')
+    instrumentCode = models.ForeignKey('instdata.InstrumentCode')
+    status         = models.IntegerField(default=1, choices = position_status_choice)
+    size           = models.DecimalField(default = 0, max_digits=MAX_DIGITS, decimal_places = ROUNDING)
+    value          = models.FloatField(default = 0.0)
+    
+    objects = PositionSnapshotManager()
+    
+    class Meta:
+        app_label       = current_app_label
+        ordering        = ('dt','fund')
+        unique_together = (("dt", "position"),)
+        
+    def __unicode__(self):
+        return '%s -- %s -- size: %s' % (self.dt,self.position,self.size)
+
+
+class PositionSnapshotDate(models.Model):
+    '''
+    Dates at which the positions snapshot has been materialised
+    '''
+    dt = models.DateField(verbose_name = 'date', unique = True)
+    
+    class Meta:
+        app_label       = current_app_label
+        ordering        = ('dt',)
+        
+    def __unicode__(self):
+        return u'%s' % self.dt
+
+
+def position_changed(sender, instance, **kwargs):
+    if not PositionSnapshot.objects.suspended():
+        PositionSnapshot.objects.refresh_positions([instance.id], instance.open_date)
+    
+def history_changed(sender, instance, **kwargs):
+    if not PositionSnapshot.objects.suspended():
+        PositionSnapshot.objects.refresh_positions([instance.position_id], instance.dt)
+
+post_save.connect(position_changed, sender = Position)
+post_save.connect(history_changed, sender = PositionHistory)
+post_delete.connect(history_changed, sender = PositionHistory)
+
+
 class ProfitAndLoss(models.Model):
     pl   = models.FloatField(default = 0.0)
     dv01 = models.FloatField(default = 0.0)
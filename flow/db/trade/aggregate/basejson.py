@@ -1,3 +1,5 @@
+from itertools import count
+
 from jflow.utils.observer import lazyobject
 from jflow.db.trade.models import Position
 
@@ -8,6 +10,52 @@ from logger import log, PositionObjectException
 import basecache 
 
 
+_revision  = 0
+_revisions = count(1)
+
+def nextrevision():
+    '''
+    Next value of the global revision counter.
+    Values are taken from an itertools.count, which is atomic,
+    so that objects are touched without taking a lock.
+    '''
+    global _revision
+    rev = _revisions.next()
+    if rev > _revision:
+        _revision = rev
+    return rev
+        
+def currentrevision():
+    return _revision
+
+def validrevision(revision):
+    '''
+    *revision* as an integer if it was handed out by this process,
+    otherwise None so that the whole object is returned. Revisions
+    greater than the current one were handed out before a restart.
+    '''
+    try:
+        revision = int(revision)
+    except (TypeError, ValueError):
+        return None
+    if 0 <= revision <= _revision:
+        return revision
+    else:
+        return None
+
+
+def elementsdelta(objs, revision):
+    '''
+    List of changes since *revision* of element objects *objs*
+    '''
+    deltas = []
+    for el in objs:
+        d = el.jsondelta(revision)
+        if d is not None:
+            deltas.append(d)
+    return deltas
+
+
 def listpop(li, elem):
     idx = 0
     for el in li:
@@ -37,12 +85,29 @@ class jsonTrade(basecache.cacheObject):
     subclasses:
         _build          for building the object after it has been created
         addcallback     for adding callback when the building process is finished
+        
+    Each object has a revision, a value of the global revision counter
+    taken when the object was last changed. Clients holding a revision
+    obtain only what changed since with rjsondelta.
     '''
+    _callbacks = None
+    
     def __init__(self, cache):
         super(jsonTrade,self).__init__(cache)
         self.__building    = False
         self.json          = {}
-        self._callbacks    = []
+        self.revision      = nextrevision()
+        self.created       = self.revision
+        
+    def touch(self):
+        '''
+        Mark the object as changed
+        '''
+        self.revision = nextrevision()
+        
+    def update(self, *args, **kwargs):
+        self.touch()
+        return super(jsonTrade,self).update(*args, **kwargs)
         
     def __unicode__(self):
         return u'%s' % self.cache
@@ -81,6 +146,8 @@ class jsonTrade(basecache.cacheObject):
     
     def addcallback(self, cbfun):
         if self.__building:
+            if self._callbacks is None:
+                self._callbacks = []
             self._callbacks.append(cbfun)
         else:
             try:
@@ -96,6 +163,21 @@ class jsonTrade(basecache.cacheObject):
         self.refresh()
         return self.json
     
+    def rjsondelta(self, revision):
+        '''
+        Return the json object if changed since *revision*, otherwise
+        a message saying it is unchanged. Both carry the revision
+        to use in the next call.
+        '''
+        rev  = currentrevision()
+        json = self.rjson()
+        if revision is None or self.revision > revision:
+            json = dict(json)
+            json['revision'] = rev
+            return json
+        else:
+            return {'revision': rev, 'unchanged': True}
+    
     def jsonDescription(self, msg):
         return {'error': False,
                 'object': str(self),
@@ -112,7 +194,7 @@ class jsonTrade(basecache.cacheObject):
     
     def _closebuild(self):
         self.__building = False
-        cbs = self._callbacks
+        cbs = self._callbacks or []
         while cbs:
             cbfun = cbs.pop()
             try:
@@ -123,6 +205,12 @@ class jsonTrade(basecache.cacheObject):
     
     
 class positionBase(jsonTrade):
+    '''
+    Base class for objects displayed as a row of the portfolio display.
+    Columns not available as attributes of the object are looked up in
+    the object returned by rowsource, otherwise set to rowmissing.
+    '''
+    rowmissing = ''
     
     def __init__(self, cache, obj, dte):
         super(positionBase,self).__init__(cache)
@@ -131,26 +219,36 @@ class positionBase(jsonTrade):
         self.id       = self.cache.get_object_id(self.dbobj)
         self.code     = self.dbobj.code
         self.rowdata  = []
+        self.cellrevisions = []
         
     def __unicode__(self):
         return u'%s' % self.code
         
     def __setitem__(self, code, value):
-        d = self.cache.displaydict.get(code,None)
-        N = len(self.rowdata)
-        if d is not None and N > d:
-            self.rowdata[d] = value
+        self.setslot(self.cache.layout.slots.get(code,None), value)
             
     def __getitem__(self, code):
-        d = self.cache.displaydict.get(code,None)
-        N = len(self.rowdata)
-        if d is not None and N > d:
+        d = self.cache.layout.slots.get(code,None)
+        if d is not None and len(self.rowdata) > d:
             return self.rowdata[d]
         else:
             return ''
+        
+    def setslot(self, d, value):
+        '''
+        Set the value at row position *d*
+        '''
+        N = len(self.rowdata)
+        if d is not None and N > d and self.rowdata[d] != value:
+            self.rowdata[d] = value
+            self.touch()
+            if len(self.cellrevisions) != N:
+                self.cellrevisions = [self.revision]*N
+            self.cellrevisions[d] = self.revision
 
     def reregister(self):
         self.rowdata = []
+        self.touch()
         self.register()
         
     def register(self):
@@ -160,14 +258,7 @@ class positionBase(jsonTrade):
         jsv = self.rowdata
         if jsv:
             return False
-        objs = self.cache.display
-        for el in objs:
-            code = el.code
-            # Try self first
-            attr = extract(self,code,jsv)
-            if not attr:
-                if not self.register2(code,jsv):
-                    jsv.append('#N/A')
+        jsv.extend(self.cache.layout.row(self, self.rowsource(), self.rowmissing))
         self.setstaticjson()
         return True
         
@@ -176,10 +267,31 @@ class positionBase(jsonTrade):
         json['id']    = self.id
         json['code']  = self.code
         json['row']   = self.rowdata
+        self.cellrevisions = [self.revision]*len(self.rowdata)
         
-    def register2(self, code, jsv):
-        jsv.append("")
-        return True
+    def jsondelta(self, revision):
+        '''
+        Changes since *revision* of an element of a tree. Return None if
+        unchanged, the json object if created after *revision*, otherwise
+        the json object without the row and with the changed cells
+        as a dictionary of position and value.
+        '''
+        if self.revision <= revision:
+            return None
+        json = self.json
+        if self.created > revision:
+            return json
+        delta = dict((k,v) for k,v in json.items() if k != 'row')
+        crevs = self.cellrevisions
+        row   = self.rowdata
+        delta['cells'] = dict((i,row[i]) for i,r in enumerate(crevs) if r > revision and i < len(row))
+        return delta
+        
+    def rowsource(self):
+        '''
+        Object providing the columns not available from self
+        '''
+        return None
     
     def refresh_me(self):
         '''
@@ -1,17 +1,28 @@
+import time
+from threading import Lock
+
 from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_save, post_delete
 
-from jflow.core.dates import now
+from jflow.conf import settings
+from jflow.core.dates import now, get_livedate
 from jflow.core.pricers import Pricer
-from jflow.db.trade.models import Position, PortfolioDisplayElement, PortfolioDisplay
+from jflow.db.trade.models import Position, PositionHistory, PortfolioDisplayElement, PortfolioDisplay
+from jflow.db.trade.models import Fund, FundHolder, PortfolioView
 #from jflow.db.trade.portfolio import get_liveposition, get_port_id
 from jflow.db import geo
 from jflow.utils.observer import lazyobject
 from jflow.utils.baseval import baseval
 from jflow.utils.tx import runInThread
+from jflow.db.trade.jsonstream import iterjson
 
 from basecache import cacheBase
+from basejson import validrevision
+from lru import lrucache, cachelimits
+from display import displaylayout
 from tscache import InstrumentTs, PortfolioTs, PortfolioViewTs, AggregateTs
-from rates import PortfolioRates
+from rates import PortfolioRates, history_dates
+from riskengine import ScenarioMatrix
 
 
 
@@ -25,11 +36,18 @@ def cachewrap(f):
     '''
     Decorator for cache methods.
     This decorator check if rjson is set to true in the argument list.
-    If it is, it serialize the object into a JSON string
+    If it is, it serialize the object into a JSON string.
+    If a revision keyword is given only changes since that revision
+    are serialized. Revisions which were not handed out by this process
+    get the whole object. If the stream keyword is True a generator of JSON
+    string chunks is returned instead.
     '''
     def wrapper(self, *args, **kwargs):
         # Check if positions have changed
         self.timecheck()
+        delta    = kwargs.get('revision',None) is not None
+        revision = validrevision(kwargs.pop('revision',None))
+        stream   = kwargs.pop('stream',False)
         el = f(self, *args,**kwargs)
         rjson = kwargs.get('rjson',False)
         if el == None:
@@ -40,6 +58,10 @@ def cachewrap(f):
             if el.building:
                 # The object is building. Return a JSON message saying so
                 return el.jsonDescription("Calculation is under way. Call back in few minutes");
+            elif delta:
+                return el.rjsondelta(revision)
+            elif stream:
+                return iterjson(el)
             else:
                 return el.rjson()
         else:
@@ -56,20 +78,128 @@ class CalculationCache(cacheBase):
     def __init__(self):
         super(CalculationCache,self).__init__()
         self.lastaccess = None
+        self.nextcheck  = 0
         self.rates      = PortfolioRates(self)
+        self.fundlock   = Lock()
+        self.dirtylock  = Lock()
+        self.dirtyfunds     = set()
+        self.dirtypositions = set()
         self.flush()
         
     def __str__(self):
         return '%s' % self.__class__.__name__
         
     def timecheck(self):
-        lm = Position.get_last_modified()
-        ld = PortfolioDisplay.objects.get_last_modified()
+        '''
+        Invalidate cached objects affected by changes since last access.
+        Funds of positions saved in this process are invalidated at once.
+        Changes made by other processes are found by querying the database,
+        at most once every PORTFOLIO_TIMECHECK_SECONDS.
+        A change in display elements flushes the cache, a change in
+        positions invalidates only the funds holding them.
+        '''
+        funds = self.changedfunds()
+        if funds:
+            self.invalidate(funds)
+        t = time.time()
+        if t < self.nextcheck:
+            return
+        self.nextcheck = t + getattr(settings,'PORTFOLIO_TIMECHECK_SECONDS',0)
         la = self.lastaccess
-        if la:
-            if lm > la or ld > la:
-                self.flush()
         self.lastaccess = now()
+        if not la:
+            return
+        if PortfolioDisplay.objects.get_last_modified() > la:
+            self.flush()
+            return
+        funds = set(Position.objects.filter(last_modified__gt = la).values_list('fund', flat = True))
+        funds.update(PositionHistory.objects.filter(last_modified__gt = la).values_list('position__fund', flat = True))
+        if funds:
+            self.invalidate(funds)
+    
+    def changed(self, fund = None, position = None):
+        '''
+        Record a change in *fund* or *position* ids. Called by
+        the Position and PositionHistory signal handlers.
+        '''
+        self.dirtylock.acquire()
+        try:
+            if fund is not None:
+                self.dirtyfunds.add(fund)
+            if position is not None:
+                self.dirtypositions.add(position)
+        finally:
+            self.dirtylock.release()
+    
+    def changedfunds(self):
+        '''
+        Set of ids of funds changed in this process since the last call
+        '''
+        self.dirtylock.acquire()
+        try:
+            funds     = self.dirtyfunds
+            positions = self.dirtypositions
+            self.dirtyfunds     = set()
+            self.dirtypositions = set()
+        finally:
+            self.dirtylock.release()
+        if positions:
+            funds.update(Position.objects.filter(id__in = positions).values_list('fund', flat = True))
+        return funds
+    
+    def invalidate(self, funds):
+        '''
+        Remove cached objects for funds with ids in *funds*
+        together with their parent funds, teams and portfolio views.
+        Instruments are not affected.
+        '''
+        parents = {}
+        holders = {}
+        codes   = {}
+        for id,code,parent,holder in Fund.objects.values_list('id','code','parent','fund_holder'):
+            parents[id] = parent
+            holders[id] = holder
+            codes[id]   = str(code)
+        ids = set()
+        for id in funds:
+            while id is not None and id not in ids and id in codes:
+                ids.add(id)
+                id = parents[id]
+        if not ids:
+            return
+        teams = FundHolder.objects.filter(id__in = set(holders[id] for id in ids))
+        views = PortfolioView.objects.filter(fund__in = ids).values_list('id', flat = True)
+        for id in ids:
+            self.__portfolios.pop(codes[id],None)
+        for team in teams.values_list('code', flat = True):
+            self.__team_aggregates.pop(str(team),None)
+        for view in views:
+            self.__portfolioviews.pop(str(view),None)
+        self.fundlock.acquire()
+        try:
+            for key in self.__fundpositions.keys():
+                if key[0] in ids:
+                    self.__fundpositions.pop(key,None)
+        finally:
+            self.fundlock.release()
+        self.log('Invalidated %s' % ', '.join(sorted(codes[id] for id in ids)))
+    
+    def scenarios(self, dte):
+        '''
+        Historical simulation scenario matrix for calculation date *dte*.
+        The matrix spans the DAYS_BACK history window and is shared by
+        all portfolios calculated at that date.
+        '''
+        dte = get_livedate(dte)
+        key = dte.dateonly
+        sm  = self.__scenarios.get(key,None)
+        if sm is None:
+            start, end = history_dates(dte)
+            sm = ScenarioMatrix(start, end)
+            self.__scenarios[key] = sm
+        else:
+            self.__scenarios.resize(key)
+        return sm
 
     @cachewrap
     def portfolio(self, code, dte, rjson = False, inthread = True):
@@ -87,6 +217,61 @@ class CalculationCache(cacheBase):
     def instrument(self, code, dte, rjson = False):
         return self.__make(code, dte, InstrumentTs, self.__instruments, rjson)
     
+    def fundpositions(self, fund, dt, status = 'all'):
+        '''
+        Open positions and their history for *fund* at date *dt*.
+        Positions loaded by loadfundtree for the build of a parent fund
+        are handed out once, otherwise they are queried.
+        '''
+        self.fundlock.acquire()
+        try:
+            pos = self.__fundpositions.pop((fund.id,dt),None)
+        finally:
+            self.fundlock.release()
+        if pos is None:
+            tree = Position.objects.positions_for_fund_tree(fund, dt = dt, status = status)
+            pos  = tree.get(fund.id,[])
+        return pos
+    
+    def loadfundtree(self, fund, dt, status = 'all'):
+        '''
+        Load positions and history for *fund* and all its sub-funds
+        with one query, unless they are already loaded by the build of
+        a parent fund. Return True if positions were loaded, in which
+        case the caller must call releasefundtree once built.
+        The query runs outside the lock, which only guards publishing
+        the results.
+        '''
+        self.fundlock.acquire()
+        try:
+            if (fund.id,dt) in self.__fundpositions:
+                return False
+        finally:
+            self.fundlock.release()
+        tree = Position.objects.positions_for_fund_tree(fund, dt = dt, status = status)
+        self.fundlock.acquire()
+        try:
+            # a concurrent build of the same tree published first
+            if (fund.id,dt) in self.__fundpositions:
+                return False
+            self.__fundpositions.update((((id,dt),v) for id,v in tree.items()))
+            self.__fundtrees[(fund.id,dt)] = tree.keys()
+            return True
+        finally:
+            self.fundlock.release()
+    
+    def releasefundtree(self, fund, dt):
+        '''
+        Remove the positions loaded by loadfundtree for *fund* which
+        have not been handed out
+        '''
+        self.fundlock.acquire()
+        try:
+            for id in self.__fundtrees.pop((fund.id,dt),()):
+                self.__fundpositions.pop((id,dt),None)
+        finally:
+            self.fundlock.release()
+    
     @cachewrap
     def addfolder(self, viewid, dte, code, parentid, rjson = False):
         p = self.portfolioview(viewid, dte)
@@ -107,6 +292,11 @@ class CalculationCache(cacheBase):
         p = self.portfolioview(viewid, dte)
         return p.move(id,target)
     
+    @cachewrap
+    def expandPortfolioNode(self, viewid, dte, id, rjson = False):
+        p = self.portfolioview(viewid, dte)
+        return p.expand(id)
+    
     @cachewrap
     def marketRisk(self, viewid, dte, id, rjson = False):
         p = self.portfolioview(viewid, dte)
@@ -114,17 +304,36 @@ class CalculationCache(cacheBase):
                 
     def flush(self, code = None):
         self.log("Flushing")
-        self.__team_aggregates = {}
-        self.__portfolioviews  = {}
-        self.__portfolios      = {}
-        self.__instruments     = {}
+        self.__team_aggregates = self.__holder('aggregate')
+        self.__portfolioviews  = self.__holder('view')
+        self.__portfolios      = self.__holder('portfolio')
+        self.__instruments     = self.__holder('instrument')
+        self.__scenarios       = self.__holder('scenario')
+        self.__fundpositions   = {}
+        self.__fundtrees       = {}
         self.display           = list(PortfolioDisplayElement.objects.all())
-        self.displaydict       = {}
-        p = 0
-        for d in self.display:
-            self.displaydict[d.code] = p
-            p += 1
+        self.layout            = displaylayout(self.display)
+        self.displaydict       = self.layout.slots
         
+    def __holder(self, kind):
+        limits = cachelimits(kind)
+        return lrucache(kind,
+                        maxitems = limits['items'],
+                        maxsize  = limits['size'],
+                        sizeof   = lambda el: el.memsize())
+    
+    def stats(self):
+        '''
+        Cache statistics. A list of dictionaries with item counts,
+        estimated resident size, hits, misses and evictions
+        for each kind of cached element
+        '''
+        return [h.stats() for h in (self.__instruments,
+                                    self.__portfolios,
+                                    self.__portfolioviews,
+                                    self.__team_aggregates,
+                                    self.__scenarios)]
+    
     def __make(self, code, dte, object, holder, rjson, inthread = False):
         '''
         Create the new JSON object
@@ -137,7 +346,9 @@ class CalculationCache(cacheBase):
         if pts == None:
             pts = object(code,self)
             holder[scode] = pts
-        return pts.get_or_create(dte, rjson, inthread)
+        el = pts.get_or_create(dte, rjson, inthread)
+        holder.resize(scode)
+        return el
     
     def get_object_id(self, obj):
         '''
@@ -159,3 +370,15 @@ class CalculationCache(cacheBase):
 
 _pcache = CalculationCache()
 
+
+def position_changed(sender, instance, **kwargs):
+    _pcache.changed(fund = instance.fund_id)
+    
+def history_changed(sender, instance, **kwargs):
+    _pcache.changed(position = instance.position_id)
+
+post_save.connect(position_changed, sender = Position)
+post_delete.connect(position_changed, sender = Position)
+post_save.connect(history_changed, sender = PositionHistory)
+post_delete.connect(history_changed, sender = PositionHistory)
+
@@ -0,0 +1,101 @@
+'''
+Compiled portfolio display configuration.
+Column codes of the display elements are resolved once for each class
+of row object into accessor functions, so that building a row does not
+look up attributes by name.
+'''
+import types
+
+__all__ = ['displaylayout', 'accessor', 'MISSING']
+
+MISSING = object()
+
+
+def callvalue(v):
+    # same rules as basejson.extract once the attribute is found
+    if not v:
+        return MISSING
+    if callable(v):
+        try:
+            return v()
+        except:
+            return '#Error'
+    return v
+
+
+def accessor(cls, code):
+    '''
+    Function returning the value of column *code* for an instance of *cls*
+    or MISSING if the instance has no such attribute or it is empty.
+    Methods and properties are resolved once from the class.
+    '''
+    raw = None
+    for klass in cls.__mro__:
+        if code in klass.__dict__:
+            raw = klass.__dict__[code]
+            break
+
+    if isinstance(raw,types.FunctionType):
+        def get(obj):
+            try:
+                return raw(obj)
+            except:
+                return '#Error'
+    elif isinstance(raw,property) and raw.fget:
+        fget = raw.fget
+        def get(obj):
+            try:
+                v = fget(obj)
+            except AttributeError:
+                return MISSING
+            return callvalue(v)
+    else:
+        def get(obj):
+            return callvalue(getattr(obj,code,None))
+    return get
+
+
+class displaylayout(object):
+    '''
+    Display layout for a list of PortfolioDisplayElement
+
+        * *codes* tuple of column codes
+        * *slots* dictionary of column code to row position
+    '''
+    def __init__(self, elements):
+        self.codes       = tuple(str(el.code) for el in elements)
+        self.slots       = dict((c,i) for i,c in enumerate(self.codes))
+        self.__accessors = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def slot(self, code):
+        return self.slots.get(code,None)
+
+    def accessors(self, cls):
+        '''
+        Tuple of accessor functions, one for each column, for instances of *cls*
+        '''
+        acc = self.__accessors.get(cls,None)
+        if acc is None:
+            acc = tuple(accessor(cls,code) for code in self.codes)
+            self.__accessors[cls] = acc
+        return acc
+
+    def row(self, obj, source = None, missing = ''):
+        '''
+        Row values for *obj*. Columns not available from *obj* are taken
+        from *source*, if given, otherwise set to *missing*.
+        '''
+        first = self.accessors(obj.__class__)
+        if source is None:
+            row = [get(obj) for get in first]
+        else:
+            row = []
+            for get,sget in zip(first,self.accessors(source.__class__)):
+                v = get(obj)
+                if v is MISSING:
+                    v = sget(source)
+                row.append(v)
+        return [missing if v is MISSING else v for v in row]
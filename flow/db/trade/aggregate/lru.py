@@ -0,0 +1,189 @@
+'''
+Size bounded least recently used containers for the calculation cache
+'''
+import sys
+from collections import OrderedDict
+from threading import Lock
+
+from jflow.conf import settings
+
+__all__ = ['lrucache', 'estimate_size', 'cachelimits']
+
+
+def estimate_size(obj, depth = 8):
+    '''
+    Rough estimate in bytes of the memory used by *obj*.
+    Only builtin containers are followed, up to *depth* levels.
+    '''
+    size = sys.getsizeof(obj, 64)
+    if depth:
+        depth -= 1
+        if isinstance(obj,dict):
+            for k,v in obj.iteritems():
+                size += estimate_size(k,depth) + estimate_size(v,depth)
+        elif isinstance(obj,(list,tuple,set)):
+            for v in obj:
+                size += estimate_size(v,depth)
+    return size
+
+
+def cachelimits(kind):
+    '''
+    Limits for cache *kind* from the PORTFOLIO_CACHE_LIMITS setting.
+    Return a dictionary with keys items, size and dates.
+    '''
+    limits = getattr(settings,'PORTFOLIO_CACHE_LIMITS',None) or {}
+    limits = limits.get(kind,None) or {}
+    return {'items': limits.get('items',None),
+            'size':  limits.get('size',None),
+            'dates': limits.get('dates',None)}
+
+
+class lrucache(object):
+    '''
+    Dictionary-like container bounded by number of items and by estimated
+    memory. When a limit is exceeded the least recently used items are evicted.
+    Items are kept in access order, so that eviction does not scan the items.
+    The size of a value is estimated when set and when resize is called,
+    not when the value is accessed.
+
+        @param name:     name used in statistics
+        @param maxitems: maximum number of items or None
+        @param maxsize:  maximum estimated size in bytes or None
+        @param sizeof:   function returning the estimated size of a value
+    '''
+    def __init__(self, name, maxitems = None, maxsize = None, sizeof = None):
+        self.name      = name
+        self.maxitems  = maxitems
+        self.maxsize   = maxsize
+        self.sizeof    = sizeof or estimate_size
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self.__data    = OrderedDict()
+        self.__size    = 0
+        self.__lock    = Lock()
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,self.name)
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __contains__(self, key):
+        return key in self.__data
+
+    def has_key(self, key):
+        return key in self.__data
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.__data.keys()
+
+    def values(self):
+        return [e[0] for e in self.__data.values()]
+
+    def items(self):
+        return [(k,e[0]) for k,e in self.__data.items()]
+
+    def __get_size(self):
+        return self.__size
+    size = property(fget = __get_size)
+
+    def get(self, key, default = None):
+        self.__lock.acquire()
+        try:
+            data = self.__data
+            e    = data.pop(key,None)
+            if e is None:
+                self.misses += 1
+                return default
+            # reinsert as most recently used
+            data[key]  = e
+            self.hits += 1
+            return e[0]
+        finally:
+            self.__lock.release()
+
+    def __getitem__(self, key):
+        e = self.__data.get(key,None)
+        if e is None:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value)
+        self.__lock.acquire()
+        try:
+            old = self.__data.pop(key,None)
+            if old is not None:
+                self.__size -= old[1]
+            self.__data[key] = [value,size]
+            self.__size += size
+            self.__evict()
+        finally:
+            self.__lock.release()
+
+    def resize(self, key):
+        '''
+        Estimate again the size of the value at *key*.
+        Used when values grow after insertion. The recency
+        of the value is not changed.
+        '''
+        e = self.__data.get(key,None)
+        if e is None:
+            return
+        size = self.sizeof(e[0])
+        self.__lock.acquire()
+        try:
+            if self.__data.get(key,None) is e:
+                self.__size += size - e[1]
+                e[1] = size
+                self.__evict()
+        finally:
+            self.__lock.release()
+
+    def pop(self, key, default = None):
+        self.__lock.acquire()
+        try:
+            e = self.__data.pop(key,None)
+            if e is None:
+                return default
+            self.__size -= e[1]
+            return e[0]
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        self.__lock.acquire()
+        try:
+            self.__data = OrderedDict()
+            self.__size = 0
+        finally:
+            self.__lock.release()
+
+    def __evict(self):
+        # must be called with the lock held. The most recent item is always kept
+        data     = self.__data
+        maxitems = self.maxitems
+        maxsize  = self.maxsize
+        while len(data) > 1 and ((maxitems and len(data) > maxitems) or
+                                 (maxsize and self.__size > maxsize)):
+            key,e = data.popitem(last = False)
+            self.__size    -= e[1]
+            self.evictions += 1
+
+    def stats(self):
+        '''
+        Dictionary of counters and gauges
+        '''
+        return {'name':      self.name,
+                'items':     len(self.__data),
+                'size':      self.__size,
+                'maxitems':  self.maxitems,
+                'maxsize':   self.maxsize,
+                'hits':      self.hits,
+                'misses':    self.misses,
+                'evictions': self.evictions}
@@ -5,6 +5,9 @@ from basejson import jsonTrade
 from logger import log
 
 from jflow.lib import numericts
+from jflow.core.rates.factory.ccypairfactory import tsarrays, alignts
+
+from riskengine import RiskEngine
 
 
 def calcerror(err):
@@ -34,62 +37,199 @@ def linearSuper(dvals, fvals):
 class allocation(object):
     '''
     Allocation object.
-    This object split allocation with respect currencies and subportfolios
+    This object split allocation with respect currencies and subportfolios.
+    Values are the sum of contributions, one for each child, and a change
+    in a contribution only applies its difference. The changes of the totals
+    by currency are returned as a list of (currency, difference, count)
+    tuples, where count is 1 when the currency is new, -1 when it is
+    removed and 0 otherwise, so that parents apply them with update.
+    Normalization is applied when serializing.
     '''
+    __slots__ = ('name','linear','ccy','assets','ccyassets',
+                 'contributions','scale','__counts')
+    
     def __init__(self, name, linear = True):
         self.name   = str(name)
         self.linear = linear
-        self.json   = {'name': self.name}
         self.clear()
     
     def __str__(self):
         return self.name
     
     def clear(self):
-        self.allocations = []
-        self.json['allocations'] = self.allocations 
         self.ccy       = {}     # by currencies
         self.assets    = {}     # by assets
         self.ccyassets = {}     # by currency and assets
-        self.allocations.append({'multiple': False,
-                                 'data':self.assets})
-        self.allocations.append({'multiple': False,
-                                 'data':self.ccy})
-        self.allocations.append({'multiple': True,
-                                 'data':self.ccyassets})
-
-    def add(self, other, assetcode):
-        ccys = self.ccy
-        aval = self.assets.get(assetcode,0.0)
-        
-        for c,val in other.ccy.items():
-            cval = ccys.get(c,0) + val
-            ccys[c] = cval
-            aval   += val
-            
-            ccy_assets = self.ccyassets.get(c,None)
-            if ccy_assets is None:
-                ccy_assets = {}
-                self.ccyassets[c] = ccy_assets
-            
-            ccy_assets[assetcode] = ccy_assets.get(assetcode,0) + val
-        
-        self.assets[assetcode] = aval
+        self.contributions = {}
+        self.scale     = None
+        self.__counts  = {}
+    
+    def set(self, key, assetcode, ccys):
+        '''
+        Set the contribution of child *key* with asset code *assetcode*
+        and values by currency *ccys*.
+        Return the list of changes of the totals by currency, empty if
+        the contribution is unchanged.
+        '''
+        changes = []
+        old = self.contributions.get(key,None)
+        if old is not None:
+            if old[0] == assetcode and old[1] == ccys:
+                return changes
+            if old[0] != assetcode or old[1] is None:
+                changes.extend(self.remove(key))
+                old = None
+        prev = old and old[1] or {}
+        for c,v in ccys.items():
+            if c in prev:
+                self.__apply(c, assetcode, numericOrZero(v) - numericOrZero(prev[c]), 0, changes)
+            else:
+                self.__apply(c, assetcode, numericOrZero(v), 1, changes)
+        for c,v in prev.items():
+            if c not in ccys:
+                self.__apply(c, assetcode, -numericOrZero(v), -1, changes)
+        self.contributions[key] = (assetcode,dict(ccys))
+        return changes
+    
+    def update(self, key, assetcode, ccys, changes):
+        '''
+        Apply to the contribution of child *key* the *changes* of
+        the child totals *ccys*, as returned by set, update or remove.
+        The whole contribution is set again if it is not known,
+        the asset code has changed or *changes* do not match it.
+        Return the list of changes of the totals by currency.
+        '''
+        old = self.contributions.get(key,None)
+        if old is None or old[0] != assetcode or old[1] is None:
+            return self.set(key, assetcode, ccys)
+        prev = old[1]
+        seen = {}
+        for c,v,count in changes:
+            if (count > 0) == seen.get(c,c in prev):
+                return self.set(key, assetcode, ccys)
+            seen[c] = count >= 0
+        result = []
+        for c,v,count in changes:
+            if count > 0:
+                prev[c] = v
+                self.__apply(c, assetcode, v, 1, result)
+            elif count < 0:
+                self.__apply(c, assetcode, -prev.pop(c), -1, result)
+            else:
+                prev[c] += v
+                self.__apply(c, assetcode, v, 0, result)
+        return result
+    
+    def setasset(self, key, assetcode, value):
+        '''
+        Set the contribution of child *key* by asset only.
+        Used by non linear allocations. Children may share an asset code,
+        the asset is removed with the last child referring to it.
+        '''
+        old = self.contributions.get(key,None)
+        if old is None or old[0] != assetcode:
+            if old is not None:
+                self.remove(key)
+            ckey = ('asset',assetcode)
+            self.__counts[ckey] = self.__counts.get(ckey,0) + 1
+            self.contributions[key] = (assetcode,None)
+        self.assets[assetcode] = value
+    
+    def remove(self, key):
+        '''
+        Remove the contribution of child *key*.
+        Return the list of changes of the totals by currency.
+        '''
+        changes = []
+        old = self.contributions.pop(key,None)
+        if old is None:
+            return changes
+        assetcode, ccys = old
+        if ccys is None:
+            counts = self.__counts
+            ckey   = ('asset',assetcode)
+            n      = counts.get(ckey,0) - 1
+            if n > 0:
+                counts[ckey] = n
+            else:
+                counts.pop(ckey,None)
+                self.assets.pop(assetcode,None)
+        else:
+            for c,v in ccys.items():
+                self.__apply(c, assetcode, -numericOrZero(v), -1, changes)
+        return changes
+    
+    def retain(self, keys):
+        '''
+        Remove contributions of children not in *keys*.
+        Return the list of changes of the totals by currency.
+        '''
+        changes = []
+        for key in self.contributions.keys():
+            if key not in keys:
+                changes.extend(self.remove(key))
+        return changes
+    
+    def __apply(self, c, assetcode, value, count, changes):
+        # add value to the three allocations and record the change of the
+        # currency total in changes. Entries are removed when no
+        # contribution refers to them anymore
+        counts = self.__counts
+        ca     = self.ccyassets.get(c,None)
+        if ca is None:
+            ca = {}
+            self.ccyassets[c] = ca
+        for data,ckey,k in ((self.ccy,('ccy',c),c),
+                            (self.assets,('asset',assetcode),assetcode),
+                            (ca,(c,assetcode),assetcode)):
+            n0 = counts.get(ckey,0)
+            n  = n0 + count
+            if n > 0:
+                counts[ckey] = n
+                data[k] = data.get(k,0.0) + value
+                if data is self.ccy:
+                    changes.append((c, value, n0 == 0 and 1 or 0))
+            else:
+                counts.pop(ckey,None)
+                v = data.pop(k,0.0)
+                if data is self.ccy:
+                    changes.append((c, -v, -1))
+        if not ca:
+            self.ccyassets.pop(c,None)
         
     def normalize(self, navi):
-        for k,v in self.ccy.items():
-            self.ccy[k] = numericMulOrVal(v,navi)
-        for k,v in self.assets.items():
-            self.assets[k] = numericMulOrVal(v,navi)
-        for av in self.ccyassets.values():
-            for k,v in av.items():
-                av[k] = numericMulOrVal(v,navi)
+        '''
+        Set the normalization factor used by tojson
+        '''
+        self.scale = navi
+    
+    def tojson(self):
+        scale = self.scale
+        if scale is None:
+            norm = dict
+        else:
+            norm = lambda d: dict((k,numericMulOrVal(v,scale)) for k,v in d.items())
+        ccyassets = dict((c,norm(a)) for c,a in self.ccyassets.items())
+        return {'name': self.name,
+                'allocations': [{'multiple': False, 'data': norm(self.assets)},
+                                {'multiple': False, 'data': norm(self.ccy)},
+                                {'multiple': True,  'data': ccyassets}]}
             
 
 class MarketRiskBase(jsonTrade):
     '''
-    JSON objects which holds market risk information
+    JSON objects which holds market risk information.
+    Allocations are created the first time they are used, objects
+    calculated without risk never hold them.
     '''
+    # code, name and linearity of allocations
+    allocationspecs = (('nav',      'NAV',                  True),
+                       ('notional', 'Notional',             True),
+                       ('volc1',    'Volatility C1',        True),
+                       ('avol',     'Aggregate Volatility', False))
+    _allocations    = None
+    _allocationlist = None
+    
     def __init__(self, cache, elem):
         '''
             @param cache:    global cache object
@@ -98,19 +238,28 @@ class MarketRiskBase(jsonTrade):
         super(MarketRiskBase,self).__init__(cache)
         self.elem                = elem
         self.performance_history = None
-        self.allocations         = {}
-        self.json_allocations    = []
-        self.json['allocations'] = self.json_allocations
-        self.addallocation('nav',       'NAV')
-        self.addallocation('notional',  'Notional')
-        self.addallocation('volc1',     'Volatility C1')
-        self.addallocation('avol',      'Aggregate Volatility', linear = False)
+        self.json['allocations'] = []
         self.clearsimple()
         
+    def __get_allocations(self):
+        if self._allocations is None:
+            self._allocations    = {}
+            self._allocationlist = []
+            for code,name,linear in self.allocationspecs:
+                self.addallocation(code, name, linear)
+        return self._allocations
+    allocations = property(fget = __get_allocations)
+    
+    def __get_allocationlist(self):
+        self.allocations
+        return self._allocationlist
+    allocationlist = property(fget = __get_allocationlist)
+        
     def addallocation(self, code, name, linear = True):
+        allocs = self.allocations
         a = allocation(name, linear = linear)
-        self.allocations[code] = a
-        self.json_allocations.append(a.json)
+        allocs[code] = a
+        self._allocationlist.append(a)
         
     def __unicode__(self):
         return '%s of %s' % (self.__class__.__name__,self.elem)
@@ -127,14 +276,60 @@ class MarketRiskBase(jsonTrade):
         self.absnotional  = 0       # Absolute value of notional exculding cash
         self.stdev        = 0
         self.var          = 0
+        self.hsvar        = 0       # Historical simulation VaR
+        self.es           = 0       # Historical expected shortfall
         self.volc1        = 0       # Volatility with correlation 1
         self.avol         = 0       # Aggregate volatility
         self.mktprice     = ''
         
     def clear(self):
         self.clearsimple()
-        for a in self.allocations.values():
+        for a in self._allocationlist or ():
             a.clear()
+    
+    def parentrisk(self):
+        '''
+        Market risk object of the parent node in a portfolio tree,
+        None if the node has no parent aggregating its allocations
+        '''
+        riskobject = getattr(getattr(self.elem,'parent',None),'riskobject',None)
+        if riskobject:
+            return riskobject()
+        return None
+    
+    def propagate(self, code, changes):
+        '''
+        Apply *changes* of the totals by currency of the linear allocation
+        *code* to the parent nodes, up to the root of the tree.
+        Each parent forwards only the changes of its own totals.
+        '''
+        node   = self
+        parent = self.parentrisk()
+        while changes and parent is not None:
+            alloc = parent.allocations[code]
+            if not alloc.linear:
+                return
+            changes = alloc.update(node.elem.id, node.assetcode(),
+                                   node.allocations[code].ccy, changes)
+            node   = parent
+            parent = node.parentrisk()
+    
+    def clearallocations(self):
+        '''
+        Clear allocations and remove their contributions from the parent
+        nodes. Used when calculating without risk, so that allocations
+        are not serialized with stale values.
+        '''
+        if not self._allocationlist:
+            return
+        parent = self.parentrisk()
+        for code,alloc in self._allocations.items():
+            alloc.clear()
+            if parent is not None:
+                palloc = parent.allocations[code]
+                changes = palloc.remove(self.elem.id)
+                if palloc.linear:
+                    parent.propagate(code, changes)
         
     def updateRow(self):
         obj = self.elem
@@ -143,15 +338,22 @@ class MarketRiskBase(jsonTrade):
         obj['mktprice'] = self.mktprice
     
     def rjson(self):
+        allocs = self._allocationlist
+        if allocs is None:
+            allocs = [allocation(name, linear) for code,name,linear in self.allocationspecs]
+        self.json['allocations'] = [a.tojson() for a in allocs]
         return self.json
     
     def calculate(self, withRisk = True):
         #self.elem.rjson()
+        self.touch()
         self._calculate(withRisk = withRisk)
         self.json['nav']      = self.nav
         self.json['notional'] = self.notional
         self.json['stdev']    = self.stdev
         self.json['var']      = self.var
+        self.json['hsvar']    = self.hsvar
+        self.json['es']       = self.es
         self.json['mktprice'] = self.mktprice
         
         # POST CALCULATION
@@ -188,7 +390,7 @@ class MarketRiskBase(jsonTrade):
             elem['lev1']          = lev1
             
             if withRisk:
-                for a in self.allocations.values():
+                for a in self._allocationlist or ():
                     a.normalize(navi)
         except:
             pass
@@ -256,15 +458,32 @@ class MarketRiskPosition(MarketRiskBase):
         self.avol = self.volc1
             
         if withRisk:
+            key = elem.id
             for k,alloc in self.allocations.items():
-                self.splitalloc(k,alloc)
+                changes = alloc.set(key, self.assetcode(), self.splitalloc(k))
+                if alloc.linear:
+                    self.propagate(k, changes)
+        else:
+            self.clearallocations()
     
     
-    def splitalloc(self, code, alloc):
+    def riskkey(self):
+        '''
+        Key of the position in the risk engine and scenario matrix:
+        the position id, the calculation currency and whether the
+        position aggregates other positions. The scenario matrix of a
+        date is shared by all trees, which therefore share a row only
+        when they hold the same historical notional.
+        '''
+        elem = self.elem
+        return (elem.id, elem.calc_ccy(), elem.isposition.isaggregate)
+    
+    def splitalloc(self, code):
         '''
         Split allocation.
         If underlying has a decomposition, split accordingly
-        otherwise just assign the currency
+        otherwise just assign the currency.
+        Return a dictionary of values by currency
         '''
         elem      = self.elem
         pos       = elem.isposition
@@ -273,8 +492,7 @@ class MarketRiskPosition(MarketRiskBase):
             self.decomposition = idb.lineardecomp()
         
         v = numericOrZero(getattr(self,code))
-        ccys   = alloc.ccy
-        assets = alloc.assets
+        ccys   = {}
         if self.decomposition.valid:
             td = self.decomposition.delta
             if code == 'notional':
@@ -292,8 +510,7 @@ class MarketRiskPosition(MarketRiskBase):
                     ccys[ccy] = cval
         else:
             ccys[pos.ccy] = v
-            
-        assets[self.assetcode()] = v
+        return ccys
     
     
     def calculate_history(self):
@@ -305,6 +522,12 @@ class MarketRiskPosition(MarketRiskBase):
         fin  = pos.fininst
         pts  = fin.histories.get('price',None)
         if pts and pts.ts:
+            mult = getattr(fin,'notional_multiplier',None)
+            if mult:
+                mult = mult()
+            if mult is not None:
+                self.performance_history = self.linear_history(pts.ts, mult*float(pos.size))
+                return
             tc = numericts()
             for k,v in pts.ts.items():
                 fin.mktprice = v
@@ -313,6 +536,23 @@ class MarketRiskPosition(MarketRiskBase):
                 tc = tc*elem._fxhistory
             fin.mktprice = self.mktprice
             self.performance_history = tc;
+    
+    def linear_history(self, prices, multiplier):
+        '''
+        Historical notional for instruments with notional linear in price,
+        prices * multiplier * fx evaluated on arrays
+        '''
+        fxh = self.elem._fxhistory
+        if fxh:
+            dates, values, fx = alignts(prices, fxh)
+            values = values*multiplier*fx
+        else:
+            dates, values = tsarrays(prices)
+            values = values*multiplier
+        tc = numericts()
+        for k,v in zip(dates,values.tolist()):
+            tc[k] = v
+        return tc
 
 
 
@@ -325,28 +565,34 @@ class MarketRiskPortfolio(MarketRiskBase):
     '''
     def __init__(self, cache, elem):
         super(MarketRiskPortfolio,self).__init__(cache, elem)
+        self.__engine    = None
+        self.__histories = {}
         
     def _calculate(self, withRisk = True):
-        self.clear()
+        '''
+        Sum the children values. Children in a tree apply the changes
+        of their allocations to self when they are calculated, therefore
+        only children not yet contributing are added to the allocations.
+        Positions of collapsed folders are added with the risk calculated
+        for them in the portfolio cache.
+        '''
+        self.clearsimple()
         elem = self.elem
-        #TODO
-        #maybe we can just loop over elem.element_objects.values
-        #that would save a key search on the dictionary 
+        if not withRisk:
+            self.clearallocations()
         for child in elem.children:
             el = elem.element_objects.get(child)
-            self.add(el.mktrisk, withRisk = withRisk)
-        
-        if self.performance_history:
-            ph = self.performance_history.pop(0)
-            for h in self.performance_history:
-                ph += h
-            self.performance_history = ph
-            if self.notional:
-                try:
-                    delta = ph.econometric.slogdelta()
-                    self.avol = self.notional*delta.econometric.vol()
-                except Exception, e:
-                    self.avol = calcerror(e)
+            self.add(el.mktrisk, withRisk = withRisk, key = child)
+        collapsed = getattr(elem,'collapsed',None) or {}
+        for cp in collapsed.values():
+            self.add(cp.risk(), withRisk = withRisk, key = cp.id)
+        if withRisk:
+            keys = set(elem.children)
+            keys.update(collapsed)
+            for k,alloc in self.allocations.items():
+                changes = alloc.retain(keys)
+                if alloc.linear:
+                    self.propagate(k, changes)
     
     def assetcode(self):
         return self.elem.code
@@ -354,7 +600,119 @@ class MarketRiskPortfolio(MarketRiskBase):
     def postcalc(self, withRisk):
         elem = self.elem
         if elem.parent == None:
+            self.calculateRisk()
             self.calculateRelativeValues(withRisk = withRisk)
+    
+    def calculateRisk(self):
+        '''
+        Volatility and value at risk of every node below and including self.
+        The covariance of the leaf positions returns is estimated once
+        and each node uses the sub-block of its own positions. The estimate
+        is kept while the set of positions is unchanged, so that moving
+        nodes within the tree or changing notionals only re-evaluates the
+        sub-blocks with the current notionals. A position whose
+        historical notional was calculated again invalidates the estimate.
+        Historical simulation risk is the sum of the rows of the node's
+        positions in the scenario matrix of the calculation date, where
+        only the rows of positions which changed are recalculated.
+        Positions of collapsed folders are included with the risk
+        calculated for them in the portfolio cache.
+        '''
+        leaves = []
+        nodes  = []
+        self.collectleaves(leaves, nodes)
+        if not leaves:
+            return
+        keys      = [l.riskkey() for l in leaves]
+        histories = [l.performance_history for l in leaves]
+        notionals = [l.notional for l in leaves]
+        engine    = self.__engine
+        cached    = self.__histories
+        if engine is None or len(engine) != len(keys) or \
+           [k for k,h in zip(keys,histories) if cached.get(k,None) is not h]:
+            try:
+                engine = RiskEngine(histories, notionals, keys = keys)
+            except Exception, e:
+                self.__engine    = None
+                self.__histories = {}
+                self.err(e, msg = 'Failed covariance estimation.', sendmail = False)
+                return
+            self.__engine    = engine
+            self.__histories = dict(zip(keys,histories))
+        else:
+            engine.setweights(keys, notionals)
+        scenarios = self.cache.scenarios(self.elem.dte)
+        for k,h,n in zip(keys,histories,notionals):
+            scenarios.add(k, h, n)
+        eindex = engine.index
+        for node,idx in nodes:
+            if idx:
+                nkeys = [keys[i] for i in idx]
+                node.setrisk(engine.node([eindex[k] for k in nkeys]),
+                             [leaves[i] for i in idx])
+                node.sethsrisk(scenarios.risk(nkeys))
+        for node,idx in nodes:
+            node.setnonlinear()
+        
+    def collectleaves(self, leaves, nodes):
+        '''
+        Append to *leaves* the positions below self, including the
+        positions of collapsed folders, with a valid historical notional
+        and to *nodes* a tuple of portfolio node and indices of its
+        positions in *leaves*. Return the list of indices.
+        '''
+        elem  = self.elem
+        idx   = []
+        risks = [elem.element_objects.get(child).mktrisk for child in elem.children]
+        collapsed = getattr(elem,'collapsed',None)
+        if collapsed:
+            risks.extend(cp.mktrisk for cp in collapsed.values())
+        for mr in risks:
+            if isinstance(mr,MarketRiskPortfolio):
+                idx.extend(mr.collectleaves(leaves, nodes))
+            elif mr.performance_history and isinstance(mr.notional,(int,long,float)):
+                idx.append(len(leaves))
+                leaves.append(mr)
+        nodes.append((self,idx))
+        return idx
+    
+    def setrisk(self, risk, positions):
+        '''
+        Set the risk of this node from a RiskEngine.node result.
+        The aggregate volatility is annualised, as the volatility of
+        positions. *positions* are the MarketRiskPosition of the node. Marginal and
+        component VaR of positions are relative to the root node.
+        '''
+        self.stdev = risk['stdev']
+        self.var   = risk['var']
+        self.avol  = risk['vol']
+        self.json['stdev'] = self.stdev
+        self.json['var']   = self.var
+        if self.elem.parent == None:
+            for mr,m,c in zip(positions,risk['marginal'],risk['component']):
+                mr.json['marginalvar']  = float(m)
+                mr.json['componentvar'] = float(c)
+    
+    def setnonlinear(self):
+        '''
+        Update non linear allocations with the children values
+        '''
+        elem = self.elem
+        for child in elem.children:
+            other = elem.element_objects.get(child).mktrisk
+            for k,alloc in self.allocations.items():
+                if not alloc.linear:
+                    alloc.setasset(child, other.assetcode(), getattr(other,k))
+    
+    def sethsrisk(self, risk):
+        '''
+        Set historical simulation VaR and expected shortfall from a
+        ScenarioMatrix.risk result
+        '''
+        self.hsvar = risk['hsvar']
+        self.es    = risk['es']
+        self.json['hsvar'] = self.hsvar
+        self.json['es']    = self.es
             
     def calculateRelativeValues(self, mrbase = None, withRisk = True):
         '''
@@ -369,27 +727,28 @@ class MarketRiskPortfolio(MarketRiskBase):
             el.mktrisk.calculateRelativeValues(mrbase, withRisk = withRisk)
         
     
-    def add(self, other, withRisk = False):
+    def add(self, other, withRisk = False, key = None):
         try:
             self.nav         += numericOrZero(other.nav)
             self.notional    += numericOrZero(other.notional)
             self.absnotional += numericOrZero(other.absnotional)
             self.volc1       += numericOrZero(other.volc1)
-            
-            if other.performance_history:
-                if not self.performance_history:
-                    self.performance_history = [other.performance_history]
-                else:
-                    self.performance_history.append(other.performance_history)
                     
-            # Add element to allocation risk
+            # Set element contribution to allocation risk.
+            # Children propagating their changes are set only when
+            # they are not contributing yet or their asset code changed
             if withRisk:
+                if key is None:
+                    key = other.elem.id
+                assetcode = other.assetcode()
+                pushes    = other.parentrisk() is self
                 for k,alloc in self.allocations.items():
-                    other_alloc = other.allocations.get(k)
                     if alloc.linear:
-                        alloc.add(other_alloc, other.assetcode())
+                        old = alloc.contributions.get(key,None)
+                        if not pushes or old is None or old[0] != assetcode:
+                            self.propagate(k, alloc.set(key, assetcode, other.allocations.get(k).ccy))
                     else:
-                        alloc.assets[other.assetcode()] = getattr(other,k)
+                        alloc.setasset(key, assetcode, getattr(other,k))
                         
         except Exception, e:
             self.update()
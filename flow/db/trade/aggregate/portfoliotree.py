@@ -4,7 +4,11 @@ JSON classes used in the protfolio tree view.
 This classes are used only when we need the tree
 structure provided by subportfolios
 '''
+import time
 
+from django.contrib.contenttypes.models import ContentType
+
+from jflow.conf import settings
 from jflow.db.trade.models import Position, PortfolioView, Fund, Portfolio
 from jflow.db.trade.utils import get_object_id, get_object_from_id
 from jflow.rates import get_history, get_rate
@@ -13,13 +17,95 @@ from jflow.core.dates import get_livedate
 from jflow.core.rates import objects as rateObjects
 
 from logger import log
-from basejson import extract, listpop, positionBase
+from basecache import cacheBase
+from basejson import extract, listpop, positionBase, currentrevision, elementsdelta
 from marketrisk import MarketRiskPosition, MarketRiskPortfolio
 from position import jsonPosition, jsonFund
 from position import MktPositionInterface, POSITION_STATUS
 
         
     
+class fxConverter(cacheBase, MktPositionInterface):
+    '''
+    Exchange rate from a position currency to the fund currency.
+    Collapsed nodes of a lazy tree share one converter for each currency
+    and are notified when the rate is available.
+    '''
+    def __init__(self, cache, ccy, calcccy, dte):
+        super(fxConverter,self).__init__()
+        self.ccy     = ccy
+        self.calcccy = calcccy
+        self.dte     = dte
+        self.register_to_fxcross(cache)
+        
+    def __unicode__(self):
+        return u'%s%s' % (self.ccy,self.calcccy)
+        
+    def calc_ccy(self):
+        return self.calcccy
+    
+    def refresh_me(self):
+        pass
+    
+    
+    
+class collapsedPosition(object):
+    '''
+    Position of a collapsed folder.
+    It wraps the position *jp* of the portfolio cache and provides to
+    MarketRiskPosition what a position node of the tree would, with
+    the exchange rate of converter *fx*. It is kept by *jp* so that the
+    history and risk are calculated once for all trees of the fund.
+    '''
+    parent = None
+    
+    def __init__(self, jp, fx):
+        self.isposition = jp
+        self.fx         = fx
+        self.id         = jp.id
+        self.key        = None
+        self.mktrisk    = MarketRiskPosition(jp.cache, self)
+        
+    def __unicode__(self):
+        return u'%s' % self.isposition
+    
+    def __getitem__(self, code):
+        return self.isposition[code]
+    
+    def __setitem__(self, code, value):
+        pass
+    
+    def calc_ccy(self):
+        return self.fx.calcccy
+    
+    def __get_fxcross(self):
+        return self.fx._fxcross or 1.0
+    _fxcross = property(fget = __get_fxcross)
+    
+    def __get_fxhistory(self):
+        return self.fx._fxhistory
+    _fxhistory = property(fget = __get_fxhistory)
+    
+    def update(self):
+        self.isposition.update()
+        
+    def risk(self):
+        '''
+        The market risk object, calculated again only when the
+        position or the exchange rate changed
+        '''
+        jp  = self.isposition
+        jp.refresh()
+        key = (jp.revision,self._fxcross,self._fxhistory is None)
+        if key != self.key:
+            # the historical notional changes once the FX history is available
+            if self.key and self.key[2] != key[2]:
+                self.mktrisk.performance_history = None
+            self.key = key
+            self.mktrisk.calculate(withRisk = True)
+        return self.mktrisk
+    
+
 
 class jsonPortfolio(positionBase, MktPositionInterface):
     '''
@@ -27,10 +113,14 @@ class jsonPortfolio(positionBase, MktPositionInterface):
     This class is used in the json Portfolio Tree.
     It maintain a node in the portfolio view. This node can be a
     position, a subportfolio or a fund.
+    In a lazy tree, folders are collapsed until expanded. A collapsed folder
+    has no children and aggregates the positions of its subtree directly.
     '''
     def __init__(self, tree, obj, parent = None):
         cache            = tree.cache
         self.isposition  = False
+        self.expanded    = True
+        self.collapsed   = None
         if isinstance(obj,jsonFund):
             obj = obj.dbobj
             
@@ -51,6 +141,7 @@ class jsonPortfolio(positionBase, MktPositionInterface):
             self.movable      = True
             self.__mkt_risk   = MarketRiskPortfolio(cache,self)
             self.fund         = parent.fund
+            self.expanded     = not tree.lazy
                         
         self.tree            = tree
         self.parent          = parent
@@ -66,6 +157,12 @@ class jsonPortfolio(positionBase, MktPositionInterface):
         return self.__mkt_risk
     mktrisk = property(fget = __get_mktrisk)
     
+    def riskobject(self):
+        '''
+        The market risk object, without refreshing it
+        '''
+        return self.__mkt_risk
+    
     def build(self, **kwargs):
         parent = self.parent
         self._build()
@@ -92,6 +189,7 @@ class jsonPortfolio(positionBase, MktPositionInterface):
             json['canaddto']  = self.canaddto
             json['editable']  = self.editable
             json['movable']   = self.movable
+            json['expanded']  = self.expanded
             json['tree']      = self.children
         return reg
         
@@ -124,6 +222,7 @@ class jsonPortfolio(positionBase, MktPositionInterface):
         if parent:
             pid = parent.id
             self.json['parent']  = pid
+            self.touch()
             parent.children.append(self.id)
             if self.isfund:
                 self.fund = self.dbobj
@@ -168,10 +267,12 @@ class jsonPortfolio(positionBase, MktPositionInterface):
             
         # Portfolio
         else:
-            folders          = obj.subfolders()
-            self.positionset = parent.positionset 
-            ppositions       = obj.position_for_date(dte.dateonly, status = POSITION_STATUS)
-                
+            self.positionset = parent.positionset
+            if self.expanded:
+                folders      = obj.subfolders()
+                ppositions   = obj.position_for_date(dte.dateonly, status = POSITION_STATUS)
+            else:
+                self.collapse()
         
         elements  = self.elements
         elemobjs  = self.element_objects
@@ -180,6 +281,9 @@ class jsonPortfolio(positionBase, MktPositionInterface):
         elements[self.id] = self.json
         elemobjs[self.id] = self
         
+        self.addchildren(folders, ppositions)
+        
+    def addchildren(self, folders, ppositions):
         # Loop over folders and create new jsonPortfolios
         for f in folders:
             self.append(f)
@@ -197,8 +301,51 @@ class jsonPortfolio(positionBase, MktPositionInterface):
                     jf = self.append(jp)
                 else:
                     log("Critical Warning, position %s not in portfolio" % p)
+    
+    def collapse(self):
+        '''
+        Take the positions of the whole subtree out of the position set
+        without creating child nodes. Folder memberships are obtained from
+        the tree, so that no query runs for the folders below self.
+        Self observes the positions and their exchange rates so that
+        aggregates are kept up to date.
+        '''
+        collapsed   = {}
+        positionset = self.positionset
+        tree        = self.tree
+        for id in tree.folderpositions(self.dbobj):
+            jp = positionset.pop(id,None)
+            if jp:
+                cp = tree.collapsedposition(jp)
+                collapsed[cp.id] = cp
+        self.collapsed = collapsed
+        for cp in collapsed.values():
+            cp.isposition.attach(self)
+            cp.fx.attach(self)
             
-            
+    def expand(self, deep = False):
+        '''
+        Create the children of a collapsed folder.
+        If *deep* is True expand the whole subtree.
+        '''
+        if not self.expanded:
+            collapsed = self.collapsed or {}
+            for cp in collapsed.values():
+                cp.isposition.detach(self)
+                cp.fx.detach(self)
+            self.expanded    = True
+            self.collapsed   = None
+            self.positionset = dict((id,cp.isposition) for id,cp in collapsed.items())
+            obj = self.dbobj
+            self.addchildren(obj.subfolders(),
+                             obj.position_for_date(self.dte.dateonly, status = POSITION_STATUS))
+            self.json['expanded'] = True
+            self.update()
+        if deep:
+            for child in self.children:
+                self.element_objects.get(child).expand(deep)
+        return self
+    
     def append(self, f):
         '''
         1 - Create a new jsonPortfolio element from f
@@ -232,10 +379,18 @@ class jsonPortfolioTree(positionBase):
     '''
     A Portfolio Tree JSON object
     '''
-    def __init__(self, cache, view, dte):
+    def __init__(self, cache, view, dte, lazy = None):
         super(jsonPortfolioTree,self).__init__(cache, view, dte)
+        if lazy is None:
+            lazy = getattr(settings,'PORTFOLIO_TREE_LAZY',False)
+        self.lazy             = lazy
         self.elements         = {}
         self.element_objects  = {}
+        self.fxconverters     = {}
+        self.removed          = []
+        self.removedfloor     = 0
+        self.served           = {}
+        self.members          = None
         self.json['elements'] = self.elements
         
     def _build(self):
@@ -266,14 +421,133 @@ class jsonPortfolioTree(positionBase):
     def get(self, id):
         return self.element_objects.get(id,None)
     
+    def rjsondelta(self, revision):
+        '''
+        Nodes changed since *revision* and ids of nodes removed since.
+        The whole tree is returned if removed nodes older than *revision*
+        are no longer recorded.
+        '''
+        rev  = currentrevision()
+        json = self.rjson()
+        if revision is None or self.created > revision or revision < self.removedfloor:
+            json = dict(json)
+            json['revision'] = rev
+        else:
+            deltas = elementsdelta(self.element_objects.values(), revision)
+            json = {'revision': rev,
+                    'root':     json.get('root',None),
+                    'elements': dict((d['id'],d) for d in deltas),
+                    'removed':  [id for r,id in self.removed if r > revision]}
+        self.serve(rev)
+        return json
+    
+    def serve(self, rev):
+        '''
+        Record revision *rev* handed to a client and drop the removed
+        nodes which no client holding a served revision can ask for.
+        Served revisions expire after PORTFOLIO_DELTA_EXPIRY seconds.
+        '''
+        t      = time.time()
+        served = self.served
+        served[rev] = t
+        expiry = t - getattr(settings,'PORTFOLIO_DELTA_EXPIRY',300)
+        for r,st in served.items():
+            if st < expiry:
+                served.pop(r,None)
+        floor = min(served.keys() or [rev])
+        if self.removed and self.removed[0][0] <= floor:
+            self.removed = [(r,id) for r,id in self.removed if r > floor]
+        self.removedfloor = floor
+    
+    def fxconverter(self, ccy, calcccy):
+        key = '%s%s' % (ccy,calcccy)
+        fx  = self.fxconverters.get(key,None)
+        if fx is None:
+            fx = fxConverter(self.cache, ccy, calcccy, self.dte)
+            self.fxconverters[key] = fx
+        return fx
+    
+    def collapsedposition(self, jp):
+        '''
+        Position *jp* of the portfolio cache as a position
+        of a collapsed folder
+        '''
+        ccy = self.fund.curncy
+        cp  = jp.collapsedrisk.get(ccy,None)
+        if cp is None:
+            cp = collapsedPosition(jp, self.fxconverter(jp.ccy, ccy))
+            jp.collapsedrisk[ccy] = cp
+        return cp
+    
+    def folderpositions(self, folder):
+        '''
+        Ids of the positions in *folder* and its subfolders.
+        Folders and memberships of the whole view are loaded with two
+        queries the first time a folder is collapsed.
+        '''
+        members = self.members
+        if members is None:
+            children  = {}
+            positions = {}
+            for id,parent in Portfolio.objects.filter(view = self.view).values_list('id','parent'):
+                if parent is not None:
+                    children.setdefault(parent,[]).append(id)
+            for fid,pid in Position.objects.filter(portfolio__view = self.view).values_list('portfolio','id'):
+                positions.setdefault(fid,[]).append(pid)
+            ct      = ContentType.objects.get_for_model(Position)
+            members = (children,positions,ct.id)
+            self.members = members
+        children, positions, ctid = members
+        ids     = []
+        folders = [folder.id]
+        while folders:
+            f = folders.pop()
+            ids.extend('%s_%s' % (ctid,pid) for pid in positions.get(f,()))
+            folders.extend(children.get(f,()))
+        return ids
+    
+    def materialise(self, id):
+        '''
+        Return node *id*, expanding the collapsed folders above it
+        '''
+        el = self.element_objects.get(id,None)
+        if el or not self.lazy:
+            return el
+        obj = get_object_from_id(id)
+        if isinstance(obj,Position):
+            folders = obj.portfolio_set.filter(view = self.view)
+            obj = folders and folders[0] or None
+        chain = []
+        while isinstance(obj,Portfolio):
+            chain.append(obj)
+            obj = obj.parent
+        chain.reverse()
+        for f in chain:
+            node = self.element_objects.get(get_object_id(f),None)
+            if node:
+                node.expand()
+        return self.element_objects.get(id,None)
+    
+    def expand(self, id):
+        '''
+        Expand node *id* of a lazy tree
+        '''
+        el = self.materialise(id)
+        if el:
+            return el.expand()
+        return None
+    
     def pop(self, id):
         '''
         Remove a node from portfolio tree
         '''
         el = self.element_objects.get(id,None)
         if el and el.editable:
+            el.expand()
             self.element_objects.pop(id,None)
             self.elements.pop(id,None)
+            self.touch()
+            self.removed.append((self.revision,id))
             p = el.parent
             if p:
                 listpop(p.children, id)
@@ -297,13 +571,19 @@ class jsonPortfolioTree(positionBase):
                 
             el.dbobj.delete()
             
+            self.members = None
             self.view.save()
         else:
             el = None
         return el
     
     def marketRisk(self, id):
-        node = self.element_objects.get(id,None)
+        '''
+        Market risk of node *id*. Only the folders above the node are
+        expanded, folders below it which are still collapsed contribute
+        the risk of their positions from the portfolio cache.
+        '''
+        node = self.materialise(id)
         if node:
             log.msg("Calculating market risk for %s" % node)
             self.refresh()
@@ -319,6 +599,7 @@ class jsonPortfolioTree(positionBase):
             p      = self.view.addFolder(pobj, code)
             if p:
                 pjson = parent.append(p)
+                self.members = None
                 self.view.save()
                 return pjson
             else:
@@ -347,11 +628,19 @@ class jsonPortfolioTree(positionBase):
                 
             
     def move(self, id, target):
+        '''
+        Move node *id* under node *target*.
+        Only the old and new parents are re-aggregated, the moved
+        positions are not repriced.
+        '''
         el = self.element_objects.get(id,None)
         tg = self.element_objects.get(target,None)
         if el and tg and el.movable and tg.canaddto and el != tg and el.fund == tg.fund:
             pp    = el.parent
+            tg.expand()
             el.setparent(tg)
+            pp.update()
+            tg.update()
             elobj = el.dbobj
             
             # And now the database stuff
@@ -368,6 +657,7 @@ class jsonPortfolioTree(positionBase):
                 else:
                     elobj.parent = tg.dbobj
                 elobj.save()
+            self.members = None
             self.view.save()
             return el
         else:
@@ -1,8 +1,10 @@
 from jflow.db.trade.models import Position
 from jflow.core.finins import finins
 
-from logger import log
-from basejson import extract, listpop, positionBase
+from threading import Lock
+
+from scheduler import buildgroup
+from basejson import extract, listpop, positionBase, currentrevision, elementsdelta
 from marketrisk import MarketRiskPosition, MarketRiskPortfolio
 
 
@@ -11,20 +13,19 @@ POSITION_STATUS = 'all'
 
 class MktPositionInterface(object):
     '''
-    Interface for live and historical market positions
+    Interface for live and historical market positions.
+    Defaults are class attributes, instances only store the values
+    which differ.
     '''
-    def __new__(cls, *args, **kwargs):
-        obj = super(MktPositionInterface, cls).__new__(cls)
-        obj.isfund       = False
-        obj.folder       = True
-        obj.canaddto     = False
-        obj.editable     = False
-        obj.movable      = False
-        obj.positionset  = None
-        obj._fxcode      = None
-        obj._fxcross     = 1.0
-        obj._fxhistory   = None
-        return obj
+    isfund       = False
+    folder       = True
+    canaddto     = False
+    editable     = False
+    movable      = False
+    positionset  = None
+    _fxcode      = None
+    _fxcross     = 1.0
+    _fxhistory   = None
         
     def calc_ccy(self):
         return self.ccy
@@ -71,8 +72,11 @@ class jsonPosition(positionBase):
     a financial instrument object.
     
     '''
+    rowmissing  = '#N/A'
+    isaggregate = False
+    
     def __init__(self, cache, fininst, position = None,
-                 withinfo = False, register = True):
+                 withinfo = False, register = True, history = None):
         '''
         Initialize a position object.
             @param cache:    the global cache object
@@ -80,6 +84,7 @@ class jsonPosition(positionBase):
             @param position: Optional a position object
             @param withinfo: Optional (default False)
             @param register: Optional (default False) if fill static information during construction
+            @param history:  Optional position history at the calculation date
         '''
         obj = position or fininst.dbinstrument
         dte = fininst.calc_date
@@ -89,8 +94,10 @@ class jsonPosition(positionBase):
         self.size          = 0.0
         self.traded        = 0.0
         self.positions     = []
+        self.history       = history
+        self.collapsedrisk = {}     # risk in collapsed folders by currency
         if position:
-            self.append(position, withinfo)
+            self.append(position, withinfo, history)
         if register:
             self.register()
         # register self with fininst for updates
@@ -120,17 +127,16 @@ class jsonPosition(positionBase):
         return self.dbinstrument.code
     ic = property(fget = __get_ic)
         
-    def append(self, pos, withinfo = False):
-        dt = self.dte.dateonly
-        pv = pos.first_at_or_before(dt)
-        try:
-            sz = int(pv.size)
+    def append(self, pos, withinfo = False, history = None):
+        '''
+        Add *pos* with its *history* at the calculation date, as prefetched
+        with the fund tree. A position without history has zero size.
+        '''
+        sz = 0
+        if history is not None:
+            sz = int(history.size)
             self.size   += sz
-            self.traded += float(pv.book_cost_base)
-        except:
-            #TODO Log this error
-            sz = '#NA'
-            log.err("Position %s has not history at %s" % (pos,dt))
+            self.traded += float(history.book_cost_base)
         if withinfo:
             fund = pos.fund
             self.positions.append({'fund': fund.code,
@@ -155,8 +161,8 @@ class jsonPosition(positionBase):
         mr.mktprice = fi.mktprice
         return mr
     
-    def register2(self, code, jsv):
-        return extract(self.fininst,code,jsv)
+    def rowsource(self):
+        return self.fininst
     
     def __get_mktrisk(self):
         self.refresh()
@@ -173,6 +179,8 @@ class jsonFund(positionBase):
     def __init__(self, cache, obj, dte):
         super(jsonFund,self).__init__(cache, obj, dte)
         self.element_objects = {}
+        self.__lock          = Lock()
+        self.__tree          = False
         
     def positionsdict(self):
         r = {}
@@ -184,37 +192,41 @@ class jsonFund(positionBase):
         self.parent = obj.parent 
         dte         = self.dte
         funds       = obj.fund_set.all()
-        elems       = self.element_objects
         self.funds  = []
+        group       = buildgroup(self.__built)
         
-        # Fund contains subfunds. Build the subfunds
+        # Fund contains subfunds. Load positions for the whole tree
+        # in one query and build the subfunds on the build pool
         if funds:
+            self.__tree = self.cache.loadfundtree(obj, dte.dateonly, status = POSITION_STATUS)
             for f in funds:
-                self.funds.append(self.cache.portfolio(f, dte))
-            
-            funds = self.funds[:]
-            for f in funds:
-                f.addcallback(self.addfund)
+                group.spawn(self.addelement, self.cache.portfolio, f, dte, False, False)
                 
-        # Fund has positions
+        # Fund has positions. Instruments are created on the build pool
         else:
-            pos = Position.objects.positions_for_fund(fund = obj, dt = dte.dateonly, status = POSITION_STATUS)
-            for p in pos:
-                ic  = p.instrumentCode
-                fi  = self.cache.instrument(ic, dte)
-                if not fi:
-                    continue
-                jp  = jsonPosition(self.cache, fi, position = p)
-                elems[jp.id] = jp
-            self.log('Finished building')
-            self._closebuild()
+            pos = self.cache.fundpositions(obj, dte.dateonly, status = POSITION_STATUS)
+            for p,h in pos:
+                group.spawn(self.addelement, self.__position, p, h)
         
-    def addfund(self, f):
-        self.funds.remove(f)
-        self.element_objects[f.id] = f
-        if not self.funds:
-            self.log('Finished building')
-            self._closebuild()
+        group.start()
+        
+    def __position(self, p, h):
+        fi = self.cache.instrument(p.instrumentCode, self.dte)
+        if fi:
+            return jsonPosition(self.cache, fi, position = p, history = h)
+        
+    def addelement(self, f):
+        self.__lock.acquire()
+        try:
+            self.element_objects[f.id] = f
+        finally:
+            self.__lock.release()
+    
+    def __built(self):
+        self.log('Finished building')
+        if self.__tree:
+            self.cache.releasefundtree(self.dbobj, self.dte.dateonly)
+        self._closebuild()
     
     def _get_ccy(self):
         return self.dbobj.curncy
@@ -226,9 +238,12 @@ class jsonAggregatePosition(jsonPosition, MktPositionInterface):
     '''
     Aggregate position
     '''
-    def __init__(self, cache, fininst, position, ccy, withinfo = True):
+    isaggregate = True
+    
+    def __init__(self, cache, fininst, position, ccy, withinfo = True, history = None):
         jsonPosition.__init__(self, cache, fininst, position,
-                                    withinfo = withinfo, register = False)
+                                    withinfo = withinfo, register = False,
+                                    history = history)
         self.convertccy    = ccy
         
     def __get_isposition(self):
@@ -270,6 +285,7 @@ class jsonTeam(positionBase):
         self.jelements        = []
         self.element_objects  = {}
         self.json['elements'] = self.jelements
+        self.__lock           = Lock()
         
     def _build(self):
         self.__mkt_risk = MarketRiskPortfolio(self.cache, self)
@@ -281,17 +297,21 @@ class jsonTeam(positionBase):
         # debugging
         #funds = funds[:1]
         
-        # Create the funds
-        for f in funds:
-            self.funds.append(self.cache.portfolio(f,dt))
-        
-        # Add the callbacks
-        funds = self.funds[:]
+        # Build the funds on the build pool and aggregate
+        # them as they finish
+        group = buildgroup(self.__built)
         for f in funds:
-            f.addcallback(self.addfund)
+            group.spawn(self.addfund, self.cache.portfolio, f, dt, False, False)
+        group.start()
     
     def addfund(self, f):
-        self.funds.remove(f)
+        self.__lock.acquire()
+        try:
+            self.__addfund(f)
+        finally:
+            self.__lock.release()
+    
+    def __addfund(self, f):
         elems   = self.element_objects
         jelems  = self.jelements
         
@@ -300,20 +320,20 @@ class jsonTeam(positionBase):
                 code = jpos.code
                 aggp = elems.get(code,None)
                 if not aggp:
-                    aggp = jsonAggregatePosition(self.cache, jpos.fininst, jpos.dbobj, self.ccy)
+                    aggp = jsonAggregatePosition(self.cache, jpos.fininst, jpos.dbobj, self.ccy,
+                                                 history = jpos.history)
                     # Register self as observer of aggp
                     aggp.attach(self)
                     elems[code] = aggp
                     self.children.append(code)
                     jelems.append(aggp.json)
                 else:
-                    aggp.append(jpos.dbobj, withinfo = True)
-        
-        # when finished, build the object
-        if not self.funds:
-            self.log('Finished adding funds')
-            self.register()
-            self._closebuild()
+                    aggp.append(jpos.dbobj, withinfo = True, history = jpos.history)
+    
+    def __built(self):
+        self.log('Finished adding funds')
+        self.register()
+        self._closebuild()
     
     def register(self):
         for jp in self.element_objects.values():
@@ -324,6 +344,19 @@ class jsonTeam(positionBase):
         return 'USD'
     ccy = property(fget = _get_ccy)
     
+    def rjsondelta(self, revision):
+        '''
+        Aggregate positions changed since *revision*
+        '''
+        rev  = currentrevision()
+        json = self.rjson()
+        if revision is None or self.created > revision:
+            json = dict(json)
+            json['revision'] = rev
+            return json
+        return {'revision': rev,
+                'elements': elementsdelta(self.element_objects.values(), revision)}
+    
     def __get_mktrisk(self):
         mr  = self.__mkt_risk
         return mr
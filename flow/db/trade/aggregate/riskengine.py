@@ -0,0 +1,290 @@
+'''
+Covariance based market risk.
+Returns of all leaf positions of a portfolio tree are aligned in a single
+matrix and their covariance is estimated once. Volatility and value at risk
+of any node are then obtained from the sub-block of the node's positions.
+Historical simulation uses a matrix of position P&L over the days of the
+history window, built once per calculation date.
+'''
+import math
+from datetime import date
+from threading import Lock
+
+import numpy as np
+
+from jflow.conf import settings
+from jflow.core.rates.factory.ccypairfactory import tsarrays
+
+__all__ = ['RiskEngine', 'ScenarioMatrix', 'returns_matrix', 'covariance',
+           'normal_quantile', 'riskconf', 'weekdays']
+
+
+def riskconf():
+    '''
+    Risk engine parameters from the PORTFOLIO_RISK setting.
+    Return a dictionary with keys method, lambda, shrinkage, confidence,
+    returns and periods.
+    '''
+    conf = getattr(settings,'PORTFOLIO_RISK',None) or {}
+    return {'method':     conf.get('method','sample'),
+            'lambda':     conf.get('lambda',0.94),
+            'shrinkage':  conf.get('shrinkage',0.0),
+            'confidence': conf.get('confidence',0.99),
+            'returns':    conf.get('returns','log'),
+            'periods':    conf.get('periods',252)}
+
+
+def normal_quantile(p, tolerance = 1.0e-10):
+    '''
+    Quantile of the standard normal distribution at probability *p*
+    '''
+    if p <= 0. or p >= 1.:
+        raise ValueError('Probability must be between 0 and 1, got %s' % p)
+    a, b = -10., 10.
+    sq2  = math.sqrt(2.)
+    while b - a > tolerance:
+        x = 0.5*(a + b)
+        if 0.5*(1. + math.erf(x/sq2)) < p:
+            a = x
+        else:
+            b = x
+    return 0.5*(a + b)
+
+
+def weekdays(start, end):
+    '''
+    Ordinals of week days between *start* and *end* included
+    '''
+    o = np.arange(start.toordinal(), end.toordinal() + 1)
+    return o[(o % 7) % 6 != 0]
+
+
+def returns_matrix(histories, log = False):
+    '''
+    Aligned daily returns of a list of historical notional timeseries.
+    The union of dates from the first date where all series are
+    available is used and missing values are forward-filled.
+    If *log* is True log returns are calculated, otherwise simple returns.
+    Return a tuple of dates and a len(dates) x len(histories) float array.
+    '''
+    N      = len(histories)
+    data   = [tsarrays(h) for h in histories]
+    if not N or not min(len(d) for d,v in data):
+        return [], np.zeros((0,N))
+    ordinals = [np.array([d.toordinal() for d in dates], dtype = int) for dates,v in data]
+    start    = max(o[0] for o in ordinals)
+    union    = np.unique(np.concatenate(ordinals))
+    union    = union[union >= start]
+    X = np.empty((len(union),N))
+    for j,o in enumerate(ordinals):
+        X[:,j] = data[j][1][np.searchsorted(o, union, side = 'right') - 1]
+    prev  = X[:-1]
+    ratio = np.where(prev != 0, X[1:]/np.where(prev != 0, prev, 1.0), 1.0)
+    if log:
+        R = np.log(np.where(ratio > 0, ratio, 1.0))
+    else:
+        R = ratio - 1.0
+    R[~np.isfinite(R)] = 0.0
+    dates = [date.fromordinal(int(o)) for o in union[1:]]
+    return dates, R
+
+
+def covariance(R, method = 'sample', lam = 0.94, shrinkage = 0.0):
+    '''
+    Covariance matrix of the columns of the returns matrix *R*
+
+        @param method:    'sample' or 'ewma' for exponentially weighted
+                          zero-mean covariance
+        @param lam:       decay factor for the ewma method
+        @param shrinkage: weight, between 0 and 1, of the diagonal target
+                          the estimate is shrunk towards
+    '''
+    T,N = R.shape
+    if T < 2:
+        return np.zeros((N,N))
+    if method == 'ewma':
+        w = lam**np.arange(T-1,-1,-1,dtype = float)
+        w = w/w.sum()
+        C = np.dot(R.T*w, R)
+    elif method == 'sample':
+        C = np.atleast_2d(np.cov(R, rowvar = 0))
+    else:
+        raise ValueError('Unknown covariance method %s' % method)
+    if shrinkage:
+        C = (1. - shrinkage)*C + shrinkage*np.diag(np.diag(C))
+    return C
+
+
+class RiskEngine(object):
+    '''
+    Parametric risk engine for a fixed set of positions.
+
+        @param histories: list of historical notional timeseries,
+                          one for each position
+        @param notionals: list of current notionals in the same order
+        @param keys:      optional list of position keys in the same order
+        @param conf:      optional dictionary overriding riskconf()
+    '''
+    def __init__(self, histories, notionals, keys = None, conf = None):
+        c = riskconf()
+        if conf:
+            c.update(conf)
+        self.conf       = c
+        self.index      = dict((k,i) for i,k in enumerate(keys or ()))
+        self.weights    = np.array(notionals, dtype = float)
+        self.dates, self.returns = returns_matrix(histories,
+                                                  log = c['returns'] == 'log')
+        self.cov        = covariance(self.returns,
+                                     method = c['method'],
+                                     lam = c['lambda'],
+                                     shrinkage = c['shrinkage'])
+        self.z          = normal_quantile(c['confidence'])
+
+    def __len__(self):
+        return len(self.weights)
+
+    def setweights(self, keys, notionals):
+        '''
+        Update the current notionals of positions *keys*.
+        The covariance estimate is unchanged.
+        '''
+        index = self.index
+        self.weights[[index[k] for k in keys]] = notionals
+
+    def node(self, idx):
+        '''
+        Risk of the sub-portfolio made of positions *idx*.
+        Return a dictionary with the daily standard deviation, the annualised
+        volatility, the parametric VaR, and the marginal and component VaR of
+        each position in *idx*. Component VaRs add up to the node VaR.
+        '''
+        idx  = np.asarray(idx, dtype = int)
+        w    = self.weights[idx]
+        Cw   = np.dot(self.cov[np.ix_(idx,idx)], w)
+        sig  = math.sqrt(max(float(np.dot(w,Cw)),0.))
+        if sig > 0:
+            marginal = self.z*Cw/sig
+        else:
+            marginal = np.zeros(len(idx))
+        return {'stdev':     sig,
+                'vol':       sig*math.sqrt(self.conf['periods']),
+                'var':       self.z*sig,
+                'marginal':  marginal,
+                'component': w*marginal}
+
+
+class ScenarioMatrix(object):
+    '''
+    Historical simulation P&L of positions over the week days between
+    *start* and *end*. Each position contributes one row, the P&L of its
+    current notional under the relative changes of its historical notional.
+    Rows are keyed by position and updated in place when the notional or
+    the history of the position change, so that the risk of any set of
+    positions is a sum of rows.
+
+        @param confidence: confidence level of VaR and expected shortfall.
+                           Default from riskconf()
+    '''
+    def __init__(self, start, end, confidence = None):
+        self.ordinals   = weekdays(start, end)
+        self.confidence = confidence or riskconf()['confidence']
+        self.__index    = {}
+        self.__state    = []
+        self.__matrix   = np.zeros((0,len(self.ordinals)))
+        self.__lock     = Lock()
+
+    def __len__(self):
+        return len(self.__state)
+
+    def __contains__(self, key):
+        return key in self.__index
+
+    def memsize(self):
+        return 8*self.__matrix.size + 16*len(self.__state)
+
+    def add(self, key, history, notional):
+        '''
+        Add or update the row of position *key*. Only the row of *key*
+        is recalculated, and only if *history* or *notional* changed.
+        A change of notional alone rescales the row.
+        '''
+        i = self.__index.get(key,None)
+        if i is not None:
+            h,n = self.__state[i]
+            if h is history and n == notional:
+                return
+            if h is history and n:
+                row = self.__matrix[i]*(float(notional)/n)
+            else:
+                row = self.pnl_row(history, notional)
+        else:
+            row = self.pnl_row(history, notional)
+        self.__lock.acquire()
+        try:
+            i = self.__index.get(key,None)
+            if i is None:
+                i = len(self.__state)
+                if i == len(self.__matrix):
+                    self.__grow()
+                self.__matrix[i] = row
+                self.__state.append((history,notional))
+                self.__index[key] = i
+            else:
+                self.__matrix[i] = row
+                self.__state[i] = (history,notional)
+        finally:
+            self.__lock.release()
+
+    def __grow(self):
+        m = self.__matrix
+        g = np.zeros((max(2*len(m),16),m.shape[1]))
+        g[:len(m)] = m
+        self.__matrix = g
+
+    def pnl_row(self, history, notional):
+        '''
+        P&L of *notional* at each scenario day from the daily relative
+        change of *history*. Days before the history starts have no P&L.
+        '''
+        N   = len(self.ordinals)
+        pnl = np.zeros(N)
+        dates, values = tsarrays(history)
+        if not dates or not N:
+            return pnl
+        o   = np.array([d.toordinal() for d in dates], dtype = int)
+        # previous week day of each scenario day
+        prv = self.ordinals - np.where(self.ordinals % 7 == 1, 3, 1)
+        i1  = np.searchsorted(o, self.ordinals, side = 'right') - 1
+        i0  = np.searchsorted(o, prv, side = 'right') - 1
+        ok  = i0 >= 0
+        v1  = values[i1[ok]]
+        v0  = values[i0[ok]]
+        chg = np.where(v0 != 0, v1/np.where(v0 != 0, v0, 1.0) - 1.0, 0.0)
+        chg[~np.isfinite(chg)] = 0.0
+        pnl[ok] = notional*chg
+        return pnl
+
+    def matrix(self):
+        '''
+        The positions x days P&L matrix
+        '''
+        return self.__matrix[:len(self.__state)]
+
+    def pnl(self, keys):
+        '''
+        Scenario P&L of the portfolio made of positions *keys*
+        '''
+        idx = [self.__index[k] for k in keys if k in self.__index]
+        return self.__matrix[idx].sum(axis = 0)
+
+    def risk(self, keys):
+        '''
+        Historical VaR and expected shortfall, as positive losses,
+        of the portfolio made of positions *keys*
+        '''
+        pnl = np.sort(self.pnl(keys))
+        if not len(pnl):
+            return {'hsvar': 0.0, 'es': 0.0}
+        k = max(int(math.floor((1. - self.confidence)*len(pnl))),1)
+        return {'hsvar': -float(pnl[k-1]),
+                'es':    -float(pnl[:k].mean())}
@@ -0,0 +1,104 @@
+'''
+Build scheduler.
+Independent builds of portfolio elements are run on a bounded thread pool
+and joined with a counter of pending tasks.
+'''
+from threading import Lock
+
+from jflow.conf import settings
+
+from logger import log
+
+__all__ = ['buildgroup', 'get_buildpool']
+
+
+def get_buildpool():
+    global _buildpool
+    if _buildpool is None:
+        threads = getattr(settings,'PORTFOLIO_BUILD_THREADS',0)
+        if threads > 0:
+            from jflow.utils.tx import ThreadPool
+            _buildpool = ThreadPool(name = "Portfolio build pool",
+                                    minthreads = 1,
+                                    maxthreads = threads)
+    return _buildpool
+
+_buildpool = None
+
+
+class buildgroup(object):
+    '''
+    A group of independent build tasks.
+    Each task is run on the build pool and its result, once built,
+    is passed to the task callback. When all tasks are done *ondone*
+    is invoked.
+
+        @param ondone: function called without arguments when all tasks
+                       have finished
+    '''
+    def __init__(self, ondone):
+        self.__ondone  = ondone
+        self.__pending = 1
+        self.__lock    = Lock()
+
+    def spawn(self, callback, func, *args):
+        '''
+        Run func(*args) on the build pool. If the result has an addcallback
+        method, as jsonTrade objects do, *callback* is called once
+        the result has finished building, otherwise straight away.
+        '''
+        self.__add()
+        pool = get_buildpool()
+        if pool is None:
+            self.__run(callback, func, *args)
+        else:
+            pool.deferToThread(self.__ran, self.__error, self.__run, callback, func, *args)
+
+    def start(self):
+        '''
+        Call once all tasks have been spawned
+        '''
+        self.__done()
+
+    def __run(self, callback, func, *args):
+        try:
+            res = func(*args)
+        except Exception, e:
+            log.err(e)
+            res = None
+        if res is not None and hasattr(res,'addcallback'):
+            res.addcallback(lambda r: self.__finished(callback, r))
+        else:
+            self.__finished(callback, res)
+
+    def __finished(self, callback, res):
+        try:
+            if res is not None:
+                callback(res)
+        except Exception, e:
+            log.err(e)
+        self.__done()
+
+    def __ran(self, res):
+        pass
+
+    def __error(self, err):
+        log.err(err)
+        self.__done()
+
+    def __add(self):
+        self.__lock.acquire()
+        try:
+            self.__pending += 1
+        finally:
+            self.__lock.release()
+
+    def __done(self):
+        self.__lock.acquire()
+        try:
+            self.__pending -= 1
+            done = self.__pending == 0
+        finally:
+            self.__lock.release()
+        if done:
+            self.__ondone()
@@ -2,9 +2,8 @@
 Cache objects
 '''
 import datetime
-from threading import Lock
+from threading import Lock, Event
 
-from jflow.core.timeseries import dateseries
 from jflow.core.dates import get_livedate, now
 from jflow.db.trade.models import Fund, FundHolder, PortfolioDisplayElement, Position, PortfolioView
 from jflow.utils.tx import runInThread
@@ -14,20 +13,54 @@ from jflow.rates import register_to_rates, get_rate, get_history
 from position import jsonFund, jsonTeam
 from portfoliotree import jsonPortfolioTree
 from logger import PositionException
+from lru import lrucache, cachelimits, estimate_size
 
 import basecache 
 
 
+def sizeof_dated(obj):
+    '''
+    Estimated size of a dated cache entry and its JSON representation
+    '''
+    return estimate_size(obj,0) + estimate_size(getattr(obj,'json',None))
+
+
+class pendingEntry(object):
+    '''
+    Placeholder for a dated entry under creation.
+    Callers requesting the same date wait on it.
+    '''
+    def __init__(self):
+        self.result = None
+        self.__done = Event()
+        
+    def set(self, result):
+        self.result = result
+        self.__done.set()
+        
+    def wait(self):
+        self.__done.wait()
+        return self.result
+
+
 class CacheElement(basecache.cacheObject):
     '''
-    Base class for time series cache elements
+    Base class for time series cache elements.
+    Dated entries are kept in a least recently used container
+    bounded by the limits of the element kind.
     '''
+    kind = None
+    
     def __init__(self, code, cache):
         super(CacheElement,self).__init__(cache)
         self.timestamp = now()
-        self.ts        = dateseries()
+        limits         = cachelimits(self.kind)
+        self.ts        = lrucache('%s dates' % self.kind,
+                                  maxitems = limits['dates'],
+                                  sizeof   = sizeof_dated)
         self.object    = self.get_object(code)
         self.__lock    = Lock()
+        self.__pending = {}
 
     def __str__(self):
         return '%s - %s' % (self.__class__.__name__,self.object)
@@ -40,6 +73,12 @@ class CacheElement(basecache.cacheObject):
     
     def lastmodified(self):
         return datetime.datetime.min
+    
+    def memsize(self):
+        '''
+        Estimated memory used by the dated entries
+        '''
+        return self.ts.size
 
     def get_or_create(self, dte, rjson, inthread = False):
         '''
@@ -54,24 +93,54 @@ class CacheElement(basecache.cacheObject):
             lm  = self.lastmodified()
             if lm > self.timestamp:
                 self.timestamp = now()
-                self.ts        = dateseries()
+                self.ts.clear()
         
-        # thread safe creation
+        # thread safe creation. The lock is held only to look up the
+        # date, the first caller creates the entry while callers for
+        # the same date wait on its placeholder
         self.__lock.acquire()
         try:
-            if self.has_key(dt):
-                return self.ts[dt]
-            else:
-                res = self.create(dte)
-                if res:
-                    self.ts[dt] = res
-                self.build(res,inthread)
-                return res
+            res = self.ts.get(dt,None)
+            if res is None:
+                pending = self.__pending.get(dt,None)
+                creator = pending is None
+                if creator:
+                    pending = pendingEntry()
+                    self.__pending[dt] = pending
+        finally:
+            self.__lock.release()
+        
+        if res is not None:
+            return res
+        if not creator:
+            return pending.wait()
+        
+        res = None
+        try:
+            res = self.create(dte)
+            self.build(res,inthread)
+            if res:
+                self.ts[dt] = res
+                self.sizewhenbuilt(dt, res)
         except Exception, e:
             self.err(e)
-            return None
+            res = None
+        self.__lock.acquire()
+        try:
+            self.__pending.pop(dt,None)
         finally:
             self.__lock.release()
+        pending.set(res)
+        return res
+    
+    def sizewhenbuilt(self, dt, res):
+        '''
+        Estimate the size of the entry at *dt* again once it has
+        finished building. Entries are not sized when accessed.
+        '''
+        addcallback = getattr(res,'addcallback',None)
+        if addcallback:
+            addcallback(lambda r : self.ts.resize(dt))
     
     def build(self, res, inthread):
         res.build(inthread)
@@ -90,6 +159,8 @@ class InstrumentTs(CacheElement):
     Risk and value calculator for a financial instrument.
     This is the building block of market and risk calculation.
     '''
+    kind = 'instrument'
+    
     def __init__(self, *args):
         super(InstrumentTs,self).__init__(*args)
         self.rates = {}  
@@ -132,6 +203,8 @@ class PortfolioTs(CacheElement):
     Portfolio cache.
     This cache object contain a timeserie for a given fund
     '''
+    kind = 'portfolio'
+    
     def __init__(self, *args):
         super(PortfolioTs,self).__init__(*args)
         
@@ -156,6 +229,8 @@ class PortfolioViewTs(CacheElement):
     '''
     Portfolio view cache
     '''
+    kind = 'view'
+    
     def __init__(self, *args):
         super(PortfolioViewTs,self).__init__(*args)
         
@@ -180,6 +255,8 @@ class AggregateTs(CacheElement):
     Position aggregator.
     This cache element aggregate position across all funds of a given team
     '''
+    kind = 'aggregate'
+    
     def __init__(self, *args):
         super(AggregateTs,self).__init__(*args)
         
@@ -4,7 +4,7 @@ Team aggregate views.
 '''
 import datetime
 
-from django.http import Http404
+from django.http import Http404, HttpResponse
 
 from djpcms.settings import HTML_CLASSES
 from djpcms.views import Factory
@@ -14,6 +14,7 @@ from djpcms.ajax import simpledump, simplelem, jredirect
 from jflow.db.utility.server import userproxyserver
 from jflow.core.dates import date2yyyymmdd
 from jflow.db.trade.utils import jsondisplays
+from jflow.db.trade.jsonstream import iterdumps
 
 from forms import ChangeDate
 
@@ -84,7 +85,7 @@ class teamview(Factory.childview):
         proxy = userproxyserver(request.user)
         dt    = date2yyyymmdd(self.date)
         data  = proxy.raw_aggregates(self.team.code,dt)
-        return simpledump(data)
+        return HttpResponse(iterdumps(data), mimetype = 'application/javascript')
     
     
      
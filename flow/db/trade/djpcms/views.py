@@ -1,6 +1,6 @@
 import datetime
 
-from django.http import Http404
+from django.http import Http404, HttpResponse
 from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied
 from django.db.models import Q
@@ -17,6 +17,7 @@ from djpcms.ajax import simpledump, simplelem, jredirect
 from jflow.db.trade.models import PortfolioView, Fund, FundHolder
 from jflow.db.trade.tools import get_trader
 from jflow.db.trade.utils import jsondisplays, get_object_from_id, get_object_id
+from jflow.db.trade.jsonstream import iterdumps
 from jflow.db.utility.server import userproxyserver
 from jflow.core.dates import date2yyyymmdd
 from jflow.quickutils.djutils import todict 
@@ -135,7 +136,7 @@ class fundview(basefundview):
         proxy = userproxyserver(request.user)
         dt    = date2yyyymmdd(self.date)
         data  = proxy.raw_portfolio(self.object.id,dt)
-        return simpledump(data)
+        return HttpResponse(iterdumps(data), mimetype = 'application/javascript')
     
     def add_folder(self, request, params):
         '''
@@ -186,6 +187,14 @@ class fundview(basefundview):
         dt     = date2yyyymmdd(self.date)
         proxy  = userproxyserver(request.user)
         return simpledump(proxy.raw_marketRisk(self.object.id, dt, id))
+    
+    def expand_node(self, request, params):
+        self.preprocess_default(request)
+        data   = todict(params)
+        id     = data.get('id',None)
+        dt     = date2yyyymmdd(self.date)
+        proxy  = userproxyserver(request.user)
+        return simpledump(proxy.raw_expandPortfolioNode(self.object.id, dt, id))
         
 
 class defaultfundview(fundview):
@@ -0,0 +1,76 @@
+'''
+Streaming JSON serialization of portfolio objects.
+Trees and team aggregates are written element by element, so that
+neither a copy of the whole JSON structure nor the whole string
+is held in memory at once.
+'''
+from django.utils import simplejson
+
+__all__ = ['iterjson', 'iterdumps', 'CHUNK_SIZE']
+
+CHUNK_SIZE = 64*1024
+
+
+def dumps(obj):
+    return simplejson.dumps(obj, default = unicode)
+
+
+def chunked(strings, chunksize):
+    '''
+    Join *strings* into chunks of at least *chunksize* characters
+    '''
+    buf  = []
+    size = 0
+    for s in strings:
+        buf.append(s)
+        size += len(s)
+        if size >= chunksize:
+            yield ''.join(buf)
+            buf  = []
+            size = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def iterdumps(obj, chunksize = CHUNK_SIZE):
+    '''
+    Generator of JSON chunks for a plain python object
+    '''
+    encoder = simplejson.JSONEncoder(default = unicode)
+    return chunked(encoder.iterencode(obj), chunksize)
+
+
+def iterjson(el, chunksize = CHUNK_SIZE):
+    '''
+    Generator of JSON chunks for jsonTrade *el*. The object is refreshed
+    before serialization. If its json has elements, as portfolio trees
+    and team aggregates do, elements are serialized one at a time.
+    '''
+    return chunked(_iterjson(el), chunksize)
+
+
+def _iterjson(el):
+    json     = el.rjson()
+    elements = json.get('elements',None)
+    if not isinstance(elements,(dict,list)):
+        yield dumps(json)
+        return
+    yield '{'
+    for k,v in json.items():
+        if k != 'elements':
+            yield '%s: %s, ' % (dumps(k),dumps(v))
+    yield '"elements": '
+    sep = ''
+    if isinstance(elements,dict):
+        yield '{'
+        for id,v in elements.items():
+            yield '%s%s: %s' % (sep,dumps(id),dumps(v))
+            sep = ', '
+        yield '}'
+    else:
+        yield '['
+        for v in elements:
+            yield '%s%s' % (sep,dumps(v))
+            sep = ', '
+        yield ']'
+    yield '}'
@@ -1,3 +1,6 @@
 #from api import *
 #from forms import *
-#from finins import *
\ No newline at end of file
+#from finins import *
+from positions import *
+from aggregate import *
+from jsonstream import *
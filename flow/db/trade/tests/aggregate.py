@@ -0,0 +1,499 @@
+import math
+from datetime import date, timedelta
+
+import numpy as np
+
+from django.test import TestCase
+
+from jflow.conf import settings
+from jflow.lib import numericts
+from jflow.db.trade.aggregate.riskengine import RiskEngine, ScenarioMatrix, normal_quantile, weekdays
+from jflow.db.trade.aggregate.lru import lrucache
+from jflow.db.trade.aggregate.display import displaylayout
+from jflow.db.trade.aggregate.marketrisk import allocation, MarketRiskPosition, MarketRiskPortfolio
+from jflow.db.trade.aggregate.portfoliotree import jsonPortfolioTree
+from jflow.db.trade.aggregate.basejson import jsonTrade, nextrevision, currentrevision, validrevision
+from jflow.db.trade.aggregate import scheduler
+
+__all__ = ['RiskEngineTest',
+           'ScenarioMatrixTest',
+           'LruCacheTest',
+           'DisplayLayoutTest',
+           'AllocationTest',
+           'LinearHistoryTest',
+           'PortfolioRiskTest',
+           'TreeMarketRiskTest',
+           'RevisionTest',
+           'BuildGroupTest']
+
+
+START = date(2010,1,4)
+
+def history(values, start = START):
+    '''
+    Historical notional on consecutive week days
+    '''
+    ts = numericts()
+    for d,v in zip(weekdays(start, start + timedelta(days = 2*len(values))),values):
+        ts[date.fromordinal(int(d))] = v
+    return ts
+
+def notionals(N, seed):
+    rnd = np.random.RandomState(seed)
+    return 100.0*np.cumprod(1.0 + 0.01*rnd.standard_normal(N))
+
+
+class RiskEngineTest(TestCase):
+    conf = {'method': 'sample', 'shrinkage': 0.0, 'confidence': 0.99,
+            'returns': 'simple', 'periods': 252}
+
+    def setUp(self):
+        self.values    = [notionals(60,1), notionals(60,2), notionals(60,3)]
+        self.histories = [history(v) for v in self.values]
+        self.engine    = RiskEngine(self.histories, [v[-1] for v in self.values],
+                                    keys = ['a','b','c'], conf = self.conf)
+
+    def testNormalQuantile(self):
+        self.assertAlmostEqual(normal_quantile(0.975),1.959964,5)
+        self.assertAlmostEqual(normal_quantile(0.5),0.0,8)
+        self.assertRaises(ValueError,normal_quantile,1.0)
+
+    def testParametricVar(self):
+        R   = np.array([v[1:]/v[:-1] - 1.0 for v in self.values]).T
+        w   = np.array([v[-1] for v in self.values])
+        sig = math.sqrt(np.dot(w,np.dot(np.cov(R, rowvar = 0),w)))
+        risk = self.engine.node([0,1,2])
+        self.assertAlmostEqual(risk['stdev'],sig,8)
+        self.assertAlmostEqual(risk['var'],normal_quantile(0.99)*sig,8)
+        self.assertAlmostEqual(risk['vol'],sig*math.sqrt(252),8)
+        self.assertAlmostEqual(risk['component'].sum(),risk['var'],8)
+
+    def testSubBlock(self):
+        single = self.engine.node([self.engine.index['b']])
+        R   = self.values[1][1:]/self.values[1][:-1] - 1.0
+        sig = self.values[1][-1]*R.std(ddof = 1)
+        self.assertAlmostEqual(single['stdev'],sig,8)
+        self.assertAlmostEqual(single['component'][0],single['var'],8)
+
+    def testLogReturns(self):
+        conf   = dict(self.conf, returns = 'log')
+        engine = RiskEngine(self.histories[:1], [1.0], conf = conf)
+        R      = np.diff(np.log(self.values[0]))
+        self.assertAlmostEqual(engine.node([0])['stdev'],R.std(ddof = 1),10)
+
+    def testSetWeights(self):
+        cov = self.engine.cov
+        self.engine.setweights(['c','a'],[2.0,-1.0])
+        w   = np.array([-1.0,self.values[1][-1],2.0])
+        sig = math.sqrt(np.dot(w,np.dot(cov,w)))
+        self.assertTrue(self.engine.cov is cov)
+        self.assertAlmostEqual(self.engine.node([0,1,2])['stdev'],sig,8)
+
+
+class keyposition(object):
+    def __init__(self, aggregate):
+        self.isaggregate = aggregate
+
+class keyelement(object):
+    def __init__(self, id, ccy, aggregate = False):
+        self.id = id
+        self.ccy = ccy
+        self.isposition = keyposition(aggregate)
+    def calc_ccy(self):
+        return self.ccy
+    def __getitem__(self, code):
+        return 'asset%s' % self.id
+
+
+class ScenarioMatrixTest(TestCase):
+
+    def setUp(self):
+        self.values = [notionals(30,4), notionals(30,5)]
+        self.histories = [history(v) for v in self.values]
+        days = weekdays(START, START + timedelta(days = 60))
+        self.start = date.fromordinal(int(days[1]))
+        self.end   = date.fromordinal(int(days[29]))
+        self.sm    = ScenarioMatrix(self.start, self.end, confidence = 0.9)
+
+    def testRow(self):
+        sm  = self.sm
+        sm.add('a', self.histories[0], 10.0)
+        v   = self.values[0]
+        self.assertEqual(len(sm),1)
+        self.assertTrue('a' in sm)
+        self.assertTrue(np.allclose(sm.pnl(['a']),10.0*(v[1:]/v[:-1] - 1.0)))
+
+    def testUpdateRow(self):
+        sm = self.sm
+        sm.add('a', self.histories[0], 10.0)
+        sm.add('b', self.histories[1], 5.0)
+        pnlb = sm.pnl(['b'])
+        sm.add('a', self.histories[0], -20.0)
+        v = self.values[0]
+        self.assertEqual(len(sm),2)
+        self.assertTrue(np.allclose(sm.pnl(['a']),-20.0*(v[1:]/v[:-1] - 1.0)))
+        sm.add('a', self.histories[1], 1.0)
+        v = self.values[1]
+        self.assertEqual(len(sm),2)
+        self.assertTrue(np.allclose(sm.pnl(['a']),v[1:]/v[:-1] - 1.0))
+        self.assertTrue(np.allclose(sm.pnl(['b']),pnlb))
+        self.assertEqual(sm.matrix().shape,(2,29))
+
+    def testRiskKeys(self):
+        # the same position in other currencies or as an aggregate has its own row
+        elems = [keyelement(1,'USD'), keyelement(1,'EUR'), keyelement(1,'USD',True)]
+        keys  = [MarketRiskPosition(None, e).riskkey() for e in elems]
+        self.assertEqual(len(set(keys)),3)
+        self.assertEqual(keys[0],MarketRiskPosition(None, keyelement(1,'USD')).riskkey())
+        sm = self.sm
+        for k,n in zip(keys,(1.0,2.0,3.0)):
+            sm.add(k, self.histories[0], n)
+        self.assertEqual(len(sm),3)
+        self.assertTrue(np.allclose(sm.pnl(keys[1:2]),2.0*sm.pnl(keys[:1])))
+
+    def testHistoricalVar(self):
+        sm = self.sm
+        sm.add('a', self.histories[0], 10.0)
+        sm.add('b', self.histories[1], -5.0)
+        pnl  = sm.pnl(['a','b'])
+        spnl = np.sort(pnl)
+        risk = sm.risk(['a','b'])
+        self.assertEqual(len(pnl),29)
+        self.assertAlmostEqual(risk['hsvar'],-spnl[1],10)
+        self.assertAlmostEqual(risk['es'],-spnl[:2].mean(),10)
+        self.assertEqual(sm.risk([]),{'hsvar': 0.0, 'es': 0.0})
+
+
+class LruCacheTest(TestCase):
+
+    def testMaxItems(self):
+        c = lrucache('test', maxitems = 2, sizeof = lambda v: 1)
+        c['a'] = 1
+        c['b'] = 2
+        self.assertEqual(c.get('a'),1)
+        c['c'] = 3
+        self.assertEqual(sorted(c.keys()),['a','c'])
+        self.assertEqual(c.evictions,1)
+        self.assertEqual(c.size,2)
+        self.assertEqual(c.get('b'),None)
+        self.assertEqual(c.stats()['misses'],1)
+
+    def testMaxSize(self):
+        c = lrucache('test', maxsize = 10, sizeof = len)
+        c['a'] = 'x'*4
+        c['b'] = 'x'*4
+        c['c'] = 'x'*4
+        self.assertEqual(sorted(c.keys()),['b','c'])
+        c['d'] = 'x'*20
+        self.assertEqual(c.keys(),['d'])
+
+    def testResize(self):
+        c = lrucache('test', maxsize = 10, sizeof = len)
+        v = ['x']
+        c['a'] = v
+        c['b'] = ['y']
+        v.extend(['x']*9)
+        self.assertEqual(c.size,2)
+        c.get('a')
+        c.resize('a')
+        self.assertEqual(c.keys(),['a'])
+        self.assertEqual(c.size,10)
+        self.assertEqual(c.pop('a'),v)
+        self.assertEqual(c.size,0)
+
+
+class row(object):
+    name = 'row'
+    def __init__(self, size):
+        self.size = size
+    def price(self):
+        return 2.0
+    def __get_value(self):
+        return self.size*self.price()
+    value = property(__get_value)
+
+class source(object):
+    description = 'source'
+
+class element(object):
+    def __init__(self, code):
+        self.code = code
+
+
+class DisplayLayoutTest(TestCase):
+
+    def setUp(self):
+        self.layout = displaylayout([element(c) for c in ('name','size','value','price','description','missing')])
+
+    def testSlots(self):
+        self.assertEqual(len(self.layout),6)
+        self.assertEqual(self.layout.slot('value'),2)
+        self.assertEqual(self.layout.slot('foo'),None)
+
+    def testRow(self):
+        r = self.layout.row(row(3))
+        self.assertEqual(r,['row',3,6.0,2.0,'',''])
+        r = self.layout.row(row(0), source(), '#N/A')
+        self.assertEqual(r,['row','#N/A','#N/A',2.0,'source','#N/A'])
+
+    def testAccessorsCached(self):
+        self.assertTrue(self.layout.accessors(row) is self.layout.accessors(row))
+
+
+class AllocationTest(TestCase):
+
+    def setUp(self):
+        self.folder = allocation('NAV')
+        self.root   = allocation('NAV')
+
+    def push(self, key, assetcode, ccys):
+        changes = self.folder.set(key, assetcode, ccys)
+        return self.root.update('folder', 'F', self.folder.ccy, changes)
+
+    def testDelta(self):
+        self.push('a', 'A', {'USD': 1.0, 'EUR': 2.0})
+        self.push('b', 'B', {'USD': 3.0})
+        self.assertEqual(self.root.ccy,{'USD': 4.0, 'EUR': 2.0})
+        changes = self.push('a', 'A', {'USD': 2.0, 'GBP': 1.0})
+        self.assertEqual(sorted(changes),[('EUR',-2.0,-1),('GBP',1.0,1),('USD',1.0,0)])
+        self.assertEqual(self.root.ccy,{'USD': 5.0, 'GBP': 1.0})
+        self.assertEqual(self.root.assets,{'F': 6.0})
+        self.assertEqual(self.push('a', 'A', {'USD': 2.0, 'GBP': 1.0}),[])
+        self.root.update('folder', 'F', self.folder.ccy, self.folder.remove('b'))
+        self.assertEqual(self.root.ccy,self.folder.ccy)
+        self.assertEqual(self.root.ccyassets,{'USD': {'F': 2.0}, 'GBP': {'F': 1.0}})
+
+    def testResync(self):
+        self.push('a', 'A', {'USD': 1.0})
+        self.folder.set('a', 'A', {'USD': 3.0})
+        # changes lost by the root are recovered with the next update
+        self.root.update('folder', 'F', self.folder.ccy, [('EUR',1.0,-1)])
+        self.assertEqual(self.root.ccy,{'USD': 3.0})
+
+    def testSharedAsset(self):
+        a = self.root
+        a.setasset('x', 'A', 1.0)
+        a.setasset('y', 'A', 2.0)
+        a.setasset('z', 'B', 3.0)
+        a.remove('x')
+        self.assertEqual(a.assets,{'A': 2.0, 'B': 3.0})
+        a.setasset('y', 'C', 4.0)
+        self.assertEqual(a.assets,{'B': 3.0, 'C': 4.0})
+        a.retain(['z'])
+        self.assertEqual(a.assets,{'B': 3.0})
+
+
+class linearinstrument(object):
+    
+    def __init__(self, multiplier):
+        self.multiplier = multiplier
+        self.mktprice   = None
+        
+    def notional(self, size = 1.0):
+        return self.multiplier*size*float(self.mktprice)
+    
+    def notional_multiplier(self):
+        return self.multiplier
+
+class riskelement(object):
+    def __init__(self, fxhistory = None):
+        self._fxhistory = fxhistory
+
+
+class LinearHistoryTest(TestCase):
+
+    def setUp(self):
+        self.prices = history(notionals(20,6))
+        self.fx     = history(1.5 + 0.1*np.random.RandomState(7).standard_normal(20))
+        self.fin    = linearinstrument(25.0)
+        self.size   = 40.0
+
+    def loop(self, fxhistory):
+        # the per-point loop of MarketRiskPosition.calculate_history
+        fin = self.fin
+        tc  = numericts()
+        for k,v in self.prices.items():
+            fin.mktprice = v
+            tc[k] = fin.notional(self.size)
+        if fxhistory:
+            tc = tc*fxhistory
+        return tc
+
+    def compare(self, fxhistory):
+        mr   = MarketRiskPosition(None, riskelement(fxhistory))
+        fast = mr.linear_history(self.prices, self.fin.notional_multiplier()*self.size)
+        slow = self.loop(fxhistory)
+        self.assertEqual(len(fast),len(self.prices))
+        self.assertEqual(sorted(fast.keys()),sorted(slow.keys()))
+        for k,v in slow.items():
+            self.assertAlmostEqual(fast[k],v,8)
+
+    def testNoFx(self):
+        self.compare(None)
+
+    def testFx(self):
+        self.compare(self.fx)
+
+
+class riskcache(object):
+    def __init__(self):
+        self.sm = ScenarioMatrix(START, START + timedelta(days = 80))
+    def scenarios(self, dte):
+        return self.sm
+
+class riskportfolio(object):
+    parent    = None
+    collapsed = None
+    dte       = None
+    def __init__(self, elems):
+        self.children        = [e.id for e in elems]
+        self.element_objects = dict((e.id,e) for e in elems)
+
+
+class PortfolioRiskTest(TestCase):
+
+    def setUp(self):
+        self.elems = []
+        for id,seed in ((1,8),(2,9),(3,10)):
+            e  = keyelement(id,'USD')
+            mr = MarketRiskPosition(None, e)
+            mr.performance_history = history(notionals(40,seed))
+            mr.notional = 100.0*id
+            e.mktrisk = mr
+            self.elems.append(e)
+
+    def calculate(self):
+        mr = MarketRiskPortfolio(riskcache(), riskportfolio(self.elems))
+        mr.calculateRisk()
+        return mr
+
+    def testEngineReuse(self):
+        root  = self.calculate()
+        stdev = root.stdev
+        self.elems[0].mktrisk.notional = 300.0
+        root.calculateRisk()
+        self.assertNotAlmostEqual(root.stdev,stdev,6)
+        self.assertAlmostEqual(root.stdev,self.calculate().stdev,8)
+        # a new historical notional of a position is estimated again
+        self.elems[1].mktrisk.performance_history = history(notionals(40,11))
+        root.calculateRisk()
+        self.assertAlmostEqual(root.stdev,self.calculate().stdev,8)
+        self.assertAlmostEqual(root.hsvar,self.calculate().hsvar,8)
+
+
+class lazyfolder(object):
+    def __init__(self, id):
+        self.id       = id
+        self.mktrisk  = 'risk%s' % id
+        self.expanded = []
+    def expand(self, deep = False):
+        self.expanded.append(deep)
+        return self
+
+class lazytree(jsonPortfolioTree):
+    def __init__(self, *folders):
+        self.lazy            = True
+        self.element_objects = dict((f.id,f) for f in folders)
+        self.refreshed       = 0
+    def refresh(self):
+        self.refreshed += 1
+
+
+class TreeMarketRiskTest(TestCase):
+
+    def testCollapsedChildren(self):
+        folder = lazyfolder('f1')
+        tree   = lazytree(folder)
+        self.assertEqual(tree.marketRisk('f1'),'riskf1')
+        self.assertEqual(folder.expanded,[])
+        self.assertEqual(tree.refreshed,1)
+        self.assertEqual(tree.marketRisk('f2'),None)
+        self.assertEqual(tree.refreshed,1)
+
+
+class revisioned(jsonTrade):
+    def rjson(self):
+        return {'id': 1}
+
+
+class RevisionTest(TestCase):
+
+    def testValidRevision(self):
+        rev = nextrevision()
+        self.assertEqual(validrevision(rev),rev)
+        self.assertEqual(validrevision(str(rev)),rev)
+        self.assertEqual(validrevision(rev+1000),None)
+        self.assertEqual(validrevision(-1),None)
+        self.assertEqual(validrevision('abc'),None)
+        self.assertEqual(validrevision(None),None)
+
+    def testDelta(self):
+        el  = revisioned(None)
+        rev = currentrevision()
+        self.assertEqual(el.rjsondelta(rev),{'revision': rev, 'unchanged': True})
+        el.touch()
+        json = el.rjsondelta(rev)
+        self.assertEqual(json['id'],1)
+        self.assertEqual(json['revision'],currentrevision())
+        self.assertEqual(el.rjsondelta(None)['id'],1)
+
+
+class building(object):
+    def __init__(self, value):
+        self.value     = value
+        self.callbacks = []
+    def addcallback(self, cbfun):
+        self.callbacks.append(cbfun)
+    def built(self):
+        for cbfun in self.callbacks:
+            cbfun(self)
+
+
+class BuildGroupTest(TestCase):
+    
+    def setUp(self):
+        self.threads = getattr(settings,'PORTFOLIO_BUILD_THREADS',0)
+        self.pool    = scheduler._buildpool
+        settings.PORTFOLIO_BUILD_THREADS = 0
+        scheduler._buildpool = None
+        self.results = []
+        self.done    = 0
+        
+    def tearDown(self):
+        settings.PORTFOLIO_BUILD_THREADS = self.threads
+        scheduler._buildpool = self.pool
+        
+    def ondone(self):
+        self.done += 1
+        
+    def broken(self, x):
+        raise ValueError(x)
+        
+    def testInline(self):
+        group = scheduler.buildgroup(self.ondone)
+        for x in range(5):
+            group.spawn(self.results.append, lambda x: x and 2*x or None, x)
+        group.spawn(self.results.append, self.broken, 1)
+        self.assertEqual(self.done,0)
+        group.start()
+        self.assertEqual(self.done,1)
+        self.assertEqual(self.results,[2,4,6,8])
+        
+    def testEmpty(self):
+        group = scheduler.buildgroup(self.ondone)
+        group.start()
+        self.assertEqual(self.done,1)
+        
+    def testBuilding(self):
+        group = scheduler.buildgroup(self.ondone)
+        elems = [building(x) for x in range(3)]
+        for el in elems:
+            group.spawn(self.results.append, lambda el: el, el)
+        group.start()
+        self.assertEqual(self.done,0)
+        elems[1].built()
+        elems[0].built()
+        self.assertEqual(self.done,0)
+        elems[2].built()
+        self.assertEqual(self.done,1)
+        self.assertEqual([el.value for el in self.results],[1,0,2])
@@ -0,0 +1,46 @@
+from django.test import TestCase
+from django.utils import simplejson
+
+from jflow.db.trade.jsonstream import iterjson, iterdumps, chunked
+
+__all__ = ['JsonStreamTest']
+
+
+class jsonobject(object):
+    def __init__(self, json):
+        self.json = json
+    def rjson(self):
+        return self.json
+
+
+class JsonStreamTest(TestCase):
+
+    def loads(self, chunks):
+        return simplejson.loads(''.join(chunks))
+
+    def testDictElements(self):
+        json = {'root': 'a', 'revision': 3,
+                'elements': dict(('id%s' % i, {'row': [i, 'x%s' % i]}) for i in range(50))}
+        self.assertEqual(self.loads(iterjson(jsonobject(json))),json)
+
+    def testListElements(self):
+        json = {'elements': [{'id': i} for i in range(10)]}
+        self.assertEqual(self.loads(iterjson(jsonobject(json))),json)
+        json = {'elements': []}
+        self.assertEqual(self.loads(iterjson(jsonobject(json))),json)
+
+    def testNoElements(self):
+        json = {'id': 1, 'elements': None}
+        self.assertEqual(self.loads(iterjson(jsonobject(json))),json)
+        json = {'description': 'building'}
+        self.assertEqual(self.loads(iterdumps(json)),json)
+
+    def testChunks(self):
+        self.assertEqual(list(chunked(['ab','cd','e'],3)),['abcd','e'])
+        self.assertEqual(list(chunked([],3)),[])
+        json   = {'elements': dict(('id%s' % i, 'v' * 20) for i in range(100))}
+        chunks = list(iterjson(jsonobject(json), chunksize = 100))
+        self.assertTrue(len(chunks) > 1)
+        for c in chunks[:-1]:
+            self.assertTrue(len(c) >= 100)
+        self.assertEqual(self.loads(chunks),json)
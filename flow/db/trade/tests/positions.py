@@ -0,0 +1,262 @@
+import time
+import datetime
+
+from django.test import TestCase
+
+from jflow.db.trade.models import FundHolder, Fund, CustodyAccount, Position, PositionHistory, PositionSnapshot
+from jflow.db.trade.models import POSITION_STATUS_DUMMY, POSITION_STATUS_SYNCRONIZED, POSITION_STATUS_MANUAL
+from jflow.db.trade.aggregate.cache import CalculationCache, get_cache
+
+__all__ = ['PositionManagerTest',
+           'PositionHistoryManagerTest',
+           'PositionSnapshotTest',
+           'CacheCheckTest']
+
+
+def instrument(code):
+    model = Position._meta.get_field('instrumentCode').rel.to
+    return model.objects.create(code = code)
+
+def ids(qs):
+    return sorted(p.id for p in qs)
+
+def sizes(position):
+    return dict((h.dt,int(h.size)) for h in PositionHistory.objects.filter(position = position))
+
+
+class PositionTestBase(TestCase):
+    
+    def setUp(self):
+        self.dt   = datetime.date(2010,6,1)
+        self.team = FundHolder.objects.create(code = 'FI', fund_manager = True)
+        self.fund = self.newfund('TESTFUND', 'USD')
+        self.ics  = [instrument('GOOG_US'), instrument('LOIL_LN')]
+        
+    def days(self, n):
+        return self.dt + datetime.timedelta(days = n)
+        
+    def newfund(self, code, ccy):
+        return Fund.objects.create(code = code, firm_code = code,
+                                   fund_holder = self.team, curncy = ccy)
+        
+    def position(self, ic, status = POSITION_STATUS_SYNCRONIZED, open_date = None, fund = None):
+        fund = fund or self.fund
+        return Position.objects.create(instrumentCode = ic,
+                                       fund           = fund,
+                                       custodian      = CustodyAccount.objects.get_for_fund(fund),
+                                       status         = status,
+                                       open_date      = open_date or self.dt)
+
+
+class PositionManagerTest(PositionTestBase):
+        
+    def testStatusFilter(self):
+        p1 = self.position(self.ics[0])
+        p2 = self.position(self.ics[1], POSITION_STATUS_MANUAL)
+        p3 = self.position(self.ics[0], POSITION_STATUS_DUMMY, datetime.date(2010,5,3))
+        status_filter = Position.objects.status_filter
+        self.assertEqual(ids(status_filter(POSITION_STATUS_SYNCRONIZED)),[p1.id])
+        self.assertEqual(ids(status_filter([POSITION_STATUS_SYNCRONIZED,POSITION_STATUS_MANUAL])),
+                         sorted([p1.id,p2.id]))
+        self.assertEqual(ids(status_filter(['2','0'])),sorted([p2.id,p3.id]))
+        self.assertEqual(ids(status_filter('all')),sorted([p1.id,p2.id,p3.id]))
+        # unknown flags default to syncronized
+        self.assertEqual(ids(status_filter(['foo'])),[p1.id])
+        
+    def testAggregatePositions(self):
+        fund2 = self.newfund('TESTFUND2', 'GBP')
+        p1 = self.position(self.ics[0])
+        p2 = self.position(self.ics[0], fund = fund2)
+        p3 = self.position(self.ics[1])
+        PositionHistory.objects.create(position = p1, dt = self.dt, size = 10)
+        PositionHistory.objects.create(position = p1, dt = self.dt + datetime.timedelta(days = 5), size = 30)
+        PositionHistory.objects.create(position = p2, dt = self.dt - datetime.timedelta(days = 3), size = 5)
+        agg = Position.objects.aggregate_positions(team = self.team, dt = self.dt)
+        self.assertEqual(sorted(agg),['GOOG_US','LOIL_LN'])
+        goog = agg['GOOG_US']
+        self.assertEqual(len(goog),2)
+        self.assertEqual(goog.size,15)
+        # a position without history has zero size
+        loil = agg['LOIL_LN']
+        self.assertEqual(loil.size,0)
+        self.assertEqual(loil[0]['position'].id,p3.id)
+        self.assertEqual(loil[0]['history'],None)
+
+
+class PositionHistoryManagerTest(PositionTestBase):
+    
+    def testAddManyDates(self):
+        ic = self.ics[0]
+        N  = PositionHistory.objects.addmany([(self.fund, self.dt, ic, 10, 1000.),
+                                              (self.fund, self.days(7), ic, 5, 600.)])
+        self.assertEqual(N,2)
+        p = Position.objects.get(fund = self.fund, instrumentCode = ic)
+        self.assertEqual(p.open_date,self.dt)
+        self.assertEqual(sizes(p),{self.dt: 10, self.days(7): 15})
+        h = PositionHistory.objects.get(position = p, dt = self.days(7))
+        self.assertAlmostEqual(h.value,1600.)
+        self.assertAlmostEqual(h.dirty_value,1600.)
+        
+    def testAddManyBeforeHistory(self):
+        ic = self.ics[0]
+        p  = self.position(ic, open_date = self.days(-10))
+        PositionHistory.objects.addmany([(self.fund, self.dt, ic, 10, 1000.),
+                                         (self.fund, self.days(7), ic, 20, 2000.)])
+        # trades before and between existing points reach all later dates
+        PositionHistory.objects.addmany([(self.fund, self.days(-5), ic, 4, 400.),
+                                         (self.fund, self.days(3), ic, -1, -100.)])
+        self.assertEqual(Position.objects.filter(fund = self.fund, instrumentCode = ic).count(),1)
+        self.assertEqual(sizes(p),{self.days(-5): 4,
+                                   self.dt: 14,
+                                   self.days(3): 13,
+                                   self.days(7): 33})
+        
+    def testAddManyRepeatedKeys(self):
+        ic0, ic1 = self.ics
+        N = PositionHistory.objects.addmany([(self.fund, self.dt, ic0, 3, 300., 310.),
+                                             (self.fund, self.dt, ic1, 1, 100.),
+                                             (self.fund, self.dt, ic0, 3, 300., 310.),
+                                             (self.fund, self.days(2), ic0, 2, 200.)])
+        self.assertEqual(N,3)
+        p0 = Position.objects.get(fund = self.fund, instrumentCode = ic0)
+        p1 = Position.objects.get(fund = self.fund, instrumentCode = ic1)
+        self.assertEqual(sizes(p0),{self.dt: 6, self.days(2): 8})
+        self.assertEqual(sizes(p1),{self.dt: 1})
+        h = PositionHistory.objects.get(position = p0, dt = self.days(2))
+        self.assertAlmostEqual(h.value,800.)
+        self.assertAlmostEqual(h.dirty_value,820.)
+
+
+class PositionSnapshotTest(PositionTestBase):
+    
+    def setUp(self):
+        super(PositionSnapshotTest,self).setUp()
+        ic0, ic1 = self.ics
+        self.p1 = self.position(ic0, open_date = self.days(-10))
+        self.p2 = self.position(ic1)
+        self.p3 = self.position(ic1, open_date = self.days(-10))
+        self.p3.close_date = self.dt
+        self.p3.save()
+        self.position(ic0, open_date = self.days(5))
+        for n,size in ((-5,10),(0,15),(5,20)):
+            PositionHistory.objects.create(position = self.p1, dt = self.days(n),
+                                           size = size, value = 10.*size)
+        
+    def rows(self, dt):
+        return dict((s.position_id,(int(s.size),s.value)) for s in PositionSnapshot.objects.filter(dt = dt))
+    
+    def history(self, n, **kwargs):
+        h = PositionHistory.objects.get(position = self.p1, dt = self.days(n))
+        for k,v in kwargs.items():
+            setattr(h,k,v)
+        h.save()
+        
+    def testMaterialise(self):
+        PS = PositionSnapshot.objects
+        self.assertFalse(PS.materialised(self.dt))
+        PS.materialise(self.dt)
+        self.assertTrue(PS.materialised(self.dt))
+        # positions without history have zero size
+        self.assertEqual(self.rows(self.dt),{self.p1.id: (15,150.), self.p2.id: (0,0.)})
+        PS.materialise(self.dt)
+        self.assertEqual(self.rows(self.dt),{self.p1.id: (15,150.), self.p2.id: (0,0.)})
+        self.assertEqual(PS.dates(),[self.dt])
+        # dates without open positions are recorded
+        PS.ensure(self.days(-20))
+        self.assertEqual(self.rows(self.days(-20)),{})
+        self.assertEqual(PS.dates(self.days(-30)),[self.days(-20),self.dt])
+        
+    def testRefresh(self):
+        PS = PositionSnapshot.objects
+        PS.materialise(self.days(-5))
+        PS.materialise(self.dt)
+        PS.suspend()
+        try:
+            self.history(-5, size = 12)
+            self.history(0, size = 17)
+        finally:
+            PS.resume()
+        PS.refresh_positions([self.p1.id], self.dt)
+        self.assertEqual(self.rows(self.days(-5))[self.p1.id],(10,100.))
+        self.assertEqual(self.rows(self.dt)[self.p1.id],(17,150.))
+        # signals refresh the dates from the changed history
+        self.history(-5, value = 120.)
+        self.assertEqual(self.rows(self.days(-5))[self.p1.id],(12,120.))
+        self.assertEqual(self.rows(self.dt)[self.p1.id],(17,150.))
+        # closing a position removes it from the later snapshots
+        self.p1.close_date = self.dt
+        self.p1.save()
+        self.assertEqual(sorted(self.rows(self.days(-5))),sorted([self.p1.id,self.p3.id]))
+        self.assertEqual(sorted(self.rows(self.dt)),[self.p2.id])
+        
+    def testAddManyMaterialise(self):
+        PS = PositionSnapshot.objects
+        PS.materialise(self.days(-5))
+        PositionHistory.objects.addmany([(self.fund, self.days(-5), self.ics[0], 1, 10.),
+                                         (self.fund, self.dt, self.ics[1], 3, 30.)])
+        self.assertEqual(PS.dates(),[self.days(-5),self.dt])
+        self.assertEqual(self.rows(self.days(-5))[self.p1.id],(11,110.))
+        self.assertEqual(self.rows(self.dt),{self.p1.id: (16,160.), self.p2.id: (3,30.)})
+        
+    def testSnapshotFilter(self):
+        PO = Position.objects
+        p1, p2 = self.p1.id, self.p2.id
+        # dates not materialised are read from the positions table
+        self.assertEqual(ids(PO.snapshot_filter(self.dt)),sorted([p1,p2]))
+        self.assertFalse(PositionSnapshot.objects.materialised(self.dt))
+        PositionSnapshot.objects.materialise(self.days(-5))
+        PositionSnapshot.objects.materialise(self.dt)
+        dummy = self.position(self.ics[1], POSITION_STATUS_DUMMY, self.days(-1)).id
+        self.assertEqual(ids(PO.snapshot_filter(self.dt)),sorted([p1,p2]))
+        self.assertEqual(ids(PO.snapshot_filter(self.dt, status = 'all')),sorted([p1,p2,dummy]))
+        self.assertEqual(ids(PO.snapshot_filter(self.dt, status = POSITION_STATUS_DUMMY)),[dummy])
+        self.assertEqual(ids(PO.snapshot_filter(self.days(-5), status = 'all')),sorted([p1,self.p3.id]))
+        self.assertEqual(ids(PO.positions_for_fund(self.fund, self.dt)),sorted([p1,p2]))
+
+
+class checkcache(CalculationCache):
+    
+    def __init__(self):
+        super(checkcache,self).__init__()
+        self.invalidated = []
+        
+    def invalidate(self, funds):
+        self.invalidated.append(set(funds))
+
+
+class CacheCheckTest(PositionTestBase):
+    
+    def setUp(self):
+        super(CacheCheckTest,self).setUp()
+        get_cache().changedfunds()
+        
+    def testSignals(self):
+        cache = get_cache()
+        p = self.position(self.ics[0])
+        self.assertEqual(cache.changedfunds(),set([self.fund.id]))
+        self.assertEqual(cache.changedfunds(),set())
+        PositionHistory.objects.create(position = p, dt = self.dt, size = 10)
+        self.assertEqual(cache.changedfunds(),set([self.fund.id]))
+        
+    def testChanged(self):
+        cache = checkcache()
+        cache.nextcheck = time.time() + 60
+        cache.changed(fund = self.fund.id)
+        cache.timecheck()
+        self.assertEqual(cache.invalidated,[set([self.fund.id])])
+        cache.timecheck()
+        self.assertEqual(len(cache.invalidated),1)
+        
+    def testThrottle(self):
+        cache = checkcache()
+        cache.lastaccess = datetime.datetime.now() - datetime.timedelta(minutes = 1)
+        cache.nextcheck  = time.time() + 60
+        fund = self.newfund('OTHERFUND', 'EUR')
+        self.position(self.ics[0], fund = fund)
+        cache.timecheck()
+        self.assertEqual(cache.invalidated,[])
+        la = cache.lastaccess
+        cache.nextcheck = 0
+        cache.timecheck()
+        self.assertEqual(cache.invalidated,[set([fund.id])])
+        self.assertTrue(cache.lastaccess > la)
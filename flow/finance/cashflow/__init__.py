@@ -2,5 +2,6 @@
 
 from cashflow import CashFlow
 from matrix import CashFlowMatrix
+from bootstrap import BootstrapEngine
 from cash import *
     
\ No newline at end of file
@@ -0,0 +1,71 @@
+
+import numpy as np
+
+__all__ = ['BootstrapEngine']
+
+
+class BootstrapEngine(object):
+    '''
+    Yield curve bootstrap engine for a fixed set of instruments.
+
+    The structure of the cash flow matrix, that is the sparsity pattern,
+    the column of each cash flow and the right hand side year fractions,
+    is calculated once at construction, and so are the matrices passed
+    to the discount support. A refresh re-evaluates the cash flow values
+    for the current quotes and fills the same matrices, so that the
+    support is re-solved in place by its build method.
+    '''
+    def __init__(self, cfmat, dcf):
+        '''
+            @param cfmat: a CashFlowMatrix instance
+            @param dcf:   day count fraction function
+        '''
+        cfmat.buildsparse(dcf)
+        self.cfmat   = cfmat
+        self.dcf     = dcf
+        self.key     = self.structure(cfmat)
+        self.__dense = None
+
+    @classmethod
+    def structure(cls, cfmat):
+        '''
+        Key of the instrument set of *cfmat*. An engine can be reused
+        for a cash flow matrix with the same key.
+        '''
+        return tuple((kv.key,id(kv.value),len(kv.value)) for kv in cfmat)
+
+    def __len__(self):
+        return len(self.cfmat)
+
+    def sparse(self):
+        '''
+        Left hand side and right hand side csr matrices for the current
+        quotes and the right hand side year fractions
+        '''
+        return self.cfmat.refreshsparse(self.dcf)
+
+    def matrices(self):
+        '''
+        Dense left hand side, right hand side and right hand side year
+        fractions matrices for the build method of the discount support.
+        The matrices are allocated once and filled with the current quotes.
+        '''
+        from qmpy.lib.core import lowertriang, rqmatrix
+        lhs,rhs,trhs = self.sparse()
+        dense = self.__dense
+        if dense is None:
+            N = lhs.rows
+            K = rhs.cols
+            if self.cfmat.lowertriang:
+                LHS = lowertriang(N)
+            else:
+                LHS = rqmatrix(N,N)
+            TRHS = rqmatrix(K)
+            for k,T in enumerate(trhs):
+                TRHS[k] = T
+            dense = LHS,rqmatrix(N,K),TRHS
+            self.__dense = dense
+        LHS,RHS,TRHS = dense
+        lhs.fill(LHS)
+        rhs.fill(RHS)
+        return dense
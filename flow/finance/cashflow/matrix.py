@@ -1,5 +1,7 @@
 
 
+import numpy as np
+
 from cashflow import *
 
 class sparselem(object):
@@ -41,6 +43,124 @@ class sparsecf(object):
         for el in elems:
             mat[el.row,el.col] += el.cash()
         return mat
+
+
+class csrpattern(object):
+    '''
+    Sparsity pattern of a compressed sparse row matrix built from
+    coordinate arrays. Matrices with the same pattern and different
+    values are obtained from the matrix method without sorting
+    the coordinates again.
+    '''
+    def __init__(self, rows, cols, r, c):
+        self.rows = rows
+        self.cols = cols
+        r = np.asarray(r, dtype = np.int64)
+        c = np.asarray(c, dtype = np.int64)
+        self.size = len(r)
+        if self.size:
+            key   = r*cols + c
+            order = np.argsort(key, kind = 'mergesort')
+            ukey, start = np.unique(key[order], return_index = True)
+            self.order = order
+            self.start = start
+            r = ukey // cols
+            c = ukey % cols
+        self.indptr = np.zeros(rows + 1, dtype = np.int64)
+        np.cumsum(np.bincount(r, minlength = rows), out = self.indptr[1:])
+        self.indices = c.astype(np.int32)
+        
+    def matrix(self, v):
+        '''
+        A csrmatrix with this pattern. *v* are the values in the
+        order of the coordinate arrays. Duplicate entries are summed
+        '''
+        v = np.asarray(v, dtype = float)
+        if self.size:
+            v = np.add.reduceat(v[self.order], self.start)
+        return csrmatrix(self.rows, self.cols, self.indptr, self.indices, v)
+
+
+class csrmatrix(object):
+    '''
+    Compressed sparse row matrix.
+    
+        * *indptr* row pointers, an array of size rows + 1
+        * *indices* column indices of non-zero values
+        * *data* non-zero values
+    '''
+    def __init__(self, rows, cols, indptr, indices, data):
+        self.rows    = rows
+        self.cols    = cols
+        self.indptr  = indptr
+        self.indices = indices
+        self.data    = data
+        
+    @classmethod
+    def fromcoo(cls, rows, cols, r, c, v):
+        '''
+        Build from coordinate arrays. Duplicate entries are summed
+        '''
+        return csrpattern(rows, cols, r, c).matrix(v)
+    
+    def __repr__(self):
+        return '%s %sx%s (%s)' % (self.__class__.__name__,self.rows,self.cols,len(self.data))
+    
+    def nnz(self):
+        return len(self.data)
+    
+    def todense(self):
+        mat = np.zeros((self.rows,self.cols))
+        for i in xrange(self.rows):
+            a,b = self.indptr[i],self.indptr[i+1]
+            mat[i,self.indices[a:b]] = self.data[a:b]
+        return mat
+    
+    def fill(self, mat):
+        '''
+        Fill a dense matrix object supporting item assignment
+        '''
+        mat.fill(0)
+        indptr  = self.indptr
+        indices = self.indices.tolist()
+        data    = self.data.tolist()
+        for i in xrange(self.rows):
+            for k in xrange(indptr[i],indptr[i+1]):
+                mat[i,indices[k]] = data[k]
+        return mat
+    
+    def dot(self, x):
+        '''
+        Matrix-vector product
+        '''
+        x   = np.asarray(x, dtype = float)
+        row = np.repeat(np.arange(self.rows), np.diff(self.indptr))
+        return np.bincount(row, weights = self.data*x[self.indices], minlength = self.rows)
+    
+    def solve_lower(self, b):
+        '''
+        Solve L x = b by forward substitution where L is self,
+        a lower triangular matrix. Cost is linear in the number
+        of non-zero elements. Raise ValueError if the matrix has
+        non-zero elements above the diagonal.
+        '''
+        b       = np.asarray(b, dtype = float)
+        x       = np.zeros(self.rows)
+        indptr  = self.indptr
+        indices = self.indices
+        data    = self.data
+        for i in xrange(self.rows):
+            a,e  = indptr[i],indptr[i+1]
+            cols = indices[a:e]
+            vals = data[a:e]
+            if np.any(vals[cols > i]):
+                raise ValueError('Matrix is not lower triangular at row %s' % i)
+            low  = cols < i
+            diag = vals[cols == i].sum()
+            if not diag:
+                raise ValueError('Singular matrix. Zero diagonal at row %s' % i)
+            x[i] = (b[i] - np.dot(vals[low],x[cols[low]]))/diag
+        return x
         
     
 
@@ -53,10 +173,12 @@ class CashFlowMatrix(CashFlowBase):
         CashFlowBase.__init__(self, False)
         self.drhs        = None
         self.trhs        = None
+        self.sparse      = None
         self.lowertriang = True
         
     def clear(self):
-        self.trhs = None
+        self.trhs   = None
+        self.sparse = None
         
     def add(self, cfs):
         '''
@@ -125,9 +247,84 @@ class CashFlowMatrix(CashFlowBase):
         k = 0
         for d in drhs:
             trhs[k] = dcf(d.key)
+            k += 1
         self.trhs = trhs
             
         
+    def buildsparse(self, dcf):
+        '''
+        Build the structure of the left and right hand side matrices
+        in compressed sparse row format. Columns are located with a
+        date to column dictionary rather than a search on the date series.
+        The sparsity patterns, the cash flow of each entry and the right
+        hand side date fractions are kept, so that refreshsparse only
+        re-evaluates cash values.
+        '''
+        if len(self) == 0:
+            self.sparse = None
+            return
+        drhs   = self.daterhs()
+        lhscol = dict((kv.key,i) for i,kv in enumerate(self.inner))
+        rhscol = dict((kv.key,i) for i,kv in enumerate(drhs))
+        N      = len(lhscol)
+        K      = len(rhscol)
+        lr, lc, lcash = [], [], []
+        rr, rc, rcash = [], [], []
+        row    = 0
+        for cfs in self.itervalues():
+            for kv in cfs:
+                dte = kv.key
+                cf  = kv.value
+                col = rhscol.get(dte,None)
+                if col is not None:
+                    rr.append(row)
+                    rc.append(col)
+                    rcash.append(cf)
+                else:
+                    lr.append(row)
+                    lc.append(lhscol[dte])
+                    lcash.append(cf)
+            row += 1
+        trhs = np.array([dcf(kv.key) for kv in drhs], dtype = float)
+        self.sparse = (csrpattern(N, N, lr, lc), lcash,
+                       csrpattern(N, K, rr, rc), rcash,
+                       trhs)
+        
+    def refreshsparse(self, dcf):
+        '''
+        Sparse version of refresh. Return a tuple of left hand side,
+        right hand side csr matrices and right hand side date fractions.
+        The structure is built once, cash values are evaluated
+        at each call.
+        '''
+        if self.sparse is None:
+            self.buildsparse(dcf)
+        if self.sparse is None:
+            return None,None,None
+        lpattern, lcash, rpattern, rcash, trhs = self.sparse
+        lhs = lpattern.matrix([cf.cash() for cf in lcash])
+        rhs = rpattern.matrix([cf.cash() for cf in rcash])
+        return lhs,rhs,trhs
+    
+    def solve(self, dcf, target, known = None):
+        '''
+        Solve for the discount factors at the cash flow matrix dates.
+        
+            * *dcf* day count fraction function
+            * *target* array of instrument values, one for each row
+            * *known* discount factors at right hand side dates
+        '''
+        lhs,rhs,trhs = self.refreshsparse(dcf)
+        if lhs is None:
+            return None
+        b = np.asarray(target, dtype = float)
+        if known is not None and rhs.nnz():
+            b = b - rhs.dot(known)
+        if self.lowertriang:
+            return lhs.solve_lower(b)
+        else:
+            return np.linalg.solve(lhs.todense(), b)
+        
     def getmatrices(self):
         from qmpy.lib.core import lowertriang, rqmatrix
         trhs  = self.trhs
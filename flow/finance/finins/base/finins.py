@@ -118,6 +118,15 @@ class finins(PositionBase):
     def notional(self, size = 1):
         return float(self.__instrument.tonotional(size))
     
+    def notional_multiplier(self):
+        '''
+        If the notional is linear in the market price return the
+        multiplier m such that notional(size) = m*size*mktprice,
+        otherwise None.
+        Used for calculating historical notional on arrays.
+        '''
+        return None
+    
     def nav(self, size = 1):
         try:
             p = float(self.mktprice)
@@ -17,6 +17,12 @@ class equity(FinIns):
         except:
             return self.notavailable
     
+    def notional_multiplier(self):
+        try:
+            return float(self.multiplier())
+        except:
+            return None
+    
     def nav(self, size):
         return self.notional(size)
         
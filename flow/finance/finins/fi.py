@@ -69,6 +69,9 @@ class BulletBond(bond, value_date_plugin):
         except:
             return self.notavailable
     
+    def notional_multiplier(self):
+        return self.multiplier()
+    
     def nav(self, size):
         return self.notional(size)
         
@@ -1,4 +1,6 @@
-from datetime import datetime
+from array import array
+from datetime import datetime, date, timedelta
+from itertools import izip
 
 from jflow.conf import settings
 from jflow.core import dates
@@ -12,7 +14,100 @@ __all__ = ['get_cache']
 
 def TrimCodeDefault(code):
     return str(code).upper().replace(' ','_')
-    
+
+
+def packts(ts):
+    '''
+    Pack a numeric timeserie into a compact binary string.
+    The string contains an int32 array of day ordinals
+    followed by a float64 array of values.
+    Return None if the timeserie cannot be packed
+    '''
+    dts  = array('i')
+    vals = array('d')
+    try:
+        for d,v in ts.items():
+            dts.append(todate(d).toordinal())
+            vals.append(v)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return array('i',[len(dts)]).tostring() + dts.tostring() + vals.tostring()
+
+
+def unpackts(blob):
+    '''
+    Inverse of packts. Return a tuple of two arrays,
+    day ordinals and values
+    '''
+    header = array('i')
+    header.fromstring(blob[:header.itemsize])
+    N    = header[0]
+    off  = header.itemsize
+    dts  = array('i')
+    dts.fromstring(blob[off:off+N*dts.itemsize])
+    off += N*dts.itemsize
+    vals = array('d')
+    vals.fromstring(blob[off:])
+    return dts, vals
+
+
+class dateintervals(object):
+    '''
+    Ordered set of disjoint closed date intervals.
+    Used by rateHistory to record which date ranges
+    of a timeserie have been loaded from data providers
+    '''
+    def __init__(self):
+        self.intervals = []
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def __iter__(self):
+        return iter(self.intervals)
+
+    def __repr__(self):
+        return '%s' % self.intervals
+
+    def add(self, start, end):
+        '''
+        Add the closed interval [start, end] merging it
+        with overlapping or adjacent intervals
+        '''
+        if start > end:
+            start, end = end, start
+        oned = timedelta(days = 1)
+        merged = []
+        for s,e in self.intervals:
+            if e + oned < start or end + oned < s:
+                merged.append((s,e))
+            else:
+                start = min(start,s)
+                end   = max(end,e)
+        merged.append((start,end))
+        merged.sort()
+        self.intervals = merged
+
+    def gaps(self, start, end):
+        '''
+        List of (start, end) closed intervals within
+        [start, end] which are not covered
+        '''
+        oned = timedelta(days = 1)
+        gaps = []
+        for s,e in self.intervals:
+            if e < start:
+                continue
+            if s > end:
+                break
+            if s > start:
+                gaps.append((start,s - oned))
+            start = e + oned
+            if start > end:
+                return gaps
+        gaps.append((start,end))
+        return gaps
+
 
 class rateCache(LoggingClass):
     '''
@@ -169,8 +264,7 @@ class rateHistory(cacheObject):
         self._factory        = creator
         self._factory.holder = self
         self.live            = None
-        self.start           = {}
-        self.end             = {}
+        self.loaded          = {}
         self._timeseries     = {}
         
     def save(self):
@@ -186,6 +280,8 @@ class rateHistory(cacheObject):
     
     def __setstate__(self,dict):
         super(rateHistory,self).__setstate__(dict)
+        if not hasattr(self,'loaded'):
+            self.loaded = {}
         self._timeseries = {}
         self._factory.holder = self
         
@@ -194,6 +290,24 @@ class rateHistory(cacheObject):
     
     def tsname(self, vfid):
         return '%s:%s:%s' % (self.cache.ratekey(self.code),vfid.field,vfid.vendor)
+    
+    def loadedintervals(self, key):
+        '''
+        The dateintervals instance recording the date ranges
+        loaded for timeserie key
+        '''
+        intervals = self.loaded.get(key,None)
+        if intervals is None:
+            intervals = dateintervals()
+            self.loaded[key] = intervals
+        return intervals
+    
+    def markloaded(self, key, start, end):
+        '''
+        Record that timeserie key has been loaded from start to end
+        '''
+        self.loadedintervals(key).add(todate(start),todate(end))
+        self.save()
         
     def timeseries(self, vfid):
         '''        
@@ -210,8 +324,16 @@ class rateHistory(cacheObject):
             else:
                 nts = dateseries(key)
             
-            for d,v in fts:
-                nts[todate(d)] = v
+            if isinstance(fts,str):
+                # The blob is decoded without unpickling, but the timeseries
+                # types have no bulk constructor so values are still inserted
+                # one at a time.
+                dts, vals   = unpackts(fts)
+                for d,v in izip(map(date.fromordinal,dts),vals):
+                    nts[d] = v
+            else:
+                for d,v in fts:
+                    nts[todate(d)] = v
             
             self._timeseries[key] = nts
                             
@@ -224,15 +346,14 @@ class rateHistory(cacheObject):
         if ts:
             st = todate(ts.front()[0])
             ed = todate(ts.back()[0])
-            self.start[ts.name] = st
-            self.end[ts.name]   = ed
-            tslist              = [(todate(d),v) for d,v in ts.items()]
-            self.backend.set(ts.name,tslist,settings.RATE_CACHE_SECONDS)
+            tsdata              = None
+            if isinstance(ts,numericts):
+                tsdata = packts(ts)
+            if tsdata is None:
+                tsdata = [(todate(d),v) for d,v in ts.items()]
+            self.backend.set(ts.name,tsdata,settings.RATE_CACHE_SECONDS)
             self.save()
             self.logger.debug('Cached %s from %s to %s' % (ts.name,st,ed))
-        else:
-            self.start = None
-            self.end   = None
         
     def clearlive(self, live_key):
         return
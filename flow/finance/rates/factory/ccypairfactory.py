@@ -1,10 +1,78 @@
 
+import numpy as np
+
 from factory import compositeFactory
 
 
+def tsarrays(ts):
+    '''
+    Return the dates and values of timeserie ts as a list and
+    a float array
+    '''
+    dates  = []
+    values = []
+    for k,v in ts.items():
+        dates.append(k)
+        values.append(v)
+    return dates, np.array(values, dtype = float)
+
+
+def alignts(ts1, ts2, ffill = False):
+    '''
+    Align two timeseries on their common dates.
+    If ffill is True, the union of dates from the first date
+    where both series are available is used and missing values
+    are forward-filled from the previous date.
+    Return a tuple of dates and two float arrays
+    '''
+    d1, v1 = tsarrays(ts1)
+    d2, v2 = tsarrays(ts2)
+    if not ffill:
+        idx2  = dict((d,i) for i,d in enumerate(d2))
+        i1    = []
+        i2    = []
+        dates = []
+        for i,d in enumerate(d1):
+            j = idx2.get(d,None)
+            if j is not None:
+                dates.append(d)
+                i1.append(i)
+                i2.append(j)
+        return dates, v1[i1], v2[i2]
+
+    if not d1 or not d2:
+        return [], v1[:0], v2[:0]
+    start = max(d1[0],d2[0])
+    dates = sorted(set(d1).union(d2))
+    dates = [d for d in dates if d >= start]
+    # position of the last observation at or before each date
+    o1 = [d.toordinal() for d in d1]
+    o2 = [d.toordinal() for d in d2]
+    od = [d.toordinal() for d in dates]
+    i1 = np.searchsorted(o1, od, side = 'right') - 1
+    i2 = np.searchsorted(o2, od, side = 'right') - 1
+    return dates, v1[i1], v2[i2]
+
+
+def applyfunc(func, values):
+    '''
+    Apply a scalar conversion function to an array of values
+    '''
+    try:
+        return np.asarray(func(values), dtype = float)
+    except Exception:
+        return np.array([func(v) for v in values], dtype = float)
+
+
 class ccypairFactory(compositeFactory):
-    
-    def __init__(self, c1, c2):
+    '''
+    Rate factory for currency pairs.
+
+        @param ffill: if True, cross rates are calculated across
+                      mismatched holidays by forward-filling the
+                      missing leg. Default False.
+    '''
+    def __init__(self, c1, c2, ffill = False):
         if str(c1) == 'USD':
             codes = (c2,)
         elif str(c2) == 'USD':
@@ -12,12 +80,13 @@ class ccypairFactory(compositeFactory):
         else:
             codes = (c1,c2)
         super(ccypairFactory,self).__init__(True,*codes)
-        self.c1 = c1
-        self.c2 = c2
-        
+        self.c1    = c1
+        self.c2    = c2
+        self.ffill = ffill
+
     def code(self):
         return '%s%s' % (self.c1,self.c2)
-    
+
     def buildcomposite(self, cts, tseries):
         if str(self.c1) == 'USD':
             c1 = None
@@ -33,23 +102,25 @@ class ccypairFactory(compositeFactory):
             c2 = tseries.get(str(self.c2))
             if c1 and c2:
                 self._buildc12(cts,c1,c2)
-        
+
+    def _fill(self, cts, dates, values):
+        # skip points where the conversion is not defined
+        valid = np.isfinite(values).tolist()
+        for k,v,ok in zip(dates,values.tolist(),valid):
+            if ok:
+                cts[k] = v
+
     def _buildc1(self, cts, c1):
-        func = self.c1.overusdfunc()
-        for k,v in c1.items():
-            cts[k] = func(v) 
-    
+        dates, v1 = tsarrays(c1)
+        self._fill(cts, dates, applyfunc(self.c1.overusdfunc(),v1))
+
     def _buildc2(self, cts, c2):
-        func = self.c2.usdoverfunc()
-        for k,v in c2.items():
-            cts[k] = func(v)
-    
+        dates, v2 = tsarrays(c2)
+        self._fill(cts, dates, applyfunc(self.c2.usdoverfunc(),v2))
+
     def _buildc12(self, cts, c1, c2):
-        func1 = self.c1.overusdfunc()
-        func2 = self.c2.usdoverfunc()
-        for k,v1 in c1.items():
-            try:
-                v2 = c2[k]
-                cts[k]  = func1(v1) * func2(v2)
-            except:
-                pass
+        dates, v1, v2 = alignts(c1, c2, self.ffill)
+        if not dates:
+            return
+        values = applyfunc(self.c1.overusdfunc(),v1) * applyfunc(self.c2.usdoverfunc(),v2)
+        self._fill(cts, dates, values)
@@ -2,7 +2,7 @@ from jflow.core import dates
 from jflow.core.dates import timedelta, qdatetodate, get_livedate
 from jflow.core.rates import cacheObject, objects
 
-from loader import histloader, shistloader
+from loader import histloader, shistloader, sharedhistloader
 from period import periodParser
 
 __all__ = ['vendorfieldid',
@@ -12,6 +12,21 @@ __all__ = ['vendorfieldid',
            'compositeCodeFactory']
 
 
+def hasbizday(start, end):
+    '''
+    True if the closed interval [start, end] contains a week day
+    '''
+    if (end - start).days >= 2:
+        return True
+    d    = start
+    oned = timedelta(days = 1)
+    while d <= end:
+        if d.weekday() < 5:
+            return True
+        d += oned
+    return False
+
+
 class vendorfieldid(object):
     '''
     Vendor Field Id object
@@ -90,8 +105,12 @@ class rateFactory(cacheObject):
     def loadhistory(self, start, end, field, vendor = None, period = None, parent = None):
         '''
         load historical data into cache.
-        This function returns an instance of rateloader
-        to which the user can attach callbacks and errbacks
+        Top level requests return a Deferred with a code method, fired
+        with the result of the loader shared by all concurrent requests
+        for the same series and date range. It fires on the reactor
+        thread, or straight away if the date range is already in cache.
+        Requests with a parent loader return the rate loader itself.
+        Both accept callbacks and errbacks.
         '''
         el = periodParser.get(period or 'd',None)
         vfid   = self.get_fvid(field,vendor)
@@ -99,12 +118,16 @@ class rateFactory(cacheObject):
             self.logger.debug("%s:%s %s to %s, %s" % (vfid.field,vfid.vendor,start,end,el.name))
         else:
             self.logger.critical("No data provider for field %s and vendor %s" % (field,vendor))
+        if vfid and parent is None:
+            return sharedhistloader(self, start, end, el, vfid)
         return histloader(self, start, end, el, vfid, parent = parent).load()
     
     def _loading_dates(self, start, end, vfid):
         '''
-        Select date range which needs to be fetch
-        from cache or data provider
+        Select the date ranges which need to be fetched
+        from the data provider. Return a tuple containing the list
+        of (start, end) gaps not yet loaded into cache and the
+        requested start and end dates.
         '''
         key = self.holder.tsname(vfid)
         if start > end:
@@ -118,29 +141,15 @@ class rateFactory(cacheObject):
         else:
             end = end.date
         start = start.date
-            
-        _start = self.holder.start.get(key,None)
-        _end   = self.holder.end.get(key,None)
-        load   = True
-        if _start:
-            oned = timedelta(days = 1)
-            load = False
-            if end > _end or start < _start:
-                load = True
-            
-            if load:
-                if end <= _end:
-                    end = _start - oned
-                elif start >= _start:
-                    start =  _end + oned
-                if start > end:
-                    start = end
         
-        return load, start, end, realstart, realend
+        gaps = self.holder.loadedintervals(key).gaps(start, end)
+        gaps = [(s,e) for s,e in gaps if hasbizday(s,e)]
+        return gaps, realstart, realend
     
-    def _performload(self, start, end, field, vendor, handler=None):
+    def _performload(self, loader, start, end, handler = None):
         '''
-        Called by histloader object
+        Called by histloader object for each date range
+        which needs loading
         '''
         pass
     
@@ -213,18 +222,19 @@ class idFactory(rateFactory):
                                       dte = dte,
                                       inst = ic)       
         
-    def _performload(self, loader, handler = None):
+    def _performload(self, loader, start, end, handler = None):
         '''
         Call the vendor interface to load time-series data
+        between start and end
         '''
         vfid = loader.vfid
         if vfid:
             ci = vfid.vendor.interface()
             if ci:
-                self.logger.debug("%s:%s %s to %s" % (vfid.field,vfid.vendor,loader.start,loader.end))
+                self.logger.debug("%s:%s %s to %s" % (vfid.field,vfid.vendor,start,end))
                 return ci.history(vfid,
-                                  loader.start,
-                                  loader.end,
+                                  start,
+                                  end,
                                   self.holder)
             else:
                 self.logger.error('Cannot load rate. Vendor "%s" has no interface available' % vid.vendor)
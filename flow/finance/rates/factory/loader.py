@@ -6,7 +6,8 @@ from jflow.utils.decorators import runInThread, threadSafe
 from jflow.utils.tx import DeferredInChain
 from jflow.core.field import fieldproxy
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.python import failure
 
 
 def histloader(factory, start, end, period, vfid, parent = None):
@@ -18,6 +19,106 @@ def histloader(factory, start, end, period, vfid, parent = None):
         return mhistloader(factory, start, end, period, vfid, parent)
     else:
         return shistloader(factory, start, end, period, vfid, parent)
+
+
+def sharedhistloader(factory, start, end, period, vfid):
+    '''
+    Rate History loader function with request coalescing.
+    Concurrent requests for the same code, field, vendor and
+    date range share one loader.
+    Return a historyload Deferred. If the date range is already in
+    cache it fires straight away in the calling thread, which may not
+    be running a reactor (the web process).
+    '''
+    d      = historyload(vfid)
+    loader = histloader(factory, start, end, period, vfid)
+    if not loader.gaps:
+        loader.addCallbacks(d.callback, d.errback)
+        loader.load()
+        return d
+    key = (factory.holder.code,
+           str(vfid.field),
+           str(vfid.vendor),
+           str(start),
+           str(end))
+    return _inflight.get_or_load(key, lambda : loader, d)
+
+
+class historyload(defer.Deferred):
+    '''
+    Deferred returned by sharedhistloader. It fires with the loader
+    result and, like the loaders, exposes the code of the series.
+    '''
+    def __init__(self, vfid):
+        defer.Deferred.__init__(self)
+        self.vfid = vfid
+    
+    def code(self):
+        return str(self.vfid)
+
+
+class inflightLoads(object):
+    '''
+    Single-flight registry of history loaders.
+    The first request for a key creates and starts the loader.
+    Every request, including the first, obtains a new Deferred which
+    fires with the loader result, so that callbacks added by one waiter
+    do not alter the result seen by the others.
+    The key is removed once the loader has finished.
+    
+    Twisted Deferreds are not thread safe, therefore the registry is
+    only accessed from the reactor thread and waiters are fired there.
+    *callFromThread* schedules a call on that thread and defaults to
+    the reactor's.
+    '''
+    def __init__(self, callFromThread = None):
+        self.loaders        = {}
+        self.callFromThread = callFromThread or reactor.callFromThread
+        
+    def __len__(self):
+        return len(self.loaders)
+    
+    def get_or_load(self, key, create, d = None):
+        '''
+        Return the Deferred *d*, or a new one, fired with the result
+        of the loader for *key*. *create* is called, on the reactor
+        thread, when no loader for *key* is running.
+        '''
+        if d is None:
+            d = defer.Deferred()
+        self.callFromThread(self.__register, key, create, d)
+        return d
+    
+    def __register(self, key, create, d):
+        waiters = self.loaders.get(key,None)
+        if waiters is not None:
+            waiters.append(d)
+            return
+        self.loaders[key] = [d]
+        try:
+            loader = create()
+        except:
+            self.__fire(key, failure.Failure())
+            return
+        done = self.__done(key)
+        loader.addCallbacks(done,done)
+        loader.load()
+    
+    def __done(self, key):
+        def done(res):
+            self.callFromThread(self.__fire, key, res)
+            return res
+        return done
+    
+    def __fire(self, key, res):
+        for d in self.loaders.pop(key,()):
+            if isinstance(res,failure.Failure):
+                d.errback(res)
+            else:
+                d.callback(res)
+
+
+_inflight = inflightLoads()
     
 
 class bhistloader(DeferredInChain):
@@ -37,12 +138,17 @@ class bhistloader(DeferredInChain):
         self.end               = end
         self.period            = period
         self.vfid              = vfid
+        self.gaps              = []
         self._load             = False
         self._loading_dates()
             
     def _loading_dates(self):
         if self.vfid:
-            self._load, self.start, self.end, self.realstart, self.realend = self.factory._loading_dates(self.start, self.end, self.vfid)
+            self.gaps, self.realstart, self.realend = self.factory._loading_dates(self.start, self.end, self.vfid)
+            if self.gaps:
+                self._load  = True
+                self.start  = self.gaps[0][0]
+                self.end    = self.gaps[-1][1]
     
     def __str__(self):
         return self.code()
@@ -78,8 +184,18 @@ class bhistloader(DeferredInChain):
         The dictionary self.results contains timeseries of underlying rates.
         We pass this to the Factory to deal with
         '''
+        self.markloaded()
         return self.handleupdate(self.results)
     
+    def markloaded(self):
+        '''
+        Record the loaded date ranges in the rate holder
+        '''
+        holder = self.holder
+        key    = holder.tsname(self.vfid)
+        for start,end in self.gaps:
+            holder.markloaded(key, start, end)
+    
     def create_result(self, res = None):
         '''
         The loader has finished and this function has been called.
@@ -115,24 +231,66 @@ class bhistloader(DeferredInChain):
 
 class shistloader(bhistloader):
     '''
-    loader for a single data
+    loader for a single data.
+    One vendor request is sent for each gap in the cached timeserie
+    and the results are merged into the rate holder timeserie.
     '''
     def __init__(self, *args):
         bhistloader.__init__(self, *args)
     
     def __handleupdate(self, res):
         if isinstance(res,defer.Deferred):
-            res.addCallbacks(self.__handleupdate,self.errback)
-        else:
-            self.results = res
-            self.finished()
+            return res.addCallback(self.__handleupdate)
+        self.__merge(res)
+        return res
+    
+    def __success(self, res):
+        self.results = self.holder.timeseries(self.vfid)
+        self.holder.memorise(self.results)
+        self.finished()
+    
+    def __failure(self, err):
+        # unwrap the first failing gap from the DeferredList
+        if isinstance(err.value,defer.FirstError):
+            err = err.value.subFailure
+        self.errback(err)
+    
+    def __merge(self, res):
+        '''
+        Merge a partial result into the holder timeserie
+        '''
+        nts = self.holder.timeseries(self.vfid)
+        if res is None or res is nts:
+            return
+        try:
+            items = res.items()
+        except AttributeError:
+            return
+        for d,v in items:
+            nts[d] = v
         
     def _do_load(self):
-        '''Send the request to the data loader Thread Pool'''
-        self.factory.loaderpool.deferToThread(self.__handleupdate,
-                                              self.errback,
-                                              self.factory._performload,
-                                              self)
+        '''
+        Send one request per gap to the data loader Thread Pool.
+        Gap results are fired on the reactor thread and collected in a
+        DeferredList, so that the loader fires once, when all gaps are
+        merged or at the first failure.
+        '''
+        requests = []
+        for start,end in self.gaps:
+            d = defer.Deferred()
+            d.addCallback(self.__handleupdate)
+            self.factory.loaderpool.deferToThread(lambda r, d = d : reactor.callFromThread(d.callback,r),
+                                                  lambda e, d = d : reactor.callFromThread(d.errback,e),
+                                                  self.factory._performload,
+                                                  self,
+                                                  start,
+                                                  end)
+            requests.append(d)
+        dl = defer.DeferredList(requests,
+                                fireOnOneErrback = True,
+                                consumeErrors = True)
+        dl.addCallbacks(self.__success,self.__failure)
     
     
     
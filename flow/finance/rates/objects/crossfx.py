@@ -1,4 +1,7 @@
+import numpy as np
+
 from jflow.utils.decorators import lazyattr
+from jflow.core.rates.cache import trimCode
 
 from composite import compositeRate
 
@@ -7,12 +10,18 @@ __all__ = ['crossfx']
 
 class crossfx(compositeRate):
     '''
-    Cross FX rate
+    Cross FX rate.
+    Cross rates between all currencies are stored in a matrix which
+    is rebuilt from the USD legs only when the input rates change.
     '''
     def __init__(self, usd = None, *args, **kwargs):
         super(crossfx,self).__init__( *args, **kwargs)
         self.usd = usd
         self.ycs = {}
+        self.__index   = {}
+        self.__pairs   = {}
+        self.__matrix  = []
+        self.__dirty   = True
     
     def swap(self, c1, c2):
         inv = False
@@ -24,7 +33,6 @@ class crossfx(compositeRate):
         return inv,c1,c2
     
     def __codes(self, code):
-        self.build()
         srte = trimCode(code)
         if len(srte) != 6:
             raise ValueError
@@ -34,9 +42,79 @@ class crossfx(compositeRate):
             raise ValueError
         return c1,c2
     
+    def update_me(self, args = None):
+        self.__dirty = True
+        return super(crossfx,self).update_me(args)
+    
+    def rebuild_rate(self):
+        super(crossfx,self).rebuild_rate()
+        self.__dirty = True
+        self.refresh_rate()
+        
+    def refresh_rate(self):
+        if self.__dirty:
+            self.__buildmatrix()
+            
+    def __buildmatrix(self):
+        '''
+        Build the N x N cross rate matrix from the USD legs.
+        Element [i][j] is the value of currency i in units of currency j.
+        '''
+        ccys = [self.usd]
+        for r in self.rates.values():
+            c = getattr(r,'ccy',None)
+            if c is not None and c.code != self.usd.code:
+                ccys.append(c)
+        index  = {}
+        values = []
+        for i,c in enumerate(ccys):
+            index[str(c)] = i
+            try:
+                values.append(self.__value_ccy(c))
+            except:
+                values.append(None)
+        matrix = []
+        for i,v1 in enumerate(values):
+            row = []
+            for j,v2 in enumerate(values):
+                if i == j:
+                    row.append(1.0)
+                else:
+                    try:
+                        row.append(v1/v2)
+                    except:
+                        row.append(None)
+            matrix.append(row)
+        self.__index  = index
+        self.__matrix = matrix
+        self.__pairs  = {}
+        self.__dirty  = False
+        
+    def __pairindex(self, code):
+        '''
+        Matrix indices for a currency-pair code
+        '''
+        ij = self.__pairs.get(code,None)
+        if ij is None:
+            srte = trimCode(code)
+            if len(srte) != 6:
+                raise ValueError
+            ij = self.__index[srte[:3]],self.__index[srte[3:]]
+            self.__pairs[code] = ij
+        return ij
+    
     def spot(self, c1, c2):
+        self.build()
+        return self.__spot(c1,c2)
+    
+    def __spot(self, c1, c2):
         if c1 == c2:
             return 1.0
+        index = self.__index
+        try:
+            return self.__matrix[index[str(c1)]][index[str(c2)]]
+        except (KeyError, IndexError):
+            pass
         inverse, c1, c2 = self.swap(c1,c2)
         try:
             v1 = self.__value_ccy(c1)
@@ -58,11 +136,12 @@ class crossfx(compositeRate):
         code must be a currency-pair string such as
             eurusd, gbpusd, usdchf etc...
         '''
+        self.build()
         try:
-            c1,c2 = self.__codes(code)
+            i,j = self.__pairindex(code)
+            return self.__matrix[i][j]
         except:
             return None
-        return self.spot(c1,c2)
     
     def __value_ccy(self, c1):        
         r = self.rates.get(str(c1))
@@ -83,24 +162,67 @@ class crossfx(compositeRate):
                 return None
         
     def fwd(self, code = None, valuedate = None, fields = None):
+        self.build()
         try:
             c1,c2 = self.__codes(code)
         except:
             return self.badvalue
-        v = self.spot(c1,c2)
+        v = self.__spot(c1,c2)
         yc1 = self.__get_yc(c1)
         yc2 = self.__get_yc(c2)
         df1 = yc1.df(valuedate)
         df2 = yc2.df(valuedate)
         return v*df1/df2
+    
+    def fwd_many(self, pairs, dates):
+        '''
+        Forward rates for a list of currency-pair codes at a list of
+        value dates. Discount factors are evaluated once per currency
+        for the whole list of dates.
+        Return a len(pairs) x len(dates) float array, with nan where
+        the forward rate is not available.
+        '''
+        self.build()
+        result = np.empty((len(pairs),len(dates)))
+        result.fill(np.nan)
+        dfs   = {}
+        codes = {}
+        for k,code in enumerate(pairs):
+            if code not in codes:
+                try:
+                    codes[code] = self.__codes(code)
+                except:
+                    codes[code] = None
+            if codes[code] is None:
+                continue
+            c1,c2 = codes[code]
+            v = self.__spot(c1,c2)
+            if v is None:
+                continue
+            df1 = self.__df_many(c1,dates,dfs)
+            df2 = self.__df_many(c2,dates,dfs)
+            if df1 is None or df2 is None:
+                continue
+            result[k] = v*df1/df2
+        return result
+    
+    def __df_many(self, c, dates, dfs):
+        key = str(c)
+        if key not in dfs:
+            yc = self.__get_yc(c)
+            if yc:
+                dfs[key] = yc.df_many(dates)
+            else:
+                dfs[key] = None
+        return dfs[key]
         
     def __get_yc(self, c):
         from get import get_rate
         ycs = self.ycs
-        yc  = ycs.get(c1,None)
+        yc  = ycs.get(c,None)
         if yc == None:
             code = '%sYC' % c.code
             yc = get_rate(code)
             if yc:
-                ycs[c1] = yc
+                ycs[c] = yc
         return yc
\ No newline at end of file
@@ -1,5 +1,8 @@
 
+import numpy as np
+
 from qmpy.python.decorators import lazyattr
+from jflow.core.cashflow import BootstrapEngine
 from base import *
 
 __all__ = ['yc','convenienceComposite']
@@ -15,6 +18,7 @@ class yc(compositeDiscount):
         super(yc,self).__init__(*args, **kwargs)
         self.__support = None
         self.__cfs     = None
+        self.__engine  = None
     
     def __get_support(self):
         return self.__support
@@ -31,6 +35,32 @@ class yc(compositeDiscount):
             return self.__support[T]
         else:
             return self.badvalue
+    
+    def df_many(self, dates):
+        '''
+        Discount factors for a sequence of dates.
+        The curve is built once and the support is evaluated
+        for the whole array of year fractions.
+        Return a float array.
+        '''
+        self.build()
+        T = np.array([self.dcf(d) for d in dates], dtype = float)
+        return self._dft_many(T)
+    
+    def _dft_many(self, T):
+        '''
+        Vectorised version of _dft
+        '''
+        sup = self.__support
+        if not sup:
+            bad = self.badvalue
+            if bad is None:
+                bad = np.nan
+            return np.repeat(float(bad),len(T))
+        try:
+            return np.asarray(sup[T], dtype = float)
+        except Exception:
+            return np.array([sup[t] for t in T], dtype = float)
         
     def __buildCashFlow(self):
         '''
@@ -46,21 +76,30 @@ class yc(compositeDiscount):
         return cfmat
     
     def rebuild_rate(self):
-        self.__cfs = self.__buildCashFlow()
+        self.__cfs    = self.__buildCashFlow()
+        self.__engine = None
         self.refresh_rate()
         
     def refresh_rate(self):
-        # Get cashflow for building
+        '''
+        Refresh the curve with the current quotes. The bootstrap engine
+        is reused while the instruments with a quote do not change, and
+        the support is re-solved in place.
+        '''
         cfmat = self.__cfs.cleaned(self)
-        lhs,rhs,trhs = cfmat.refresh(self.dcf)
-        if trhs == None:
+        if not len(cfmat):
+            self.__engine  = None
+            self.__support = None
             return
-        else:
-            sup = self.support
-            if sup == None:
-                sup = self.__initial(cfmat)
-                self.__support = sup
-            sup.build(lhs,rhs,trhs)
+        engine = self.__engine
+        if engine == None or engine.key != BootstrapEngine.structure(cfmat):
+            engine = BootstrapEngine(cfmat, self.dcf)
+            self.__engine = engine
+        sup = self.__support
+        if sup == None:
+            sup = self.__initial(cfmat)
+            self.__support = sup
+        sup.build(*engine.matrices())
         
     def __initial(self, cfmat):
         '''